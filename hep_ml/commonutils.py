@@ -7,13 +7,18 @@ from __future__ import print_function, division, absolute_import
 
 import math
 import io
+import os
 import numbers
+import shutil
+import tempfile
+import timeit
+from collections import deque, OrderedDict
 import numpy
 import pandas
 from numpy.random.mtrand import RandomState
 from scipy.special import expit
 import sklearn.cross_validation
-from sklearn.utils.validation import check_arrays
+from sklearn.utils.validation import check_arrays, check_random_state
 #from sklearn.neighbors.unsupervised import NearestNeighbors
 from sklearn.neighbors import NearestNeighbors
 
@@ -151,6 +156,73 @@ def weighted_percentile(array, percentiles, sample_weight=None, array_sorted=Fal
     return numpy.interp(percentiles, weighted_quantiles, array)
 
 
+class SortedColumns(object):
+    def __init__(self, arrays, sample_weight=None, old_style=False):
+        """ Column-wise sorted copy of 2-dimensional array together with weighted quantiles of each column.
+        Sorting is done once, after this any number of percentiles can be computed (see weighted_percentiles).
+        :param arrays: numpy.array of shape [n_samples, n_columns], i.e. one column per classifier or per stage
+        :param sample_weight: array-like of shape [n_samples], the same weights are used for all columns
+        :param old_style: if True, will correct output to be consistent with numpy.percentile.
+        """
+        arrays = numpy.array(arrays)
+        if arrays.ndim == 1:
+            arrays = arrays[:, numpy.newaxis]
+        assert arrays.ndim == 2, 'arrays should be 2-dimensional'
+        sample_weight = check_sample_weight(arrays, sample_weight)
+        n_samples, n_columns = arrays.shape
+        columns_index = numpy.arange(n_columns)
+
+        order = numpy.argsort(arrays, axis=0)
+        self.sorted_arrays = arrays[order, columns_index]
+        ordered_weights = sample_weight[order]
+        self.weighted_quantiles = numpy.cumsum(ordered_weights, axis=0) - 0.5 * ordered_weights
+        if old_style:
+            self.weighted_quantiles -= self.weighted_quantiles[[0], :]
+            self.weighted_quantiles /= self.weighted_quantiles[[-1], :]
+        else:
+            self.weighted_quantiles /= numpy.sum(sample_weight)
+
+    def percentiles(self, percentiles):
+        """ Linear interpolation, the same as numpy.interp, but done for all columns simultaneously.
+        :param percentiles: array-like with floats in [0, 1], shape = [n_percentiles]
+        :return: numpy.array of shape [n_percentiles, n_columns]
+        """
+        percentiles = numpy.atleast_1d(numpy.array(percentiles, dtype=float))
+        assert numpy.all(percentiles >= 0) and numpy.all(percentiles <= 1), 'Percentiles should be in [0, 1]'
+        xp, fp = self.weighted_quantiles, self.sorted_arrays
+        n_samples, n_columns = xp.shape
+        if n_samples == 1:
+            return numpy.repeat(fp, len(percentiles), axis=0)
+
+        # each column is shifted, so all columns can be searched in one flat sorted array
+        shifts = 2. * numpy.arange(n_columns)
+        flat_xp = (xp + shifts).T.ravel()
+        targets = numpy.clip(percentiles[:, numpy.newaxis], xp[0, :], xp[-1, :]) + shifts
+        column_starts = numpy.arange(n_columns) * n_samples
+        right = numpy.searchsorted(flat_xp, targets.ravel()).reshape(targets.shape)
+        right = numpy.clip(right, column_starts + 1, column_starts + n_samples - 1)
+        left = right - 1
+
+        flat_fp = fp.T.ravel()
+        denominator = flat_xp[right] - flat_xp[left]
+        fraction = (targets - flat_xp[left]) / numpy.where(denominator > 0, denominator, 1.)
+        return flat_fp[left] + numpy.clip(fraction, 0, 1) * (flat_fp[right] - flat_fp[left])
+
+
+def weighted_percentiles(arrays, percentiles, sample_weight=None, old_style=False):
+    """ Vectorized version of weighted_percentile for many arrays and many percentiles at once.
+    NOTE: percentiles should be in [0, 1]!
+    :param arrays: numpy.array of shape [n_samples, n_columns] or SortedColumns (then sorting is skipped)
+    :param percentiles: array-like with many percentiles
+    :param sample_weight: array-like of shape [n_samples], ignored if arrays is SortedColumns
+    :param old_style: if True, will correct output to be consistent with numpy.percentile.
+    :return: numpy.array of shape [n_percentiles, n_columns]
+    """
+    if not isinstance(arrays, SortedColumns):
+        arrays = SortedColumns(arrays, sample_weight=sample_weight, old_style=old_style)
+    return arrays.percentiles(percentiles)
+
+
 def build_normalizer(signal, sample_weight=None):
     """Prepares normalization function for some set of values
     transforms it to uniform distribution from [0, 1]. Example of usage:
@@ -238,6 +310,224 @@ def computeKnnIndicesOfSameClass(uniform_variables, X, y, n_neighbours=50):
 # endregion
 
 
+# region Debug recorder
+
+
+class DebugRecorder(object):
+    def __init__(self, max_records=None, dtype=None, n_events=None, directory=None, random_state=None):
+        """
+        Keeps intermediate arrays (weights, predictions, gradients) recorded during training.
+        Instance is passed as keep_debug_info to uBoostBDT and flatness losses,
+        each fitting gets own recorder with the same settings (see fresh).
+        Recorded values are available as recorder[name] (list-like, one row per record).
+
+        :param max_records: int or None, if not None, only the last max_records records of each name are kept
+        :param dtype: None or numpy dtype (for instance, numpy.float16) used to store arrays
+        :param n_events: int or None, if not None, only this number of randomly selected events is kept
+            (the same events in all records of the same length)
+        :param directory: str or None, if not None, records are appended to files in this directory
+            and read as memory-mapped arrays (max_records is not applied then).
+            Files are kept in a temporary subdirectory, which is removed by close() or when recorder is deleted
+        """
+        self.max_records = max_records
+        self.dtype = dtype
+        self.n_events = n_events
+        self.directory = directory
+        self.random_state = random_state
+        self._records = dict()
+        self._shapes = dict()
+        self._dtypes = dict()
+        self._event_indices = dict()
+        self._files_directory = None
+
+    def fresh(self):
+        """Returns new empty recorder with the same settings"""
+        return DebugRecorder(max_records=self.max_records, dtype=self.dtype, n_events=self.n_events,
+                             directory=self.directory, random_state=self.random_state)
+
+    @staticmethod
+    def create(keep_debug_info):
+        """Creates recorder from keep_debug_info parameter: True or DebugRecorder.
+        True corresponds to keeping all the records in original precision"""
+        if isinstance(keep_debug_info, DebugRecorder):
+            return keep_debug_info.fresh()
+        return DebugRecorder()
+
+    def _select_events(self, array):
+        if self.n_events is None or len(array) <= self.n_events:
+            return array
+        if len(array) not in self._event_indices:
+            random_state = check_random_state(self.random_state)
+            indices = random_state.choice(len(array), size=self.n_events, replace=False)
+            self._event_indices[len(array)] = numpy.sort(indices)
+        return array[self._event_indices[len(array)]]
+
+    def record(self, name, array):
+        """Saves a copy of array (or its part) under given name"""
+        array = self._select_events(numpy.asarray(array))
+        array = numpy.array(array, dtype=self.dtype or array.dtype)
+        if name not in self._records:
+            self._shapes[name] = array.shape
+            self._dtypes[name] = array.dtype
+            if self.directory is None:
+                self._records[name] = deque(maxlen=self.max_records)
+            else:
+                if self._files_directory is None:
+                    self._files_directory = tempfile.mkdtemp(dir=self.directory)
+                self._records[name] = os.path.join(self._files_directory, name + '.bin')
+        assert array.shape == self._shapes[name], 'records with the same name should have the same shape'
+        array = array.astype(self._dtypes[name], copy=False)
+        if self.directory is None:
+            self._records[name].append(array)
+        else:
+            with open(self._records[name], 'ab') as f:
+                f.write(array.tobytes())
+
+    def __getitem__(self, name):
+        # as in defaultdict(list), which was used before, there are no records for unknown names
+        if name not in self._records:
+            return []
+        if self.directory is None:
+            return list(self._records[name])
+        return numpy.memmap(self._records[name], dtype=self._dtypes[name], mode='r').reshape((-1,) + self._shapes[name])
+
+    def __contains__(self, name):
+        return name in self._records
+
+    def keys(self):
+        return list(self._records.keys())
+
+    def close(self):
+        """Removes all records and files created by recorder"""
+        if self._files_directory is not None:
+            shutil.rmtree(self._files_directory, ignore_errors=True)
+            self._files_directory = None
+        self._records.clear()
+        self._shapes.clear()
+        self._dtypes.clear()
+
+    def __del__(self):
+        self.close()
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def items(self):
+        return [(name, self[name]) for name in self.keys()]
+
+
+# endregion
+
+
+# region Training profiler
+
+class _NoPhase(object):
+    """Context manager which does nothing, returned by disabled profiler"""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_no_phase = _NoPhase()
+
+
+class _Phase(object):
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        if self.profiler.trace_memory:
+            self.memory = self.profiler._tracemalloc.get_traced_memory()[0]
+        self.start = timeit.default_timer()
+        return self
+
+    def __exit__(self, *args):
+        seconds = timeit.default_timer() - self.start
+        memory = None
+        if self.profiler.trace_memory:
+            memory = self.profiler._tracemalloc.get_traced_memory()[0] - self.memory
+        self.profiler._add(self.name, seconds, memory)
+        return False
+
+
+class TrainingProfiler(object):
+    def __init__(self, enabled=True, trace_memory=False):
+        """
+        Accumulates wall time of training phases (computing gradient, fitting tree, ...) for each stage of boosting.
+        Instance (or True) is passed as profile parameter to boosting classifiers,
+        after fitting the results are available as classifier.profiling_info (pandas.DataFrame,
+        one row per stage, one column per phase, phases done before the first stage go to stage -1).
+
+        >>> with profiler.phase('fit_tree'):
+        >>>     tree.fit(X, y)
+
+        :param bool enabled: if False, phase() returns context manager which does nothing
+        :param bool trace_memory: if True, the memory allocated (and not released) in each phase is also
+            computed with tracemalloc (in bytes, columns '<phase>_memory'), this slows down training
+        """
+        self.enabled = enabled
+        self.trace_memory = trace_memory
+        self.stage = -1
+        self._timings = OrderedDict()
+        self._tracemalloc = None
+        self._started_tracing = False
+
+    def fresh(self):
+        """Returns new profiler with the same settings"""
+        return TrainingProfiler(enabled=self.enabled, trace_memory=self.trace_memory)
+
+    @staticmethod
+    def create(profile):
+        """Creates profiler from profile parameter of classifier: bool or TrainingProfiler"""
+        if isinstance(profile, TrainingProfiler):
+            profiler = profile.fresh()
+        else:
+            profiler = TrainingProfiler(enabled=bool(profile))
+        if profiler.enabled and profiler.trace_memory:
+            import tracemalloc
+            profiler._tracemalloc = tracemalloc
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                profiler._started_tracing = True
+        return profiler
+
+    def start_stage(self, stage):
+        self.stage = stage
+
+    def phase(self, name):
+        """Returns context manager, which measures the time spent inside it"""
+        if not self.enabled:
+            return _no_phase
+        return _Phase(self, name)
+
+    def _add(self, name, seconds, memory):
+        stage_timings = self._timings.setdefault(self.stage, OrderedDict())
+        stage_timings[name] = stage_timings.get(name, 0.) + seconds
+        if memory is not None:
+            stage_timings[name + '_memory'] = stage_timings.get(name + '_memory', 0) + memory
+
+    def finish(self):
+        """Stops memory tracing (if it was started by profiler),
+        returns collected information as pandas.DataFrame or None if profiler is disabled"""
+        if self._started_tracing:
+            self._tracemalloc.stop()
+            self._started_tracing = False
+        if not self.enabled:
+            return None
+        return self.to_dataframe()
+
+    def to_dataframe(self):
+        result = pandas.DataFrame.from_dict(self._timings, orient='index').fillna(0.)
+        result.index.name = 'stage'
+        return result
+
+
+# endregion
+
+
 def smear_dataset(testX, smeared_variables=None, smearing_factor=0.1):
     """For the selected features 'smears' them in dataset,
     pay attention, that only float feature can be smeared by now.
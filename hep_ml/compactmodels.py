@@ -0,0 +1,148 @@
+"""
+Compact format to store trained tree ensembles for deployment.
+
+Only split features, thresholds, tree structure and leaf values are saved (in .npz file),
+the loaded model can only make predictions, but is loaded fast and takes little memory.
+
+Supported models: ``uGradientBoostingClassifier`` (without init_estimator)
+and ``uBoostClassifier`` (with tree base estimators).
+
+>>> export_model(classifier, 'model.npz')
+>>> model = load_model('model.npz')
+>>> proba = model.predict_proba(X)
+"""
+from __future__ import division, print_function, absolute_import
+
+import numpy
+import pandas
+from sklearn.tree.tree import DTYPE
+
+from .commonutils import sigmoid_function
+from .ugradientboosting import uGradientBoostingClassifier, PackedTrees, score_to_proba
+from .uboost import uBoostClassifier
+
+__author__ = 'Alex Rogozhnikov'
+
+
+def _uboost_leaf_values(bdt, estimator, estimator_weight):
+    """Contributions of leaves of single classification tree to the score of uBoostBDT"""
+    proba = estimator.tree_.value[:, 0, :]
+    assert proba.shape[1] == 2, 'Trees should be trained on two classes'
+    if bdt.algorithm == 'SAMME':
+        leaf_values = 2. * numpy.argmax(proba, axis=1) - 1.
+    else:
+        normalizer = proba.sum(axis=1)[:, numpy.newaxis]
+        normalizer[normalizer == 0.] = 1.
+        proba = proba / normalizer
+        proba[proba <= 1e-5] = 1e-5
+        leaf_values = numpy.log(proba[:, 1] / proba[:, 0])
+    return leaf_values * estimator_weight
+
+
+def export_model(classifier, filename):
+    """Saves the trained classifier in compact format
+    :type classifier: uGradientBoostingClassifier | uBoostClassifier
+    :param str filename: name of .npz file
+    """
+    if isinstance(classifier, uGradientBoostingClassifier):
+        assert classifier.init_estimator is None, 'init_estimator can not be exported'
+        trees = PackedTrees([tree.tree_ for tree in classifier.estimators])
+        parameters = {'model_type': 'ugb',
+                      'learning_rate': classifier.learning_rate}
+    elif isinstance(classifier, uBoostClassifier):
+        estimators = []
+        leaf_values = []
+        limits = [0]
+        score_cuts = []
+        for bdt in classifier.classifiers:
+            for estimator, weight in zip(bdt.estimators_, bdt.estimator_weights_):
+                assert hasattr(estimator, 'tree_'), 'only tree base estimators can be exported'
+                estimators.append(estimator.tree_)
+                leaf_values.append(_uboost_leaf_values(bdt, estimator, weight))
+            limits.append(len(estimators))
+            score_cuts.append(bdt.score_cut)
+        trees = PackedTrees(estimators, leaf_values=leaf_values)
+        parameters = {'model_type': 'uboost',
+                      'ensemble_limits': numpy.array(limits),
+                      'score_cuts': numpy.array(score_cuts),
+                      'smoothing': classifier.smoothing}
+    else:
+        raise ValueError('Export of {} is not supported'.format(type(classifier)))
+
+    train_variables = classifier.train_variables
+    parameters['has_train_variables'] = train_variables is not None
+    # names are stored with their dtype, so both string and integer names of columns are restored
+    names = [] if train_variables is None else list(train_variables)
+    parameters['train_variables'] = numpy.array(names)
+    if parameters['train_variables'].tolist() != names:
+        raise ValueError('train_variables can not be exported, names should be all strings or all integers')
+    parameters.update(trees.to_arrays())
+    numpy.savez(filename, **parameters)
+
+
+def load_model(filename):
+    """Loads model saved by export_model
+    :rtype: CompactClassifier
+    """
+    with numpy.load(filename) as data:
+        return CompactClassifier(dict(data.items()))
+
+
+class CompactClassifier(object):
+    # maximal number of (event, tree) pairs evaluated at once
+    max_batch_elements = 10 ** 7
+
+    def __init__(self, parameters):
+        """Predict-only classifier, use load_model to create it"""
+        self.model_type = str(parameters['model_type'])
+        self.trees = PackedTrees.from_arrays(parameters)
+        self.train_variables = None
+        if parameters['has_train_variables']:
+            self.train_variables = parameters['train_variables'].tolist()
+        if self.model_type == 'ugb':
+            self.learning_rate = float(parameters['learning_rate'])
+        elif self.model_type == 'uboost':
+            self.ensemble_limits = parameters['ensemble_limits']
+            self.score_cuts = parameters['score_cuts']
+            self.smoothing = float(parameters['smoothing'])
+        else:
+            raise ValueError('Unknown type of model: ' + self.model_type)
+
+    def _compute_scores(self, X):
+        """For uGB returns [n_samples, 1] with score, for uBoost returns [n_samples, n_bdts] with scores of BDTs"""
+        if self.train_variables is not None:
+            X = pandas.DataFrame(X).loc[:, self.train_variables]
+        X = numpy.asarray(X, dtype=DTYPE)
+        n_columns = 1 if self.model_type == 'ugb' else len(self.score_cuts)
+        result = numpy.zeros([len(X), n_columns])
+        chunk_size = max(1, self.max_batch_elements // max(self.trees.n_trees, 1))
+        for start in range(0, len(X), chunk_size):
+            rows = slice(start, start + chunk_size)
+            tree_predictions = self.trees.predict_trees(X[rows])
+            if self.model_type == 'ugb':
+                # summing in the same order as in uGradientBoostingClassifier
+                for column in tree_predictions.T:
+                    result[rows, 0] += self.learning_rate * column
+            else:
+                for i, (begin, end) in enumerate(zip(self.ensemble_limits[:-1], self.ensemble_limits[1:])):
+                    for column in tree_predictions[:, begin:end].T:
+                        result[rows, i] += column
+        return result
+
+    def predict_score(self, X):
+        if self.model_type == 'ugb':
+            return self._compute_scores(X)[:, 0]
+        scores = self._compute_scores(X)
+        return numpy.sum(sigmoid_function(scores - self.score_cuts, self.smoothing), axis=1)
+
+    def predict_proba(self, X):
+        score = self.predict_score(X)
+        if self.model_type == 'ugb':
+            return score_to_proba(score)
+        result = numpy.zeros([len(score), 2])
+        result[:, 1] = score / len(self.score_cuts)
+        result[:, 0] = 1. - result[:, 1]
+        return result
+
+    def predict(self, X):
+        return numpy.argmax(self.predict_proba(X), axis=1)
@@ -20,6 +20,11 @@ __author__ = 'Alex Rogozhnikov'
 
 
 class CategoricalTreeRegressor(fasttree.FastTreeRegressor):
+    supports_feature_orders = False
+    supports_histograms = False
+    # events go to right subtree if directions[(multiplier * X[:, feature]) & mask] is True
+    split_fields = ['feature', 'multiplier', 'mask', 'directions']
+
     def __init__(self,
                  max_depth=5,
                  max_features=None,
@@ -35,11 +40,10 @@ class CategoricalTreeRegressor(fasttree.FastTreeRegressor):
                                             random_state=random_state)
         self.n_categories_power = n_categories_power
 
-    def _fit_tree_node(self, X, y, w, node_index, depth, passed_indices):
-        """Recursive function to fit tree"""
+    def _fit_tree_node(self, X, y, w, depth, passed_indices):
+        """Recursive function to fit tree, returns index of created node"""
         if len(passed_indices) <= self.min_samples_split or depth >= self.max_depth:
-            self.nodes_data[node_index] = (numpy.average(y[passed_indices], weights=w[passed_indices]), )
-            return
+            return self._add_leaf(numpy.average(y[passed_indices], weights=w[passed_indices]))
 
         multiplier = numpy.random.choice([1, 3, 5, 7, 11, 13, 17, 23])
         n_categories = 2 ** self.n_categories_power
@@ -74,33 +78,34 @@ class CategoricalTreeRegressor(fasttree.FastTreeRegressor):
         # computing information for (possible) children
         passed_left_subtree = passed_indices[~passed]
         passed_right_subtree = passed_indices[passed]
-        left, right = self._children(node_index)
         if len(passed_left_subtree) == 0 or len(passed_right_subtree) == 0:
             # this will be leaf
-            self.nodes_data[node_index] = (numpy.average(y[passed_indices], weights=w[passed_indices]), )
-        else:
-            # non-leaf, recurrent calls
-            self.nodes_data[node_index] = (feature_index, multiplier, mask, directions)
-            self._fit_tree_node(X, y, w, left, depth + 1, passed_left_subtree)
-            self._fit_tree_node(X, y, w, right, depth + 1, passed_right_subtree)
-
-    def _apply_node(self, X, leaf_indices, predictions, node_index, passed_indices):
+            return self._add_leaf(numpy.average(y[passed_indices], weights=w[passed_indices]))
+        # non-leaf, recurrent calls
+        node = self._add_split(feature=feature_index, multiplier=multiplier, mask=mask, directions=directions)
+        left = self._fit_tree_node(X, y, w, depth + 1, passed_left_subtree)
+        right = self._fit_tree_node(X, y, w, depth + 1, passed_right_subtree)
+        self._set_children(node, left, right)
+        return node
+
+    def _apply_node(self, X, leaf_indices, node, passed_indices):
         """Recursive function to compute the index """
-        node_data = self.nodes_data[node_index]
-        if len(node_data) == 1:
-            # leaf node
-            leaf_indices[passed_indices] = node_index
-            predictions[passed_indices] = node_data[0]
+        if self._is_leaf(node):
+            leaf_indices[passed_indices] = node
         else:
-            # non-leaf
-            feature_index, multiplier, mask, directions = node_data
-            clipped_category = (multiplier * X[passed_indices, feature_index]) & mask
-            passed = numpy.take(directions, clipped_category)
+            clipped_category = (self.multiplier[node] * X[passed_indices, self.feature[node]]) & self.mask[node]
+            passed = numpy.take(self.directions[node], clipped_category)
             passed_left_subtree = passed_indices[~passed]
             passed_right_subtree = passed_indices[passed]
-            left, right = self._children(node_index)
-            self._apply_node(X, leaf_indices, predictions, left, passed_left_subtree)
-            self._apply_node(X, leaf_indices, predictions, right, passed_right_subtree)
+            self._apply_node(X, leaf_indices, self.children_left[node], passed_left_subtree)
+            self._apply_node(X, leaf_indices, self.children_right[node], passed_right_subtree)
+
+    def _split_to_right(self, flat_X, offsets, nodes):
+        # tables of directions are gathered for each event
+        values = flat_X.take(offsets + self.feature.take(nodes))
+        clipped_category = (self.multiplier.take(nodes) * values) & self.mask.take(nodes)
+        n_categories = self.directions.shape[1]
+        return numpy.ravel(self.directions).take(nodes * n_categories + clipped_category)
 
 
 class SimpleCategoricalRegressor(BaseEstimator, RegressorMixin):
@@ -1,5 +1,6 @@
 from __future__ import division, print_function, absolute_import
 import copy
+import timeit
 import numpy
 import pandas
 from sklearn.cross_validation import StratifiedKFold, train_test_split
@@ -7,14 +8,14 @@ from sklearn.tree.tree import DTYPE
 from sklearn.utils.validation import check_random_state, column_or_1d, check_arrays
 from sklearn.base import clone, BaseEstimator, ClassifierMixin
 
-from ..commonutils import check_sample_weight, sigmoid_function
+from ..commonutils import check_sample_weight, sigmoid_function, TrainingProfiler
+from ..histogramtree import BinQuantizer
 from hep_ml.losses import AdaLossFunction
 from ..losses import AbstractLossFunction
 
-from .fasttree import FastTreeRegressor, FastNeuroTreeRegressor
+from .fasttree import FastTreeRegressor, FastNeuroTreeRegressor, compute_feature_orders
 from scipy.special import logit
 from multiprocessing.pool import ThreadPool
-from threading import Lock
 
 
 __author__ = 'Alex Rogozhnikov'
@@ -22,41 +23,90 @@ __author__ = 'Alex Rogozhnikov'
 # TODO where to include sample_weight - in the loss, or in the tree.fit, introduce special parameter
 
 
-def _train_one_classifier(train_params):
+class StageCallback(object):
     """
-    Supplementary function to train one classifier, used in parallel versions of boosting.
+    Base class for callbacks of AbstractGradientBoostingClassifier.fit,
+    methods are called by stage driver of boosting, descendants redefine the ones they need.
     """
-    self, X, y, sample_weight, y_pred, lock = train_params
+    def on_train_begin(self, classifier):
+        pass
 
-    # estimator creation
-    estimator = self._create_estimator(len(self.estimators))
+    def on_stage_end(self, classifier, stage, estimator, y_pred):
+        """
+        Called after each stage
+        :param estimator: estimator trained on this stage (already added to classifier.estimators)
+        :param y_pred: current predictions on training data, shouldn't be modified
+        :return: True if training should be stopped
+        """
+        return False
 
-    # estimator learning
-    residual = self.loss.negative_gradient(y_pred)
-    train_mask = self._generate_mask(len(X), subsample=self.subsample)
-    self._fit_estimator(estimator, X, y, sample_weight, residual, mask=train_mask)
+    def on_train_end(self, classifier):
+        pass
 
-    # update estimator
-    update_mask = numpy.ones(len(y), dtype=bool)
-    self._update_estimator(estimator, X, y, sample_weight, residual, y_pred, mask=update_mask)
 
-    # updating training state
-    stage_pred = self.learning_rate * estimator.predict(X)
-    with lock:
-        y_pred += stage_pred
-        self.estimators.append(estimator)
-    self.scores.append(self.loss(y_pred))
+class StageTimer(StageCallback):
+    """Saves time spent on each stage (in seconds) to self.times"""
+    def on_train_begin(self, classifier):
+        self.times = []
+        self._last_time = timeit.default_timer()
 
+    def on_stage_end(self, classifier, stage, estimator, y_pred):
+        now = timeit.default_timer()
+        self.times.append(now - self._last_time)
+        self._last_time = now
+        return False
 
-def _train_kfold_classifier(train_params):
-    self, X, y, sample_weight, y_pred, residual, train_indices, test_indices, lock = train_params
 
-    # splitting train on real train and update
-    if self.subsample < 0.5:
-        train_train_indices, train_update_indices = train_test_split(train_indices, train_size=self.subsample)
-    else:
-        train_train_indices = train_indices[self._generate_mask(len(train_indices), subsample=self.subsample)]
-        train_update_indices = train_indices
+class ValidationMonitor(StageCallback):
+    def __init__(self, X, y, sample_weight=None, metric=None, early_stopping_rounds=None):
+        """
+        Computes score on validation data after each stage (predictions are updated incrementally)
+        and saves these to self.scores.
+        :param metric: AbstractMetric from hep_ml.metrics to be minimized, if None, loss of classifier is used
+            (flatness losses don't compute their value, so metric is required with them)
+        :param int early_stopping_rounds: if not None, training stops when score didn't improve
+            during this number of stages, estimators after the best stage are dropped
+        """
+        self.X = X
+        self.y = y
+        self.sample_weight = sample_weight
+        self.metric = metric
+        self.early_stopping_rounds = early_stopping_rounds
+
+    def on_train_begin(self, classifier):
+        X, y, sample_weight = classifier._initial_data_check(self.X, self.y, self.sample_weight)
+        if self.metric is None:
+            assert classifier.loss.computes_value, \
+                '{} does not compute its value, metric is needed'.format(type(classifier.loss).__name__)
+            loss = copy.copy(classifier.loss)
+            loss.fit(X, y, sample_weight=sample_weight)
+            self._score_function = loss
+        else:
+            metric = copy.copy(self.metric)
+            metric.fit(X, y, sample_weight=sample_weight)
+            self._score_function = lambda score: metric(y, classifier.score_to_proba(score), sample_weight)
+        self._X = classifier.get_train_vars(X)
+        self._pred = classifier._compute_initial_predictions(self._X)
+        self.scores = []
+        self.best_stage = None
+
+    def on_stage_end(self, classifier, stage, estimator, y_pred):
+        self._pred += classifier.learning_rate * estimator.predict(self._X)
+        self.scores.append(self._score_function(self._pred))
+        if self.best_stage is None or self.scores[-1] < self.scores[self.best_stage]:
+            self.best_stage = stage
+        return self.early_stopping_rounds is not None and stage - self.best_stage >= self.early_stopping_rounds
+
+    def on_train_end(self, classifier):
+        if self.early_stopping_rounds is not None and self.best_stage is not None:
+            del classifier.estimators[self.best_stage + 1:]
+            del classifier.scores[self.best_stage + 1:]
+        del self._X, self._pred, self._score_function
+
+
+def _train_kfold_classifier(train_params):
+    self, X, y, sample_weight, y_pred, residual, train_train_indices, train_update_indices, test_indices = \
+        train_params
 
     # estimator creation
     estimator = self._create_estimator(len(self.estimators))
@@ -82,11 +132,14 @@ class AbstractGradientBoostingClassifier(BaseEstimator, ClassifierMixin):
                  train_variables=None,
                  random_state=None,
                  n_threads=1,
-                 dtype=DTYPE):
+                 dtype=DTYPE,
+                 profile=False):
         """This version of gradient boosting supports only two-class classification and only special losses
         derived from AbstractLossFunction.
         There are some methods that should be overriden in descendants.
         :type loss: AbstractLossFunction, by default AdaLossFunction is used
+        :param profile: bool or TrainingProfiler, if True, time spent in phases of each stage
+            is measured and saved to self.profiling_info (pandas.DataFrame)
         """
         self.loss = loss
         self.n_estimators = n_estimators
@@ -97,6 +150,7 @@ class AbstractGradientBoostingClassifier(BaseEstimator, ClassifierMixin):
         self.initial_prediction = 0.
         self.dtype = dtype
         self.n_threads = n_threads
+        self.profile = profile
 
     def _check_params(self):
         if self.loss is None:
@@ -134,6 +188,13 @@ class AbstractGradientBoostingClassifier(BaseEstimator, ClassifierMixin):
         assert numpy.all(numpy.in1d(y, [0, 1])), 'Only two-class classification supported'
         return X, y, sample_weight
 
+    def _prepare_training_data(self, X):
+        """Computes data shared by all stages of fit (not kept after fit)"""
+        pass
+
+    def _clear_training_data(self):
+        pass
+
     def _prepare_initial_predictions(self, X, y, sample_weight):
         self.initial_prediction = logit(numpy.average(y, weights=sample_weight))
 
@@ -147,9 +208,14 @@ class AbstractGradientBoostingClassifier(BaseEstimator, ClassifierMixin):
             n_sampled_events = int(subsample * length)
             return self.random_state.choice(length, n_sampled_events, replace=True)
 
-    def fit(self, X, y, sample_weight=None):
+    def fit(self, X, y, sample_weight=None, callbacks=None):
+        """
+        :param callbacks: list of StageCallback (for instance, StageTimer, ValidationMonitor),
+            which are called after each stage and can stop training
+        """
         X, y, sample_weight = self._initial_data_check(X, y, sample_weight)
         self._check_params()
+        callbacks = [] if callbacks is None else list(callbacks)
 
         loss_weight = numpy.ones(len(sample_weight))
         tree_weight = sample_weight
@@ -158,8 +224,10 @@ class AbstractGradientBoostingClassifier(BaseEstimator, ClassifierMixin):
             loss_weight, tree_weight = tree_weight, loss_weight
 
 
+        self._profiler = TrainingProfiler.create(self.profile)
         self.loss = copy.copy(self.loss)
-        self.loss.fit(X, y, sample_weight=loss_weight)
+        with self._profiler.phase('fit_loss'):
+            self.loss.fit(X, y, sample_weight=loss_weight)
 
         X, y, sample_weight = self._prepare_data_for_fitting(X, y, sample_weight)
 
@@ -168,15 +236,51 @@ class AbstractGradientBoostingClassifier(BaseEstimator, ClassifierMixin):
         self.estimators = []
         self.scores = []
 
-        # pool = ThreadPool(processes=self.n_threads)
+        try:
+            self._prepare_training_data(X)
+            for callback in callbacks:
+                callback.on_train_begin(self)
+            for stage in range(self.n_estimators):
+                self._profiler.start_stage(stage)
+                estimator = self._fit_stage(X, y, tree_weight, y_pred)
+                # all callbacks are called even if one of them requests to stop
+                stop_requests = [callback.on_stage_end(self, stage, estimator, y_pred) for callback in callbacks]
+                if any(stop_requests):
+                    break
+            for callback in callbacks:
+                callback.on_train_end(self)
+            self.profiling_info = self._profiler.finish()
+        finally:
+            self._clear_training_data()
+            del self._profiler
+        return self
 
-        lock = Lock()
-        train_params = [self, X, y, tree_weight, y_pred, lock]
-        # TODO use threading
-        # pool.map(_train_one_classifier, [train_params] * self.n_estimators, chunksize=1)
-        map(_train_one_classifier, [train_params] * self.n_estimators)
+    def _fit_stage(self, X, y, sample_weight, y_pred):
+        """Trains one estimator, adds it to ensemble and updates y_pred in place, returns trained estimator"""
+        profiler = self._profiler
+        estimator = self._create_estimator(len(self.estimators))
 
-        return self
+        # estimator learning
+        with profiler.phase('gradient'):
+            residual = self.loss.negative_gradient(y_pred)
+        with profiler.phase('fit_tree'):
+            train_mask = self._generate_mask(len(X), subsample=self.subsample)
+            self._fit_estimator(estimator, X, y, sample_weight, residual, mask=train_mask)
+
+        # update estimator
+        with profiler.phase('update_tree'):
+            update_mask = numpy.ones(len(y), dtype=bool)
+            self._update_estimator(estimator, X, y, sample_weight, residual, y_pred, mask=update_mask)
+
+        # updating training state
+        with profiler.phase('predict'):
+            stage_pred = numpy.asarray(estimator.predict(X), dtype=float)
+            stage_pred *= self.learning_rate
+            y_pred += stage_pred
+        self.estimators.append(estimator)
+        with profiler.phase('loss'):
+            self.scores.append(self.loss(y_pred))
+        return estimator
 
     def get_train_vars(self, X):
         if self.train_variables is None:
@@ -229,7 +333,8 @@ class CommonGradientBoosting(AbstractGradientBoostingClassifier):
                  train_variables=None,
                  dtype='float',
                  n_threads=1,
-                 random_state=None):
+                 random_state=None,
+                 profile=False):
         self.base_estimator = base_estimator
         AbstractGradientBoostingClassifier.__init__(self, loss=loss,
                                                     n_estimators=n_estimators,
@@ -238,7 +343,8 @@ class CommonGradientBoosting(AbstractGradientBoostingClassifier):
                                                     train_variables=train_variables,
                                                     random_state=random_state,
                                                     n_threads=n_threads,
-                                                    dtype=dtype)
+                                                    dtype=dtype,
+                                                    profile=profile)
 
     def _create_estimator(self, stage):
         return clone(self.base_estimator)
@@ -254,7 +360,8 @@ class FoldingGBClassifier(CommonGradientBoosting):
                  train_variables=None,
                  n_threads=1,
                  update_tree=False,
-                 random_state=None):
+                 random_state=None,
+                 profile=False):
         """
         :param loss: loss function used
         :param base_estimator: BaseEstimator
@@ -262,8 +369,9 @@ class FoldingGBClassifier(CommonGradientBoosting):
         :param n_estimators:
         :param subsample: used in fitting classifiers
         :param train_variables:
-        :param n_threads:
+        :param n_threads: number of threads, models of different folds are trained in parallel
         :param update_tree: bool,
+        :param profile: bool or TrainingProfiler, see AbstractGradientBoostingClassifier
         """
         self.n_folds = n_folds
         self.update_tree = update_tree
@@ -274,14 +382,17 @@ class FoldingGBClassifier(CommonGradientBoosting):
                                         subsample=subsample,
                                         train_variables=train_variables,
                                         n_threads=n_threads,
-                                        random_state=random_state)
+                                        random_state=random_state,
+                                        profile=profile)
 
     def fit(self, X, y, sample_weight=None):
         X, y, sample_weight = self._initial_data_check(X, y, sample_weight=sample_weight)
         self._check_params()
+        profiler = TrainingProfiler.create(self.profile)
 
         self.loss = copy.copy(self.loss)
-        self.loss.fit(X, y, sample_weight=sample_weight)
+        with profiler.phase('fit_loss'):
+            self.loss.fit(X, y, sample_weight=sample_weight)
 
         X, y, sample_weight = self._prepare_data_for_fitting(X, y, sample_weight)
 
@@ -289,30 +400,50 @@ class FoldingGBClassifier(CommonGradientBoosting):
         self.estimators = []
         self.scores = []
 
-        pool = ThreadPool(processes=self.n_threads)
-        lock = Lock()
-
-        for stage in range(self.n_estimators):
-            stage_estimators = []
-
-            train_params = []
-            residual = self.loss.negative_gradient(y_pred)
-            for fold, (train_indices, test_indices) in enumerate(
-                    StratifiedKFold(y, n_folds=self.n_folds, shuffle=True, random_state=stage)):
-                train_params.append([self, X, y, sample_weight, y_pred,
-                                     residual, train_indices, test_indices, lock])
-            # TODO use multithreading
-            # result = pool.map(_train_kfold_classifier, train_params, chunksize=1)
-            result = map(_train_kfold_classifier, train_params)
-            for estimator, test_indices, test_prediction in result:
-                stage_estimators.append(estimator)
-                y_pred[test_indices] += self.learning_rate * test_prediction
-
-            self.estimators.append(stage_estimators)
-            self.scores.append(self.loss(y_pred))
-
+        # models of different folds are trained in parallel
+        pool = ThreadPool(processes=self.n_threads) if self.n_threads > 1 else None
+
+        try:
+            for stage in range(self.n_estimators):
+                profiler.start_stage(stage)
+                stage_estimators = []
+
+                train_params = []
+                with profiler.phase('gradient'):
+                    residual = self.loss.negative_gradient(y_pred)
+                for fold, (train_indices, test_indices) in enumerate(
+                        StratifiedKFold(y, n_folds=self.n_folds, shuffle=True, random_state=stage)):
+                    # random splits are done here, so folds trained in threads don't share random state
+                    train_train_indices, train_update_indices = self._split_train_indices(train_indices)
+                    train_params.append([self, X, y, sample_weight, y_pred, residual,
+                                         train_train_indices, train_update_indices, test_indices])
+                with profiler.phase('fit_folds'):
+                    if pool is None:
+                        result = [_train_kfold_classifier(params) for params in train_params]
+                    else:
+                        result = pool.map(_train_kfold_classifier, train_params, chunksize=1)
+                    # folds are added in the same order independently of threads
+                    for estimator, test_indices, test_prediction in result:
+                        stage_estimators.append(estimator)
+                        y_pred[test_indices] += self.learning_rate * test_prediction
+
+                self.estimators.append(stage_estimators)
+                with profiler.phase('loss'):
+                    self.scores.append(self.loss(y_pred))
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+        self.profiling_info = profiler.finish()
         return self
 
+    def _split_train_indices(self, train_indices):
+        """Splits train part of fold on events used to train estimator and events used to update it"""
+        if self.subsample < 0.5:
+            return train_test_split(train_indices, train_size=self.subsample, random_state=self.random_state)
+        train_train_indices = train_indices[self._generate_mask(len(train_indices), subsample=self.subsample)]
+        return train_train_indices, train_indices
+
     def staged_predict_score(self, X):
         """ Uses mean predictions, TODO use same folding """
         X = self.get_train_vars(X)
@@ -339,12 +470,20 @@ class TreeGradientBoostingClassifier(CommonGradientBoosting):
                  train_variables=None,
                  n_threads=1,
                  dtype=DTYPE,
-                 random_state=None):
+                 random_state=None,
+                 profile=False,
+                 max_bins=None):
         '''
         :param base_estimator: descendant of FastTreeRegressor
         :param update_tree: if True, will update values in leaves to minimize loss function
+        :param int n_threads: number of threads used by each tree (overrides n_threads of base_estimator)
+        :param profile: bool or TrainingProfiler, see AbstractGradientBoostingClassifier
+        :param int max_bins: if not None, features are quantized once into at most max_bins (<= 256) bins
+            shared by all trees, trees find splits from histograms over bins
+            (base_estimator should support histograms)
         '''
         self.update_tree = update_tree
+        self.max_bins = max_bins
         CommonGradientBoosting.__init__(self, loss=loss, base_estimator=base_estimator,
                                         n_estimators=n_estimators,
                                         learning_rate=learning_rate,
@@ -352,10 +491,46 @@ class TreeGradientBoostingClassifier(CommonGradientBoosting):
                                         dtype=dtype,
                                         n_threads=n_threads,
                                         subsample=subsample,
-                                        random_state=random_state)
+                                        random_state=random_state,
+                                        profile=profile)
+
+    def _create_estimator(self, stage):
+        estimator = CommonGradientBoosting._create_estimator(self, stage)
+        # threads are used inside trees, since stages are trained sequentially
+        if 'n_threads' in estimator.get_params():
+            estimator.set_params(n_threads=self.n_threads)
+        return estimator
+
+    def _prepare_training_data(self, X):
+        # binned data and orders are computed only for fit and not kept after it
+        self._feature_orders = None
+        self._X_binned = None
+        self._bin_edges = None
+        if self.max_bins is not None:
+            assert getattr(self.base_estimator, 'supports_histograms', False), \
+                'base_estimator does not support binned data'
+            # features are quantized only once, the same bins are used by all trees
+            quantizer = BinQuantizer(max_bins=self.max_bins, random_state=self.random_state).fit(X)
+            self._X_binned = quantizer.transform(X)
+            self._bin_edges = quantizer.bin_edges
+        elif getattr(self.base_estimator, 'supports_feature_orders', False):
+            # features are sorted only once, trees use these orders instead of sorting data in each node
+            self._feature_orders = compute_feature_orders(X)
+
+    def _clear_training_data(self):
+        self._feature_orders = None
+        self._X_binned = None
+        self._bin_edges = None
 
     def _fit_estimator(self, estimator, X, y, sample_weight, residual, mask):
-        estimator.fit(X, residual, sample_weight=sample_weight, check_input=False)
+        if self._X_binned is not None:
+            estimator.fit(self._X_binned, residual, sample_weight=sample_weight, check_input=False,
+                          bin_edges=self._bin_edges)
+        elif self._feature_orders is None:
+            estimator.fit(X, residual, sample_weight=sample_weight, check_input=False)
+        else:
+            estimator.fit(X, residual, sample_weight=sample_weight, check_input=False,
+                          feature_orders=self._feature_orders)
 
     def _update_estimator(self, estimator, X, y, sample_weight, residual, y_pred, mask):
         if self.update_tree:
@@ -6,10 +6,10 @@ I need numpy implementation mostly for further experiments, rather than for real
 This tree shouldn't be used by itself, only in boosting techniques
 """
 from __future__ import division, print_function, absolute_import
-from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 import numpy
 from sklearn.base import BaseEstimator, RegressorMixin
-from sklearn.linear_model import LogisticRegression, SGDClassifier, LinearRegression
+from sklearn.linear_model import LogisticRegression, SGDClassifier
 from sklearn.utils.validation import check_random_state
 
 
@@ -17,11 +17,21 @@ __author__ = 'Alex Rogozhnikov'
 
 
 # Criterion is minimized in tree
+# compute_best_splits of each criterion takes optional orders - [n_samples, n_features] array with argsort of data
+# (if these are already known), otherwise data is sorted by criterion.
+# Criteria with compute_statistics and compute_costs_from_sums can be used in level-wise building of trees
+# and with binned data: costs of splits are computed from sums of statistics of events in left and right parts.
+
+def _check_orders(data, orders):
+    if orders is None:
+        return numpy.argsort(data, axis=0)
+    return orders
+
 
 class MseCriterion(object):
     @staticmethod
-    def compute_best_splits(data, y, sample_weight):
-        orders = numpy.argsort(data, axis=0)
+    def compute_best_splits(data, y, sample_weight, orders=None):
+        orders = _check_orders(data, orders)
         answers = y[orders]
         weights = sample_weight[orders]
         left_sum, right_sum = _compute_cumulative_sums(answers * weights)
@@ -31,11 +41,19 @@ class MseCriterion(object):
         costs = - (left_sum ** 2 / left_weights + right_sum ** 2 / right_weights)
         return _compute_cuts_costs_positions(costs, data=data, orders=orders)
 
+    @staticmethod
+    def compute_statistics(y, sample_weight):
+        return numpy.array([y * sample_weight, sample_weight + 1e-20])
+
+    @staticmethod
+    def compute_costs_from_sums(left, right):
+        return - (left[0] ** 2 / left[1] + right[0] ** 2 / right[1])
+
 
 class FriedmanMseCriterion(object):
     @staticmethod
-    def compute_best_splits(data, y, sample_weight):
-        orders = numpy.argsort(data, axis=0)
+    def compute_best_splits(data, y, sample_weight, orders=None):
+        orders = _check_orders(data, orders)
         answers = y[orders]
         weights = sample_weight[orders]
         left_sum, right_sum = _compute_cumulative_sums(answers * weights)
@@ -45,14 +63,23 @@ class FriedmanMseCriterion(object):
         costs = - left_weights * right_weights * (diff ** 2)
         return _compute_cuts_costs_positions(costs, data=data, orders=orders)
 
+    @staticmethod
+    def compute_statistics(y, sample_weight):
+        return numpy.array([y * sample_weight, sample_weight + 1e-50])
+
+    @staticmethod
+    def compute_costs_from_sums(left, right):
+        diff = left[0] / left[1] - right[0] / right[1]
+        return - left[1] * right[1] * (diff ** 2)
+
 
 class PValueCriterion(object):
     @staticmethod
-    def compute_best_splits(data, y, sample_weight):
+    def compute_best_splits(data, y, sample_weight, orders=None):
         y_order = numpy.argsort(numpy.argsort(y))
         # converting to [-1, 1]
         y_order = numpy.linspace(-1, 1, len(y_order))[y_order]
-        orders = numpy.argsort(data, axis=0)
+        orders = _check_orders(data, orders)
         # answers = y[orders]
         pred_orders = y_order[orders]
         weights = sample_weight[orders]
@@ -65,6 +92,20 @@ class PValueCriterion(object):
         costs /= numpy.sqrt((left_weights + regularization) * (right_weights + regularization))
         return _compute_cuts_costs_positions(costs, data=data, orders=orders)
 
+    @staticmethod
+    def compute_statistics(y, sample_weight):
+        # ranks are computed over all events passed (not over events in node)
+        y_order = numpy.linspace(-1, 1, len(y))[numpy.argsort(numpy.argsort(y))]
+        return numpy.array([y_order * sample_weight, sample_weight + 1e-50])
+
+    @staticmethod
+    def compute_costs_from_sums(left, right):
+        total_weight = left[1] + right[1]
+        # ranks are centered inside node
+        left_sum = left[0] - left[1] * (left[0] + right[0]) / total_weight
+        regularization = 0.01 * total_weight
+        return - numpy.abs(left_sum) / numpy.sqrt((left[1] + regularization) * (right[1] + regularization))
+
 
 class AbstractClassificationCriterion(object):
     @staticmethod
@@ -72,8 +113,8 @@ class AbstractClassificationCriterion(object):
         raise NotImplementedError('Should be overloaded')
 
     @classmethod
-    def compute_best_splits(cls, data, y, sample_weight):
-        orders = numpy.argsort(data, axis=0)
+    def compute_best_splits(cls, data, y, sample_weight, orders=None):
+        orders = _check_orders(data, orders)
         answers = y[orders]
         weights = sample_weight[orders]
         pos_answers = answers * (answers > 0)
@@ -84,6 +125,14 @@ class AbstractClassificationCriterion(object):
         costs = cls.compute_costs(left_pos_sum, right_pos_sum, left_neg_sum, right_neg_sum)
         return _compute_cuts_costs_positions(costs, data=data, orders=orders)
 
+    @staticmethod
+    def compute_statistics(y, sample_weight):
+        return numpy.array([y * (y > 0) * sample_weight, - y * (y < 0) * sample_weight])
+
+    @classmethod
+    def compute_costs_from_sums(cls, left, right):
+        return cls.compute_costs(left[0], right[0], left[1], right[1])
+
 
 class GiniCriterion(AbstractClassificationCriterion):
     @staticmethod
@@ -156,6 +205,48 @@ def _compute_cuts_costs_positions(costs, data, orders):
     return optimal_cuts, optimal_costs, optimal_sorted_positions
 
 
+def compute_feature_orders(X):
+    """Returns array [n_features, n_samples], i-th row contains indices of events sorted by i-th feature.
+    Computed once, it can be passed to FastTreeRegressor.fit for all trees trained on X"""
+    return numpy.argsort(numpy.transpose(X), axis=1, kind='mergesort')
+
+
+def _stable_select(orders, mask):
+    """Keeps in each row of orders ([n_features, n_events]) only events with mask (global boolean array),
+    the events in rows remain sorted"""
+    return orders[mask[orders]].reshape([len(orders), -1])
+
+
+def compute_histograms(X_binned, statistics, indices, n_bins):
+    """Computes histograms of statistics of events (and counts of events, the last row) over bins of features.
+    :param X_binned: [n_samples, n_features] uint8 array of bins
+    :param statistics: [n_statistics, n_samples], as returned by criterion.compute_statistics
+    :param indices: events used
+    :return: array [n_statistics + 1, n_features, n_bins]
+    """
+    n_features = X_binned.shape[1]
+    codes = (X_binned[indices] + numpy.arange(n_features) * n_bins).ravel()
+    length = n_features * n_bins
+    result = numpy.zeros([len(statistics) + 1, length])
+    for i, statistic in enumerate(statistics):
+        result[i] = numpy.bincount(codes, weights=numpy.repeat(statistic[indices], n_features), minlength=length)
+    result[-1] = numpy.bincount(codes, minlength=length)
+    return result.reshape([len(statistics) + 1, n_features, n_bins])
+
+
+def compute_histogram_costs(criterion, histograms):
+    """Computes costs of splits from histograms (as returned by compute_histograms),
+    cost[feature, bin] corresponds to the split bin_index <= bin.
+    :return: costs, array [n_features, n_bins - 1], impossible splits (with empty part) get inf
+    """
+    left = numpy.cumsum(histograms, axis=2)[:, :, :-1]
+    right = histograms.sum(axis=2)[:, :, numpy.newaxis] - left
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        costs = criterion.compute_costs_from_sums(left[:-1], right[:-1])
+    costs[(left[-1] == 0) | (right[-1] == 0)] = numpy.inf
+    return costs
+
+
 criterions = {'mse': MseCriterion,
               'fmse': FriedmanMseCriterion,
               'friedman-mse': FriedmanMseCriterion,
@@ -168,59 +259,193 @@ criterions = {'mse': MseCriterion,
 }
 
 
+def _stack_node_values(values):
+    """Converts list with values in nodes (None for leaves) to array, leaves get zeros"""
+    example = numpy.asarray(next((value for value in values if value is not None), 0))
+    result = numpy.zeros((len(values),) + example.shape, dtype=example.dtype)
+    for node, value in enumerate(values):
+        if value is not None:
+            result[node] = value
+    return result
+
+
 class FastTreeRegressor(BaseEstimator, RegressorMixin):
+    # descendants with other types of splits don't use orders of features and binned data
+    supports_feature_orders = True
+    supports_histograms = True
+    # names of arrays which keep parameters of splits in nodes, descendants define own types of splits
+    split_fields = ['feature', 'threshold']
+
     def __init__(self,
                  max_depth=5,
                  max_features=None,
                  min_samples_split=40,
                  max_events_used=1000,
                  criterion='mse',
-                 random_state=None):
+                 random_state=None,
+                 level_wise=False,
+                 sampling='choice',
+                 n_threads=1):
+        """
+        :param int n_threads: number of threads, in recursive building split search in node is done
+            in parallel for groups of features (numpy releases GIL while sorting)
+        :param str sampling: how max_events_used events are taken from large nodes in recursive building.
+            'choice' - random events with replacement,
+            'permutation' - events are shuffled once per tree, nodes keep this order, so the first events of node
+            are random sample without replacement (no random numbers and no copies are needed in nodes),
+            'stratified' - the same, but events with positive and non-positive target are interleaved
+            in the order proportionally, so samples keep the fraction of positive targets.
+            With feature_orders events with the smallest positions in this order are taken from node.
+            Level-wise building and binned data support only 'choice'.
+        :param bool level_wise: if True, tree is built level by level (all nodes of the same depth are split
+            together with vectorized operations), otherwise recursively node by node.
+            In large nodes each event is used in split search with probability max_events_used / n_events_in_node.
+            With 'pvalue' criterion ranks of target are computed over all events, not inside nodes.
+        """
         self.max_depth = max_depth
         self.max_features = max_features
         self.min_samples_split = min_samples_split
         self.max_events_used = max_events_used
         self.criterion = criterion
         self.random_state = random_state
-        # keeps the indices of features and the values at which we split them.
-        # dict{node_index -> (feature_index, split_value) or (leaf_value)}
-        # Node index is defined as:
-        # left: `0`bit, right: `1`bit.
-        # Indices of some nodes: root - 1b, left child of root: 10b, it's right child: 101b.
-        self.nodes_data = dict()
+        self.level_wise = level_wise
+        self.sampling = sampling
+        self.n_threads = n_threads
+
+    # region nodes
+    # Nodes of fitted tree are kept in arrays, root has index 0, parent has smaller index than children.
+    # children_left, children_right - indices of children, leaves point to themselves,
+    # value - predictions in leaves, arrays from split_fields - parameters of splits (zeros in leaves).
+    # During fitting nodes are collected in lists and converted to arrays once.
+
+    def _start_nodes(self):
+        self._nodes = {field: [] for field in ['children_left', 'children_right', 'value'] + self.split_fields}
+
+    def _add_leaf(self, value):
+        """Adds leaf node, returns its index"""
+        node = len(self._nodes['value'])
+        self._nodes['children_left'].append(node)
+        self._nodes['children_right'].append(node)
+        self._nodes['value'].append(value)
+        for field in self.split_fields:
+            self._nodes[field].append(None)
+        return node
+
+    def _add_split(self, **split_data):
+        """Adds split node with given parameters (keys are split_fields), returns its index.
+        Children should be set later with _set_children"""
+        node = self._add_leaf(0.)
+        for field in self.split_fields:
+            self._nodes[field][node] = split_data[field]
+        return node
+
+    def _set_children(self, node, left, right):
+        self._nodes['children_left'][node] = left
+        self._nodes['children_right'][node] = right
+
+    def _compile_nodes(self):
+        """Converts collected nodes to arrays"""
+        self.children_left = numpy.array(self._nodes['children_left'], dtype=int)
+        self.children_right = numpy.array(self._nodes['children_right'], dtype=int)
+        self.value = numpy.array(self._nodes['value'], dtype=float)
+        for field in self.split_fields:
+            setattr(self, field, _stack_node_values(self._nodes[field]))
+        del self._nodes
+        # _children[2 * node + to_right] is the child of node
+        self._children = numpy.column_stack([self.children_left, self.children_right]).ravel()
+        # depth is number of steps needed to reach any leaf from root
+        self.depth = 0
+        level = numpy.array([0])
+        while True:
+            level = level[self.children_left[level] != level]
+            if len(level) == 0:
+                break
+            level = numpy.concatenate([self.children_left[level], self.children_right[level]])
+            self.depth += 1
+
+    @property
+    def node_count(self):
+        return len(self.value)
+
+    def _is_leaf(self, node):
+        return self.children_left[node] == node
+
+    # endregion
 
     def print_tree_stats(self):
-        print(len(self.nodes_data), ' nodes in tree')
-        leaves = [k for k, v in self.nodes_data.items() if len(v) == 1]
-        print(len(leaves), ' leaf nodes in tree')
-
-    def print_tree(self, node_index=1, prefix=''):
-        data = self.nodes_data[node_index]
-        print(prefix, data)
-        if len(data) > 1:
-            left, right = self._children(node_index)
-            self.print_tree(left, "  " + prefix)
-            self.print_tree(right, "  " + prefix)
+        print(self.node_count, ' nodes in tree')
+        print(numpy.sum(self.children_left == numpy.arange(self.node_count)), ' leaf nodes in tree')
 
-    @staticmethod
-    def _children(node_index):
-        left_node = 2 * node_index
-        right_node = 2 * node_index + 1
-        return left_node, right_node
+    def print_tree(self, node=0, prefix=''):
+        if self._is_leaf(node):
+            print(prefix, self.value[node])
+        else:
+            print(prefix, tuple(getattr(self, field)[node] for field in self.split_fields))
+            self.print_tree(self.children_left[node], "  " + prefix)
+            self.print_tree(self.children_right[node], "  " + prefix)
 
-    def _fit_tree_node(self, X, y, w, node_index, depth, passed_indices):
-        """Recursive function to fit tree, rather simple implementation"""
-        if len(passed_indices) <= self.min_samples_split or depth >= self.max_depth:
-            self.nodes_data[node_index] = (numpy.average(y[passed_indices], weights=w[passed_indices]), )
-            return
+    def _compute_sampling_order(self, y):
+        """Initial order of events for 'permutation' and 'stratified' sampling"""
+        if self.sampling == 'permutation':
+            return self.random_state.permutation(len(y))
+        assert self.sampling == 'stratified', 'Unknown sampling: ' + str(self.sampling)
+        # i-th event of shuffled group gets key (i + shift) / n_group,
+        # so in each prefix of order the number of events from group is proportional to its size
+        keys = numpy.zeros(len(y))
+        for group in [y > 0, y <= 0]:
+            n_group = numpy.sum(group)
+            keys[group] = (self.random_state.permutation(n_group) + self.random_state.random_sample()) / n_group
+        return numpy.argsort(keys, kind='mergesort')
 
-        selected_events = passed_indices
-        if len(passed_indices) > self.max_events_used:
-            selected_events = self.random_state.choice(passed_indices, size=self.max_events_used, replace=True)
+    def _sample_node_events(self, passed_indices):
+        """Selects events of node used in split search"""
+        if len(passed_indices) <= self.max_events_used:
+            return passed_indices
+        if self.sampling == 'choice':
+            return self.random_state.choice(passed_indices, size=self.max_events_used, replace=True)
+        # nodes keep random order of events, so the first events are random sample without replacement
+        return passed_indices[:self.max_events_used]
+
+    def _sample_presorted_node_events(self, passed_indices):
+        """Selects events of node used in split search when node keeps events sorted by features"""
+        if self.sampling == 'choice':
+            return self.random_state.choice(passed_indices, size=self.max_events_used, replace=False)
+        # events of node that go first in the sampling order, the same as the prefix of node in recursive building
+        ranks = self._sampling_ranks[passed_indices]
+        return passed_indices[numpy.argpartition(ranks, self.max_events_used - 1)[:self.max_events_used]]
 
+    def _select_features(self):
+        """Returns features used in split search of node and flag whether these are all features"""
+        if self._n_used_features == self.n_features:
+            return self._all_features, True
         selected_features = self.random_state.choice(self.n_features, size=self._n_used_features, replace=False)
-        cuts, costs, _ = self._criterion.compute_best_splits(
-            X[numpy.ix_(selected_events, selected_features)], y[selected_events], sample_weight=w[selected_events])
+        return selected_features, False
+
+    def _compute_best_splits(self, data, y, sample_weight, orders=None):
+        """Calls criterion, with several threads columns of data are split into groups processed in parallel"""
+        n_groups = min(self.n_threads, data.shape[1])
+        if self._pool is None or n_groups < 2:
+            return self._criterion.compute_best_splits(data, y, sample_weight, orders=orders)
+
+        def compute_group_splits(columns):
+            group_orders = None if orders is None else orders[:, columns]
+            return self._criterion.compute_best_splits(data[:, columns], y, sample_weight, orders=group_orders)
+
+        limits = numpy.linspace(0, data.shape[1], n_groups + 1).astype(int)
+        results = self._pool.map(compute_group_splits, [slice(start, stop) for start, stop in zip(limits, limits[1:])])
+        return tuple(numpy.concatenate(group_results) for group_results in zip(*results))
+
+    def _fit_tree_node(self, X, y, w, depth, passed_indices):
+        """Recursive function to fit tree, rather simple implementation, returns index of created node"""
+        if len(passed_indices) <= self.min_samples_split or depth >= self.max_depth:
+            return self._add_leaf(numpy.average(y[passed_indices], weights=w[passed_indices]))
+
+        selected_events = self._sample_node_events(passed_indices)
+        selected_features, all_features = self._select_features()
+        # when all features are used, only rows are taken. Rows are copied, since criterion sorts each column,
+        # argsort and gathering of y and weights by orders allocate arrays of the same shape anyway
+        data = X[selected_events] if all_features else X[numpy.ix_(selected_events, selected_features)]
+        cuts, costs, _ = self._compute_best_splits(data, y[selected_events], sample_weight=w[selected_events])
 
         # feature that showed best pre-estimated cost
         best_feature_index = numpy.argmin(costs)
@@ -229,76 +454,261 @@ class FastTreeRegressor(BaseEstimator, RegressorMixin):
         # computing information for (possible) children
         passed_left_subtree = passed_indices[X[passed_indices, feature_index] <= split]
         passed_right_subtree = passed_indices[X[passed_indices, feature_index] > split]
-        left, right = self._children(node_index)
         if len(passed_left_subtree) == 0 or len(passed_right_subtree) == 0:
             # this will be leaf
-            self.nodes_data[node_index] = (numpy.average(y[passed_indices], weights=w[passed_indices]), )
-        else:
-            # non-leaf, recurrent calls
-            self.nodes_data[node_index] = (feature_index, split)
-            self._fit_tree_node(X, y, w, left, depth + 1, passed_left_subtree)
-            self._fit_tree_node(X, y, w, right, depth + 1, passed_right_subtree)
+            return self._add_leaf(numpy.average(y[passed_indices], weights=w[passed_indices]))
+        # non-leaf, recurrent calls
+        node = self._add_split(feature=feature_index, threshold=split)
+        left = self._fit_tree_node(X, y, w, depth + 1, passed_left_subtree)
+        right = self._fit_tree_node(X, y, w, depth + 1, passed_right_subtree)
+        self._set_children(node, left, right)
+        return node
 
-    def _apply_node(self, X, leaf_indices, predictions, node_index, passed_indices):
-        """Recursive function to compute the index """
-        node_data = self.nodes_data[node_index]
-        if len(node_data) == 1:
-            # leaf node
-            leaf_indices[passed_indices] = node_index
-            predictions[passed_indices] = node_data[0]
+    def _fit_presorted_tree_node(self, X, y, w, depth, node_orders):
+        """Recursive function to fit tree, which doesn't sort data in nodes, returns index of created node.
+        :param node_orders: [n_features, n_node_events], events in node sorted by each feature,
+            orders of children are obtained by stable partitioning
+        """
+        passed_indices = node_orders[0]
+        if len(passed_indices) <= self.min_samples_split or depth >= self.max_depth:
+            return self._add_leaf(numpy.average(y[passed_indices], weights=w[passed_indices]))
+
+        selected_features, all_features = self._select_features()
+        selected_orders = node_orders if all_features else node_orders[selected_features]
+        if len(passed_indices) > self.max_events_used:
+            selected_events = self._sample_presorted_node_events(passed_indices)
+            self._event_mask[selected_events] = True
+            selected_orders = _stable_select(selected_orders, self._event_mask)
+            self._event_mask[selected_events] = False
+        # numbering events inside the node to pass orders to criterion
+        selected_events = selected_orders[0]
+        self._event_positions[selected_events] = numpy.arange(len(selected_events))
+        data = X[selected_events] if all_features else X[numpy.ix_(selected_events, selected_features)]
+        cuts, costs, _ = self._compute_best_splits(
+            data, y[selected_events], sample_weight=w[selected_events], orders=self._event_positions[selected_orders.T])
+
+        # feature that showed best pre-estimated cost
+        best_feature_index = numpy.argmin(costs)
+        feature_index = selected_features[best_feature_index]
+        split = cuts[best_feature_index]
+        # computing information for (possible) children
+        self._event_mask[passed_indices] = X[passed_indices, feature_index] <= split
+        left_orders = _stable_select(node_orders, self._event_mask)
+        self._event_mask[passed_indices] = ~self._event_mask[passed_indices]
+        right_orders = _stable_select(node_orders, self._event_mask)
+        self._event_mask[passed_indices] = False
+        if left_orders.shape[1] == 0 or right_orders.shape[1] == 0:
+            # this will be leaf
+            return self._add_leaf(numpy.average(y[passed_indices], weights=w[passed_indices]))
+        # non-leaf, recurrent calls
+        node = self._add_split(feature=feature_index, threshold=split)
+        left = self._fit_presorted_tree_node(X, y, w, depth + 1, left_orders)
+        right = self._fit_presorted_tree_node(X, y, w, depth + 1, right_orders)
+        self._set_children(node, left, right)
+        return node
+
+    def _fit_binned_tree_node(self, X_binned, y, w, depth, passed_indices, histograms):
+        """Recursive function to fit tree on binned data, returns index of created node.
+        Histograms of one of children are computed from events, of the other - by subtraction from parent.
+        """
+        if len(passed_indices) <= self.min_samples_split or depth >= self.max_depth:
+            return self._add_leaf(numpy.average(y[passed_indices], weights=w[passed_indices]))
+
+        costs = compute_histogram_costs(self._criterion, histograms)
+        if self._n_used_features < self.n_features:
+            selected_features = self.random_state.choice(self.n_features, size=self._n_used_features, replace=False)
+            feature_mask = numpy.zeros(self.n_features, dtype=bool)
+            feature_mask[selected_features] = True
+            costs[~feature_mask, :] = numpy.inf
+        feature_index, bin_threshold = numpy.unravel_index(numpy.argmin(costs), costs.shape)
+        if not numpy.isfinite(costs[feature_index, bin_threshold]):
+            # this will be leaf
+            return self._add_leaf(numpy.average(y[passed_indices], weights=w[passed_indices]))
+
+        to_left = X_binned[passed_indices, feature_index] <= bin_threshold
+        passed_left_subtree = passed_indices[to_left]
+        passed_right_subtree = passed_indices[~to_left]
+        if len(passed_left_subtree) <= len(passed_right_subtree):
+            left_histograms = compute_histograms(X_binned, self._statistics, passed_left_subtree, self._n_bins)
+            right_histograms = histograms - left_histograms
         else:
-            # non-leaf
-            feature_index, split = node_data
-            to_right = X[passed_indices, feature_index] > split
-            passed_left_subtree = passed_indices[~to_right]
-            passed_right_subtree = passed_indices[to_right]
-            left, right = self._children(node_index)
-            self._apply_node(X, leaf_indices, predictions, left, passed_left_subtree)
-            self._apply_node(X, leaf_indices, predictions, right, passed_right_subtree)
+            right_histograms = compute_histograms(X_binned, self._statistics, passed_right_subtree, self._n_bins)
+            left_histograms = histograms - right_histograms
+        # x <= edge  <=>  bin_index <= bin_threshold, so tree can be applied to original data
+        node = self._add_split(feature=feature_index, threshold=self._bin_edges[feature_index][bin_threshold])
+        left = self._fit_binned_tree_node(X_binned, y, w, depth + 1, passed_left_subtree, left_histograms)
+        right = self._fit_binned_tree_node(X_binned, y, w, depth + 1, passed_right_subtree, right_histograms)
+        self._set_children(node, left, right)
+        return node
+
+    def _compute_level_best_splits(self, X, statistics, feature_orders, event_positions, selected, n_nodes):
+        """Finds the best split for each node of level.
+        In each presorted feature events are grouped by nodes with stable sorting, so inside each group
+        events remain sorted, cumulative sums inside groups are computed by subtracting sums before group.
+        :param event_positions: index of node in level for each event, -1 for events in leaves
+        :param selected: boolean mask of events used in split search
+        :return: best_costs, best_features, best_cuts - arrays of length n_nodes
+        """
+        best_costs = numpy.zeros(n_nodes) + numpy.inf
+        best_features = numpy.zeros(n_nodes, dtype=int)
+        best_cuts = numpy.zeros(n_nodes)
+        # each node uses own subset of features
+        feature_mask = None
+        if self._n_used_features < self.n_features:
+            ranks = numpy.argsort(numpy.argsort(self.random_state.random_sample([n_nodes, self.n_features]), axis=1),
+                                  axis=1)
+            feature_mask = ranks < self._n_used_features
+
+        node_dtype = numpy.uint16 if n_nodes <= numpy.iinfo(numpy.uint16).max else int
+        for feature, events in enumerate(feature_orders):
+            events = events[selected[events]]
+            nodes = event_positions[events]
+            # stable sorting of small integers is done by numpy with radix sort in linear time
+            grouping = numpy.argsort(nodes.astype(node_dtype), kind='mergesort')
+            events = events[grouping]
+            nodes = nodes[grouping]
+            values = X[events, feature]
+
+            # take is used since it is much faster than fancy indexing along second axis
+            left = numpy.cumsum(statistics.take(events, axis=1), axis=1)
+            node_counts = numpy.bincount(nodes, minlength=n_nodes)
+            ends = numpy.cumsum(node_counts)
+            starts = ends - node_counts
+            before = numpy.zeros([len(statistics), n_nodes])
+            before[:, starts > 0] = left[:, starts[starts > 0] - 1]
+            total = numpy.zeros([len(statistics), n_nodes])
+            total[:, node_counts > 0] = left[:, ends[node_counts > 0] - 1]
+            total -= before
+            left -= before.take(nodes, axis=1)
+            right = total.take(nodes, axis=1) - left
+            costs = self._criterion.compute_costs_from_sums(left, right)
+
+            # split is possible only between different values inside the same node
+            possible = numpy.zeros(len(events), dtype=bool)
+            possible[:-1] = (nodes[1:] == nodes[:-1]) & (values[1:] > values[:-1])
+            if feature_mask is not None:
+                possible &= feature_mask[nodes, feature]
+            costs[~possible] = numpy.inf
+
+            # the first position with minimal cost in each node
+            node_min_costs = numpy.zeros(n_nodes) + numpy.inf
+            if len(events) > 0:
+                node_min_costs[node_counts > 0] = numpy.minimum.reduceat(costs, starts[node_counts > 0])
+            candidates = numpy.flatnonzero((costs == node_min_costs[nodes]) & possible)
+            improved_nodes, first = numpy.unique(nodes[candidates], return_index=True)
+            positions = candidates[first]
+            improved = node_min_costs[improved_nodes] < best_costs[improved_nodes]
+            improved_nodes, positions = improved_nodes[improved], positions[improved]
+            best_costs[improved_nodes] = node_min_costs[improved_nodes]
+            best_features[improved_nodes] = feature
+            best_cuts[improved_nodes] = (values[positions] + values[positions + 1]) / 2.
+        return best_costs, best_features, best_cuts
+
+    def _fit_level_wise(self, X, y, w, feature_orders):
+        """Builds tree level by level, number of passes over data is equal to depth of tree"""
+        assert hasattr(self._criterion, 'compute_costs_from_sums'), \
+            'criterion {} is not supported in level-wise mode'.format(self.criterion)
+        statistics = self._criterion.compute_statistics(y, w)
+        # nodes of previous level which were split (children of these are nodes of current level)
+        parent_nodes = []
+        n_nodes = 1
+        # for each event - index of node inside level, -1 if event is in leaf
+        event_positions = numpy.zeros(len(X), dtype=int)
+        for depth in range(self.max_depth + 1):
+            active_events = numpy.flatnonzero(event_positions >= 0)
+            active_positions = event_positions[active_events]
+            node_counts = numpy.bincount(active_positions, minlength=n_nodes)
+            node_values = numpy.bincount(active_positions, weights=w[active_events] * y[active_events],
+                                         minlength=n_nodes)
+            node_values /= numpy.bincount(active_positions, weights=w[active_events], minlength=n_nodes)
+
+            can_split = node_counts > self.min_samples_split
+            if depth >= self.max_depth:
+                can_split[:] = False
+            best_costs = numpy.zeros(n_nodes) + numpy.inf
+            if numpy.any(can_split):
+                selected = (event_positions >= 0) & can_split[event_positions]
+                # large nodes are subsampled
+                probabilities = self.max_events_used / numpy.maximum(node_counts, 1.)
+                selected &= self.random_state.random_sample(len(X)) < probabilities[event_positions]
+                best_costs, best_features, best_cuts = self._compute_level_best_splits(
+                    X, statistics, feature_orders, event_positions, selected, n_nodes)
+
+            is_split = numpy.isfinite(best_costs)
+            level_nodes = []
+            for position in range(n_nodes):
+                if is_split[position]:
+                    level_nodes.append(self._add_split(feature=best_features[position], threshold=best_cuts[position]))
+                else:
+                    level_nodes.append(self._add_leaf(node_values[position]))
+            for rank, parent in enumerate(parent_nodes):
+                self._set_children(parent, level_nodes[2 * rank], level_nodes[2 * rank + 1])
+            if not numpy.any(is_split):
+                break
+
+            # passing events to the next level, left child of split node k gets position 2 * rank of k
+            split_ranks = numpy.cumsum(is_split) - 1
+            events_split = is_split[active_positions]
+            split_events = active_events[events_split]
+            split_positions = active_positions[events_split]
+            to_right = X[split_events, best_features[split_positions]] > best_cuts[split_positions]
+            event_positions[active_events] = -1
+            event_positions[split_events] = 2 * split_ranks[split_positions] + to_right
+            parent_nodes = [node for node, split in zip(level_nodes, is_split) if split]
+            n_nodes = 2 * len(parent_nodes)
 
     def apply(self, X):
-        """For each event returns the index of leaf that event belongs to"""
+        """For each event returns the index of leaf that event belongs to and prediction"""
         assert isinstance(X, numpy.ndarray), 'X should be numpy.array'
+        leaf_indices = self._descend(X)
+        return leaf_indices, self.value.take(leaf_indices)
+
+    def _descend(self, X):
+        """All events descend one level at each step (leaves point to themselves), returns leaf indices.
+        Arrays are accessed with take on flattened data, which is much faster than fancy indexing"""
+        flat_X = numpy.ravel(X)
+        offsets = numpy.arange(len(X)) * X.shape[1]
         leaf_indices = numpy.zeros(len(X), dtype=int)
-        predictions = numpy.zeros(len(X), dtype=float)
-        # this function fills leaf_indices array
-        self._apply_node(X, leaf_indices, predictions, node_index=1, passed_indices=numpy.arange(len(X)))
-        return leaf_indices, predictions
+        for _ in range(self.depth):
+            to_right = self._split_to_right(flat_X, offsets, leaf_indices)
+            leaf_indices = self._children.take(2 * leaf_indices + to_right)
+        return leaf_indices
 
-    def fast_apply(self, X):
-        """Same as previous function, but uses special structures and vectorization """
+    def _split_to_right(self, flat_X, offsets, nodes):
+        """For each event returns whether it goes to the right child of its node,
+        j-th feature of i-th event is flat_X[offsets[i] + j]. Descendants with other types of splits redefine this"""
+        return flat_X.take(offsets + self.feature.take(nodes)) > self.threshold.take(nodes)
+
+    def _apply_node(self, X, leaf_indices, node, passed_indices):
+        """Recursive function to compute the index """
+        if self._is_leaf(node):
+            leaf_indices[passed_indices] = node
+        else:
+            to_right = X[passed_indices, self.feature[node]] > self.threshold[node]
+            self._apply_node(X, leaf_indices, self.children_left[node], passed_indices[~to_right])
+            self._apply_node(X, leaf_indices, self.children_right[node], passed_indices[to_right])
+
+    def _recursive_apply(self, X):
+        """Computes leaves with recursive _apply_node, the same result as apply"""
         assert isinstance(X, numpy.ndarray), 'X should be numpy.array'
-        # vertices in tree are enumerated (this time in dense way without binary notation), root is 0.
-        ordered_nodes = OrderedDict(self.nodes_data)
-        n_nodes = len(ordered_nodes)
-        old2new_index = dict(zip(ordered_nodes.keys(), range(n_nodes)))
-        child_indices = numpy.zeros(2 * n_nodes, dtype=int)
-        features = numpy.zeros(n_nodes, dtype=int)
-        splits = numpy.zeros(n_nodes, dtype=float)
-        leaf_values = numpy.zeros(n_nodes, dtype=float)
-
-        for i, (node_index, node_data) in enumerate(ordered_nodes.items()):
-            if len(node_data) == 1:
-                leaf_values[i] = node_data[0]
-                child_indices[2 * i] = i
-                child_indices[2 * i + 1] = i
-            else:
-                feature_index, split = node_data
-                features[i] = feature_index
-                splits[i] = split
-                left, right = self._children(node_index)
-                child_indices[2 * i] = old2new_index[left]
-                child_indices[2 * i + 1] = old2new_index[right]
-
-        rows = numpy.arange(len(X))
         leaf_indices = numpy.zeros(len(X), dtype=int)
-        for _ in range(self.max_depth + 1):
-            passed = X[rows, features[leaf_indices]] > splits[leaf_indices]
-            leaf_indices = child_indices[2 * leaf_indices + passed]
+        # this function fills leaf_indices array
+        self._apply_node(X, leaf_indices, node=0, passed_indices=numpy.arange(len(X)))
+        return leaf_indices, self.value[leaf_indices]
 
-        return leaf_indices, leaf_values[leaf_indices]
+    def fast_apply(self, X):
+        """The same as apply (kept for compatibility)"""
+        return self.apply(X)
 
-    def fit(self, X, y, sample_weight, check_input=True):
+    def fit(self, X, y, sample_weight, check_input=True, feature_orders=None, bin_edges=None):
+        """
+        :param feature_orders: optional array [n_features, n_samples] computed by compute_feature_orders(X),
+            if passed, data isn't sorted in each node (useful when many trees are trained on the same X)
+        :param bin_edges: optional list with edges of bins for each feature (as computed by
+            hep_ml.histogramtree.BinQuantizer), if passed, X should contain uint8 indices of bins.
+            Splits are found from histograms over bins (all events of node are used), fitted tree is applied
+            to original (not binned) data.
+        """
         if check_input:
             assert isinstance(X, numpy.ndarray), "X should be numpy.array"
             assert isinstance(y, numpy.ndarray), "y should be numpy.array"
@@ -311,10 +721,54 @@ class FastTreeRegressor(BaseEstimator, RegressorMixin):
             self._n_used_features = min(self.n_features, self.max_features)
         self._criterion = criterions[self.criterion]
         self.random_state = check_random_state(self.random_state)
-        self.nodes_data = dict()  # clearing previous fitting
-        root_node_index = 1
-        self._fit_tree_node(X=X, y=y, w=sample_weight, node_index=root_node_index, depth=0,
-                            passed_indices=numpy.arange(len(X)))
+        assert self.sampling in ['choice', 'permutation', 'stratified'], 'Unknown sampling: ' + str(self.sampling)
+        self._all_features = numpy.arange(self.n_features)
+        self._start_nodes()
+        # with several threads split search in nodes is done in parallel for groups of features
+        self._pool = ThreadPool(self.n_threads) if self.n_threads > 1 else None
+        try:
+            if bin_edges is not None:
+                assert self.supports_histograms, 'binned data is not supported by ' + self.__class__.__name__
+                assert X.dtype == numpy.uint8, 'data should be binned'
+                assert not self.level_wise and feature_orders is None, 'binned data is used without feature_orders'
+                assert self.sampling == 'choice', 'all events are used with binned data, sampling should be choice'
+                assert hasattr(self._criterion, 'compute_costs_from_sums'), \
+                    'criterion {} is not supported with binned data'.format(self.criterion)
+                self._bin_edges = bin_edges
+                self._n_bins = max(len(edges) for edges in bin_edges) + 1
+                self._statistics = self._criterion.compute_statistics(y, sample_weight)
+                indices = numpy.arange(len(X))
+                self._fit_binned_tree_node(X, y, sample_weight, depth=0, passed_indices=indices,
+                                           histograms=compute_histograms(X, self._statistics, indices, self._n_bins))
+                del self._bin_edges, self._n_bins, self._statistics
+            elif self.level_wise:
+                assert self.supports_feature_orders, \
+                    'level-wise building is not supported by ' + self.__class__.__name__
+                assert self.sampling == 'choice', 'level-wise building supports only choice sampling'
+                if feature_orders is None:
+                    feature_orders = compute_feature_orders(X)
+                self._fit_level_wise(X, y, sample_weight, feature_orders)
+            elif feature_orders is None:
+                passed_indices = numpy.arange(len(X))
+                if self.sampling != 'choice':
+                    passed_indices = self._compute_sampling_order(y)
+                self._fit_tree_node(X=X, y=y, w=sample_weight, depth=0, passed_indices=passed_indices)
+            else:
+                assert self.supports_feature_orders, 'feature_orders are not supported by ' + self.__class__.__name__
+                assert feature_orders.shape == (self.n_features, len(X)), 'wrong shape of feature_orders'
+                # buffers reused in all nodes
+                self._event_mask = numpy.zeros(len(X), dtype=bool)
+                self._event_positions = numpy.zeros(len(X), dtype=int)
+                self._sampling_ranks = None
+                if self.sampling != 'choice':
+                    self._sampling_ranks = numpy.argsort(self._compute_sampling_order(y))
+                self._fit_presorted_tree_node(X=X, y=y, w=sample_weight, depth=0, node_orders=feature_orders)
+                del self._event_mask, self._event_positions, self._sampling_ranks
+        finally:
+            if self._pool is not None:
+                self._pool.terminate()
+            del self._pool
+        self._compile_nodes()
         return self
 
     def predict(self, X):
@@ -322,7 +776,29 @@ class FastTreeRegressor(BaseEstimator, RegressorMixin):
         return predictions
 
 
+def _fit_linear_regressions(data, y):
+    """Fits many linear regressions (with intercept) at once by solving stacked normal equations.
+    :param data: [n_regressions, n_samples, n_features]
+    :param y: [n_samples], target is the same for all regressions
+    :return: coefficients, [n_regressions, n_features]
+    """
+    data = data - data.mean(axis=1, keepdims=True)
+    y = y - y.mean()
+    gram = numpy.einsum('rsi,rsj->rij', data, data)
+    moments = numpy.einsum('rsi,s->ri', data, y)
+    # small regularization, since the same feature may be used twice in combination
+    n_features = data.shape[2]
+    regularization = 1e-10 * numpy.trace(gram, axis1=1, axis2=2) / n_features + 1e-20
+    gram += regularization[:, numpy.newaxis, numpy.newaxis] * numpy.eye(n_features)
+    return numpy.linalg.solve(gram, moments[:, :, numpy.newaxis])[:, :, 0]
+
+
 class FastNeuroTreeRegressor(FastTreeRegressor):
+    supports_feature_orders = False
+    supports_histograms = False
+    # split is done on linear combination of features
+    split_fields = ['lincomb_features', 'lincomb_coefficients', 'threshold']
+
     def __init__(self,
                  max_depth=5,
                  max_features=None,
@@ -332,7 +808,9 @@ class FastNeuroTreeRegressor(FastTreeRegressor):
                  n_events_form_lincomb=50,
                  max_events_used=1000,
                  criterion='mse',
-                 random_state=None):
+                 random_state=None,
+                 sampling='choice',
+                 n_threads=1):
         self.min_samples_leaf = min_samples_leaf
         self.n_lincomb = n_lincomb
         self.n_events_form_lincomb = n_events_form_lincomb
@@ -342,38 +820,35 @@ class FastNeuroTreeRegressor(FastTreeRegressor):
                                    min_samples_split=min_samples_split,
                                    max_events_used=max_events_used,
                                    criterion=criterion,
-                                   random_state=random_state)
+                                   random_state=random_state,
+                                   sampling=sampling,
+                                   n_threads=n_threads)
 
-    def _fit_tree_node(self, X, y, w, node_index, depth, passed_indices):
-        """Recursive function to fit tree, rather simple implementation"""
+    def _fit_tree_node(self, X, y, w, depth, passed_indices):
+        """Recursive function to fit tree, rather simple implementation, returns index of created node"""
         if len(passed_indices) <= self.min_samples_split or depth >= self.max_depth:
-            self.nodes_data[node_index] = (numpy.average(y[passed_indices], weights=w[passed_indices]), )
-            return
+            return self._add_leaf(numpy.average(y[passed_indices], weights=w[passed_indices]))
 
-        selected_events = passed_indices
-        if len(passed_indices) > self.max_events_used:
-            selected_events = self.random_state.choice(passed_indices, size=self.max_events_used, replace=True)
+        selected_events = self._sample_node_events(passed_indices)
 
         candidate_features = self.random_state.choice(self.n_features, replace=True,
                                                       size=[self._n_used_features, self.n_lincomb])
-        formed_data = numpy.zeros([len(selected_events), self._n_used_features])
-        candidate_lincomb_coefficients = numpy.zeros_like(candidate_features, dtype=float)
-        for i, lincomb_features in enumerate(candidate_features):
-            pre_events_used = selected_events[:self.n_events_form_lincomb]
-            data = X[numpy.ix_(pre_events_used, lincomb_features)]
-            w_used = w[pre_events_used]
-            lr = LinearRegression().fit(data * w_used[:, numpy.newaxis], y[pre_events_used] * w_used)
-            # normalizing coeffs
-            coeffs = lr.coef_
-            coeffs /= numpy.abs(coeffs).sum() + 0.01
-
-            candidate_lincomb_coefficients[i, :] = coeffs
-            formed_data[:, i] = self._compute_lincomb(X, indices=selected_events,
-                                                      lincomb_features=lincomb_features,
-                                                      lincomb_coefficients=coeffs)
-
-        cuts, costs, _ = self._criterion.compute_best_splits(
-            formed_data, y[selected_events], sample_weight=w[selected_events])
+        pre_events_used = selected_events[:self.n_events_form_lincomb]
+        w_used = w[pre_events_used]
+        # [n_candidates, n_events, n_lincomb]
+        data = numpy.transpose(X[pre_events_used][:, candidate_features], [1, 0, 2]) * w_used[:, numpy.newaxis]
+        candidate_lincomb_coefficients = _fit_linear_regressions(data, y[pre_events_used] * w_used)
+        # normalizing coeffs
+        candidate_lincomb_coefficients /= numpy.abs(candidate_lincomb_coefficients).sum(axis=1, keepdims=True) + 0.01
+
+        # all linear combinations are computed with one matrix product
+        combinations = numpy.zeros([self.n_features, self._n_used_features])
+        candidate_index = numpy.repeat(numpy.arange(self._n_used_features), self.n_lincomb)
+        numpy.add.at(combinations, (candidate_features.ravel(), candidate_index),
+                     candidate_lincomb_coefficients.ravel())
+        formed_data = X[selected_events].dot(combinations)
+
+        cuts, costs, _ = self._compute_best_splits(formed_data, y[selected_events], sample_weight=w[selected_events])
 
         # feature that showed best pre-estimated cost
         combination_index = numpy.argmin(costs)
@@ -387,38 +862,182 @@ class FastNeuroTreeRegressor(FastTreeRegressor):
 
         passed_left_subtree = passed_indices[lincomb_values <= split]
         passed_right_subtree = passed_indices[lincomb_values > split]
-        left, right = self._children(node_index)
         if len(passed_left_subtree) < self.min_samples_leaf or len(passed_right_subtree) < self.min_samples_leaf:
             # this will be leaf
-            self.nodes_data[node_index] = (numpy.average(y[passed_indices], weights=w[passed_indices]), )
-        else:
-            # non-leaf, recurrent calls
-            self.nodes_data[node_index] = (lincomb_features, lincomb_coefficients, split)
-            self._fit_tree_node(X, y, w, left, depth + 1, passed_left_subtree)
-            self._fit_tree_node(X, y, w, right, depth + 1, passed_right_subtree)
+            return self._add_leaf(numpy.average(y[passed_indices], weights=w[passed_indices]))
+        # non-leaf, recurrent calls
+        node = self._add_split(lincomb_features=lincomb_features, lincomb_coefficients=lincomb_coefficients,
+                               threshold=split)
+        left = self._fit_tree_node(X, y, w, depth + 1, passed_left_subtree)
+        right = self._fit_tree_node(X, y, w, depth + 1, passed_right_subtree)
+        self._set_children(node, left, right)
+        return node
 
     def _compute_lincomb(self, X, indices, lincomb_features, lincomb_coefficients):
-        result = numpy.zeros(len(indices))
-        for feature, coeff in zip(lincomb_features, lincomb_coefficients):
-            result += X[indices, feature] * coeff
-        return result
+        return X[numpy.ix_(indices, lincomb_features)].dot(lincomb_coefficients)
 
-    def _apply_node(self, X, leaf_indices, predictions, node_index, passed_indices):
+    def _apply_node(self, X, leaf_indices, node, passed_indices):
         """Recursive function to compute the index """
-        node_data = self.nodes_data[node_index]
-        if len(node_data) == 1:
-            # leaf node
-            leaf_indices[passed_indices] = node_index
-            predictions[passed_indices] = node_data[0]
+        if self._is_leaf(node):
+            leaf_indices[passed_indices] = node
         else:
-            # non-leaf
-            lincomb_features, lincomb_coefficients, split = node_data
             lincomb_values = self._compute_lincomb(X, indices=passed_indices,
-                                                   lincomb_features=lincomb_features,
-                                                   lincomb_coefficients=lincomb_coefficients)
-            passed_left_subtree = passed_indices[lincomb_values <= split]
-            passed_right_subtree = passed_indices[lincomb_values > split]
-            left, right = self._children(node_index)
-            self._apply_node(X, leaf_indices, predictions, left, passed_left_subtree)
-            self._apply_node(X, leaf_indices, predictions, right, passed_right_subtree)
+                                                   lincomb_features=self.lincomb_features[node],
+                                                   lincomb_coefficients=self.lincomb_coefficients[node])
+            passed_left_subtree = passed_indices[lincomb_values <= self.threshold[node]]
+            passed_right_subtree = passed_indices[lincomb_values > self.threshold[node]]
+            self._apply_node(X, leaf_indices, self.children_left[node], passed_left_subtree)
+            self._apply_node(X, leaf_indices, self.children_right[node], passed_right_subtree)
+
+    def _split_to_right(self, flat_X, offsets, nodes):
+        # combination of its node is computed for each event, features and coefficients are gathered
+        lincomb_values = numpy.zeros(len(nodes))
+        for features, coefficients in zip(self.lincomb_features.T, self.lincomb_coefficients.T):
+            lincomb_values += flat_X.take(offsets + features.take(nodes)) * coefficients.take(nodes)
+        return lincomb_values > self.threshold.take(nodes)
+
+
+class FastObliviousTreeRegressor(FastTreeRegressor):
+    supports_feature_orders = False
+    supports_histograms = False
+
+    def __init__(self,
+                 max_depth=5,
+                 max_features=None,
+                 max_events_used=1000,
+                 criterion='mse',
+                 random_state=None):
+        """
+        Oblivious (symmetric) tree: all nodes of the same depth share one split (feature, threshold),
+        so the index of leaf is bit-packed from results of depth comparisons,
+        first level gives the most significant bit.
+        After fitting feature and threshold are arrays of length depth, value is table of 2 ** depth leaves.
+
+        Split of level is chosen to minimize sum of criterion over nodes of level,
+        max_events_used events (taken randomly on each level) are used in search.
+        """
+        FastTreeRegressor.__init__(self,
+                                   max_depth=max_depth,
+                                   max_features=max_features,
+                                   max_events_used=max_events_used,
+                                   criterion=criterion,
+                                   random_state=random_state)
+
+    def _compute_level_best_split(self, X, y, w, selected_events, node_indices, n_nodes):
+        """Returns (feature, threshold) minimizing total cost over nodes of level, or None if no split is possible"""
+        statistics = self._criterion.compute_statistics(y[selected_events], w[selected_events])
+        # statistics of each event is put in the row of its node, [n_statistics, n_nodes, n_events]
+        node_statistics = numpy.zeros([len(statistics), n_nodes, len(selected_events)])
+        node_statistics[:, node_indices[selected_events], numpy.arange(len(selected_events))] = statistics
+
+        best_cost, best_split = numpy.inf, None
+        selected_features = self.random_state.choice(self.n_features, size=self._n_used_features, replace=False)
+        for feature in selected_features:
+            values = X[selected_events, feature]
+            order = numpy.argsort(values)
+            values = values[order]
+            left = numpy.cumsum(node_statistics[:, :, order], axis=2)
+            right = left[:, :, -1:] - left
+            # empty parts of nodes are regularized, so they don't contribute to the total cost
+            costs = self._criterion.compute_costs_from_sums(left + 1e-20, right + 1e-20).sum(axis=0)
+            possible = numpy.flatnonzero(values[1:] > values[:-1])
+            if len(possible) == 0:
+                continue
+            position = possible[numpy.argmin(costs[possible])]
+            if costs[position] < best_cost:
+                best_cost = costs[position]
+                best_split = feature, (values[position] + values[position + 1]) / 2.
+        return best_split
+
+    def fit(self, X, y, sample_weight, check_input=True, feature_orders=None, bin_edges=None):
+        if check_input:
+            assert isinstance(X, numpy.ndarray), "X should be numpy.array"
+            assert isinstance(y, numpy.ndarray), "y should be numpy.array"
+            assert isinstance(sample_weight, numpy.ndarray), "sample_weight should be numpy.array"
+            assert len(X) == len(y) == len(sample_weight), 'Size of arrays is different'
+        assert feature_orders is None and bin_edges is None, \
+            'feature_orders and binned data are not supported by ' + self.__class__.__name__
+        assert hasattr(criterions[self.criterion], 'compute_costs_from_sums'), \
+            'criterion {} is not supported by oblivious tree'.format(self.criterion)
+        self.n_features = X.shape[1]
+        if self.max_features is None:
+            self._n_used_features = self.n_features
+        else:
+            self._n_used_features = min(self.n_features, self.max_features)
+        self._criterion = criterions[self.criterion]
+        self.random_state = check_random_state(self.random_state)
+
+        features, thresholds = [], []
+        node_indices = numpy.zeros(len(X), dtype=int)
+        node_values = numpy.array([numpy.average(y, weights=sample_weight)])
+        for depth in range(self.max_depth):
+            selected_events = numpy.arange(len(X))
+            if len(X) > self.max_events_used:
+                selected_events = self.random_state.choice(len(X), size=self.max_events_used, replace=False)
+            split = self._compute_level_best_split(X, y, sample_weight, selected_events, node_indices,
+                                                   n_nodes=2 ** depth)
+            if split is None:
+                break
+            feature, threshold = split
+            features.append(feature)
+            thresholds.append(threshold)
+            node_indices = 2 * node_indices + (X[:, feature] > threshold)
+            # empty nodes inherit value of parent
+            n_nodes = 2 ** (depth + 1)
+            weights = numpy.bincount(node_indices, weights=sample_weight, minlength=n_nodes)
+            sums = numpy.bincount(node_indices, weights=sample_weight * y, minlength=n_nodes)
+            node_values = numpy.where(weights > 0, sums / numpy.maximum(weights, 1e-20), numpy.repeat(node_values, 2))
+
+        self.feature = numpy.array(features, dtype=int)
+        self.threshold = numpy.array(thresholds, dtype=float)
+        self.value = node_values
+        self.depth = len(features)
+        # weights of bits in index of leaf
+        self._bit_weights = 2 ** numpy.arange(self.depth)[::-1]
+        return self
+
+    def print_tree_stats(self):
+        print(self.depth, ' levels in tree')
+        print(self.node_count, ' leaf nodes in tree')
+
+    def print_tree(self, node=0, prefix=''):
+        for feature, threshold in zip(self.feature, self.threshold):
+            print(prefix, (feature, threshold))
+        print(prefix, self.value)
+
+    def apply(self, X):
+        """For each event returns the index of leaf and prediction"""
+        assert isinstance(X, numpy.ndarray), 'X should be numpy.array'
+        leaf_indices = numpy.dot(X[:, self.feature] > self.threshold, self._bit_weights)
+        return leaf_indices, self.value.take(leaf_indices)
+
+
+def predict_oblivious_ensemble(trees, X, tree_weights=None):
+    """
+    Computes sum of predictions of oblivious trees, all trees are evaluated together:
+    comparisons of all levels of all trees are done at once, leaf indices are bit-packed
+    and predictions are taken from concatenated table of leaves.
+    :type trees: list[FastObliviousTreeRegressor]
+    :param X: numpy.array of shape [n_samples, n_features]
+    :param tree_weights: optional weights of trees (i.e. learning rate in boosting)
+    :return: numpy.array of shape [n_samples]
+    """
+    if len(trees) == 0:
+        return numpy.zeros(len(X))
+    if tree_weights is None:
+        tree_weights = numpy.ones(len(trees))
+    max_depth = max(tree.depth for tree in trees)
+    # trees are padded to the same depth with never passed comparisons in the least significant bits,
+    # tables of leaves are repeated correspondingly
+    features = numpy.zeros([len(trees), max_depth], dtype=int)
+    thresholds = numpy.zeros([len(trees), max_depth]) + numpy.inf
+    leaf_values = numpy.zeros([len(trees), 2 ** max_depth])
+    for i, (tree, weight) in enumerate(zip(trees, tree_weights)):
+        features[i, :tree.depth] = tree.feature
+        thresholds[i, :tree.depth] = tree.threshold
+        leaf_values[i] = numpy.repeat(tree.value * weight, 2 ** (max_depth - tree.depth))
 
+    bits = X[:, features.ravel()] > thresholds.ravel()
+    leaf_indices = numpy.dot(bits.reshape([len(X), len(trees), max_depth]), 2 ** numpy.arange(max_depth)[::-1])
+    leaf_indices += numpy.arange(len(trees)) * 2 ** max_depth
+    return leaf_values.ravel().take(leaf_indices).sum(axis=1)
@@ -449,9 +449,9 @@ class NewFlatnessLossFunction(KnnFlatnessLossFunction):
 
         y_signed = self.y_signed
         if self.keep_debug_info:
-            self.debug_dict['pred'].append(numpy.copy(y_pred))
-            self.debug_dict['fl_grad'].append(numpy.copy(neg_gradient))
-            self.debug_dict['ada_grad'].append(y_signed * sample_weight * numpy.exp(- y_signed * y_pred))
+            self.debug_dict.record('pred', y_pred)
+            self.debug_dict.record('fl_grad', neg_gradient)
+            self.debug_dict.record('ada_grad', y_signed * sample_weight * numpy.exp(- y_signed * y_pred))
 
         # adding ada
         neg_gradient += self.ada_coefficient * y_signed * sample_weight \
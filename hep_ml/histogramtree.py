@@ -0,0 +1,273 @@
+"""
+Regression tree which finds splits from histograms of binned features.
+
+Features are quantized once (``BinQuantizer``) into at most 256 bins stored as uint8,
+after this the cost of finding split in node is proportional to the number of bins,
+not to the number of unique values of features. Histogram of one of children is computed
+from events, histogram of the other is obtained by subtraction from parent's histogram.
+
+Fitted tree keeps sklearn-like arrays (``feature``, ``threshold``, ``children_left``,
+``children_right``, ``value``) and has ``apply``, so losses can update leaves in the same way
+as in sklearn trees.
+"""
+from __future__ import division, print_function, absolute_import
+
+from multiprocessing.pool import ThreadPool
+import numpy
+from sklearn.base import BaseEstimator, RegressorMixin
+from sklearn.utils.validation import check_random_state
+
+__author__ = 'Alex Rogozhnikov'
+
+TREE_LEAF = -1
+
+
+def _compute_n_used_features(max_features, n_features):
+    """Number of features tested in each node, max_features is interpreted as in sklearn trees:
+    None, 'auto', 'sqrt', 'log2', int (number of features) or float (fraction of features)"""
+    if max_features is None:
+        return n_features
+    if max_features in ['auto', 'sqrt']:
+        n_used = int(numpy.sqrt(n_features))
+    elif max_features == 'log2':
+        n_used = int(numpy.log2(n_features))
+    elif isinstance(max_features, (int, numpy.integer)):
+        assert max_features > 0, 'max_features should be positive'
+        n_used = max_features
+    elif isinstance(max_features, float):
+        assert 0. < max_features <= 1., 'float max_features should be in (0, 1]'
+        n_used = int(max_features * n_features)
+    else:
+        raise ValueError('Unknown max_features: {}'.format(max_features))
+    return min(n_features, max(1, n_used))
+
+
+class BinQuantizer(BaseEstimator):
+    def __init__(self, max_bins=256, max_events_used=200000, random_state=None):
+        """Transforms features to uint8 indices of bins, bins are computed from percentiles.
+        :param int max_bins: maximal number of bins for each feature, not greater than 256
+        :param int max_events_used: number of events used to compute percentiles
+        """
+        self.max_bins = max_bins
+        self.max_events_used = max_events_used
+        self.random_state = random_state
+
+    def fit(self, X):
+        assert 2 <= self.max_bins <= 256, 'max_bins should be in [2, 256]'
+        X = numpy.asarray(X, dtype=float)
+        if len(X) > self.max_events_used:
+            random_state = check_random_state(self.random_state)
+            X = X[random_state.choice(len(X), size=self.max_events_used, replace=False)]
+        # bin_edges[feature] is sorted array, event x belongs to bin searchsorted(edges, x),
+        # so x <= edges[i]  <=>  bin_index <= i. NaN gets into the last bin, so it always goes right
+        self.bin_edges = []
+        for column in X.T:
+            column = column[~numpy.isnan(column)]
+            values = numpy.unique(column)
+            if len(values) <= self.max_bins:
+                edges = (values[1:] + values[:-1]) / 2.
+            else:
+                edges = numpy.percentile(column, numpy.linspace(0, 100, self.max_bins + 1)[1:-1])
+                edges = numpy.unique(edges)
+            self.bin_edges.append(edges)
+        return self
+
+    def transform(self, X):
+        X = numpy.asarray(X, dtype=float)
+        assert X.shape[1] == len(self.bin_edges), 'Wrong number of features'
+        result = numpy.zeros(X.shape, dtype=numpy.uint8)
+        for feature, edges in enumerate(self.bin_edges):
+            result[:, feature] = numpy.searchsorted(edges, X[:, feature])
+        return result
+
+
+class HistogramTreeRegressor(BaseEstimator, RegressorMixin):
+    def __init__(self, max_depth=3, min_samples_split=2, min_samples_leaf=1, max_features=None,
+                 criterion='mse', random_state=None, n_threads=1):
+        """Regression tree trained on binned data.
+        :param criterion: 'mse' or 'friedman_mse'
+        :param int n_threads: number of threads, histograms of different features are computed in parallel
+        """
+        self.max_depth = max_depth
+        self.min_samples_split = min_samples_split
+        self.min_samples_leaf = min_samples_leaf
+        self.max_features = max_features
+        self.criterion = criterion
+        self.random_state = random_state
+        self.n_threads = n_threads
+
+    def _compute_features_histograms(self, X_binned, y, w, indices, features):
+        """Returns array [3, n_selected_features, n_bins] with sum of w * y, sum of w and number of events in bins"""
+        n_features = features.stop - features.start
+        codes = (X_binned[indices, features] + self._feature_offsets[:n_features]).ravel()
+        length = n_features * self._n_bins
+        result = numpy.zeros([3, length], dtype=float)
+        weights = w[indices]
+        result[0] = numpy.bincount(codes, weights=numpy.repeat(y[indices] * weights, n_features), minlength=length)
+        result[1] = numpy.bincount(codes, weights=numpy.repeat(weights, n_features), minlength=length)
+        result[2] = numpy.bincount(codes, minlength=length)
+        return result.reshape([3, n_features, self._n_bins])
+
+    def _compute_histograms(self, X_binned, y, w, indices):
+        """Returns array [3, n_features, n_bins], features are split into groups processed by different threads"""
+        if self._pool is None:
+            return self._compute_features_histograms(X_binned, y, w, indices, slice(0, self._n_features))
+        results = self._pool.map(lambda features: self._compute_features_histograms(X_binned, y, w, indices, features),
+                                 self._feature_groups)
+        return numpy.concatenate(results, axis=1)
+
+    def _compute_best_split(self, histograms):
+        """Returns (feature, bin_threshold), or None if split is impossible"""
+        left = numpy.cumsum(histograms, axis=2)[:, :, :-1]
+        total = histograms.sum(axis=2)[:, :, numpy.newaxis]
+        right = total - left
+        left_sum, left_weight, left_count = left
+        right_sum, right_weight, right_count = right
+        if self.criterion == 'mse':
+            costs = - (left_sum ** 2 / (left_weight + 1e-20) + right_sum ** 2 / (right_weight + 1e-20))
+        elif self.criterion == 'friedman_mse':
+            diff = left_sum / (left_weight + 1e-20) - right_sum / (right_weight + 1e-20)
+            costs = - left_weight * right_weight * diff ** 2
+        else:
+            raise ValueError('Unknown criterion: ' + str(self.criterion))
+
+        possible = (left_count >= self.min_samples_leaf) & (right_count >= self.min_samples_leaf)
+        if self._n_used_features < self._n_features:
+            selected_features = self.random_state.choice(self._n_features, size=self._n_used_features,
+                                                         replace=False)
+            feature_mask = numpy.zeros(self._n_features, dtype=bool)
+            feature_mask[selected_features] = True
+            possible &= feature_mask[:, numpy.newaxis]
+        if not numpy.any(possible):
+            return None
+        costs[~possible] = numpy.inf
+        feature, bin_threshold = numpy.unravel_index(numpy.argmin(costs), costs.shape)
+        return feature, bin_threshold
+
+    def _add_node(self, value):
+        self._features.append(0)
+        self._thresholds.append(0.)
+        self._bin_thresholds.append(0)
+        self._children_left.append(TREE_LEAF)
+        self._children_right.append(TREE_LEAF)
+        self._values.append(value)
+        self._improvements.append(0.)
+        return len(self._values) - 1
+
+    def _fit_tree_node(self, X_binned, y, w, passed_indices, histograms, depth):
+        """Recursive function to fit tree, returns the index of created node"""
+        sum_wy, sum_w, _ = histograms[:, 0, :].sum(axis=1)
+        node = self._add_node(sum_wy / (sum_w + 1e-20))
+        self._depth = max(self._depth, depth)
+        if self.max_depth is not None and depth >= self.max_depth:
+            return node
+        if len(passed_indices) < max(self.min_samples_split, 2 * self.min_samples_leaf):
+            return node
+        split = self._compute_best_split(histograms)
+        if split is None:
+            return node
+        feature, bin_threshold = split
+        to_left = X_binned[passed_indices, feature] <= bin_threshold
+        left_indices = passed_indices[to_left]
+        right_indices = passed_indices[~to_left]
+        # histogram is computed only for smaller child
+        if len(left_indices) <= len(right_indices):
+            left_histograms = self._compute_histograms(X_binned, y, w, left_indices)
+            right_histograms = histograms - left_histograms
+        else:
+            right_histograms = self._compute_histograms(X_binned, y, w, right_indices)
+            left_histograms = histograms - right_histograms
+
+        self._features[node] = feature
+        self._bin_thresholds[node] = bin_threshold
+        self._thresholds[node] = self.bin_edges[feature][bin_threshold]
+        self._improvements[node] = \
+            _node_cost(left_histograms) + _node_cost(right_histograms) - _node_cost(histograms)
+        self._children_left[node] = self._fit_tree_node(X_binned, y, w, left_indices, left_histograms, depth + 1)
+        self._children_right[node] = self._fit_tree_node(X_binned, y, w, right_indices, right_histograms, depth + 1)
+        return node
+
+    def fit(self, X_binned, y, sample_weight, bin_edges, pool=None):
+        """
+        :param X_binned: numpy.array of shape [n_samples, n_features] with dtype uint8, quantized data
+        :param bin_edges: list with edges for each feature, as computed by BinQuantizer
+        :param pool: optional ThreadPool used when n_threads > 1 (not terminated after fit),
+            so that many trees can reuse the same threads. If None, pool is created for this fit
+        """
+        assert X_binned.dtype == numpy.uint8, 'data should be binned'
+        assert len(X_binned) == len(y) == len(sample_weight), 'Size of arrays is different'
+        assert self.min_samples_leaf >= 1, 'min_samples_leaf should be positive'
+        self.random_state = check_random_state(self.random_state)
+        self.bin_edges = bin_edges
+        self._n_features = X_binned.shape[1]
+        self._n_used_features = _compute_n_used_features(self.max_features, self._n_features)
+        self._n_bins = max(len(edges) for edges in bin_edges) + 1
+        self._feature_offsets = numpy.arange(self._n_features) * self._n_bins
+
+        self._features, self._thresholds, self._bin_thresholds = [], [], []
+        self._children_left, self._children_right, self._values, self._improvements = [], [], [], []
+        self._depth = 0
+        indices = numpy.arange(len(X_binned))
+        self._pool = None
+        own_pool = False
+        if self.n_threads > 1:
+            group_limits = numpy.linspace(0, self._n_features, min(self.n_threads, self._n_features) + 1).astype(int)
+            self._feature_groups = [slice(start, stop) for start, stop in zip(group_limits[:-1], group_limits[1:])]
+            own_pool = pool is None
+            self._pool = ThreadPool(self.n_threads) if own_pool else pool
+        try:
+            root_histograms = self._compute_histograms(X_binned, y, sample_weight, indices)
+            self._fit_tree_node(X_binned, y, sample_weight, indices, root_histograms, depth=0)
+        finally:
+            if own_pool:
+                self._pool.terminate()
+            self._pool = None
+
+        self.feature = numpy.array(self._features, dtype=int)
+        self.threshold = numpy.array(self._thresholds, dtype=float)
+        self.bin_threshold = numpy.array(self._bin_thresholds, dtype=numpy.uint8)
+        self.children_left = numpy.array(self._children_left, dtype=int)
+        self.children_right = numpy.array(self._children_right, dtype=int)
+        # the same shape as in sklearn trees: [n_nodes, n_outputs, max_n_classes]
+        self.value = numpy.array(self._values, dtype=float).reshape([-1, 1, 1])
+        importances = numpy.bincount(self.feature, weights=self._improvements, minlength=self._n_features)
+        self.feature_importances_ = importances / max(numpy.sum(importances), 1e-20)
+        del self._features, self._thresholds, self._bin_thresholds
+        del self._children_left, self._children_right, self._values, self._improvements
+        return self
+
+    @property
+    def tree_(self):
+        # leaves are updated by losses through this
+        return self
+
+    @property
+    def node_count(self):
+        return len(self.feature)
+
+    def _apply(self, X, threshold):
+        leaves = numpy.zeros(len(X), dtype=int)
+        rows = numpy.arange(len(X))
+        for _ in range(self._depth):
+            # NaN goes right, as in binned data (and in sklearn trees)
+            to_right = ~(X[rows, self.feature[leaves]] <= threshold[leaves])
+            children = numpy.where(to_right, self.children_right[leaves], self.children_left[leaves])
+            leaves = numpy.where(children == TREE_LEAF, leaves, children)
+        return leaves
+
+    def apply(self, X):
+        """For each event returns the index of leaf"""
+        return self._apply(numpy.asarray(X), self.threshold)
+
+    def apply_binned(self, X_binned):
+        """The same as apply, but takes binned data"""
+        return self._apply(X_binned, self.bin_threshold)
+
+    def predict(self, X):
+        return self.value[self.apply(X), 0, 0]
+
+
+def _node_cost(histograms):
+    """minus mse improvement of node, up to constant"""
+    sum_wy, sum_w, _ = histograms[:, 0, :].sum(axis=1)
+    return sum_wy ** 2 / (sum_w + 1e-20)
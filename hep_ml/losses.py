@@ -9,11 +9,11 @@ import numpy
 import pandas
 from scipy import sparse
 from scipy.special import expit
-from collections import defaultdict
 from sklearn.utils.validation import check_random_state
 from sklearn.base import BaseEstimator
 
-from .commonutils import computeSignalKnnIndices, indices_of_values, check_sample_weight, check_uniform_label
+from .commonutils import computeSignalKnnIndices, indices_of_values, check_sample_weight, check_uniform_label, \
+    DebugRecorder
 from .metrics_utils import bin_to_group_indices, compute_group_weights, compute_bin_indices
 
 __author__ = 'Alex Rogozhnikov'
@@ -30,6 +30,9 @@ def compute_positions(y_pred, sample_weight):
 
 
 class AbstractLossFunction(BaseEstimator):
+    # False if __call__ doesn't compute the value of loss, then it can't be used as a validation score
+    computes_value = True
+
     def fit(self, X, y, sample_weight):
         """ This method is optional, it is called before all the others."""
         pass
@@ -44,13 +47,16 @@ class AbstractLossFunction(BaseEstimator):
         moreover, the order should be the same"""
         raise NotImplementedError()
 
-    def update_tree(self, tree, X, y, y_pred, sample_weight, update_mask, residual):
+    def update_tree(self, tree, X, y, y_pred, sample_weight, update_mask, residual, terminal_regions=None):
         """This method may be not called at all, so it shouldn't
         modify y_pred (unlike LossFunction from sklearn),
-        y_pred will be recomputed outside after updating the tree"""
+        y_pred will be recomputed outside after updating the tree
+        :param terminal_regions: optional array with indices of leaves for events from X,
+            if passed, tree isn't applied to X once more"""
 
         # compute leaf for each sample in ``X``.
-        terminal_regions = tree.apply(X)
+        if terminal_regions is None:
+            terminal_regions = tree.apply(X)
 
         # mask all which are not in sample mask.
         masked_terminal_regions = terminal_regions.copy()
@@ -79,8 +85,8 @@ class AbstractLossFunction(BaseEstimator):
             new_value = self.update_tree_leaf(
                 leaf=leaf, indices_in_leaf=indices_in_leaf, X=X, y=y, y_pred=y_pred,
                 sample_weight=sample_weight, update_mask=update_mask, residual=residual)
-            assert len(fast_tree.nodes_data[leaf]) == 1
-            fast_tree.nodes_data[leaf] = (new_value, )
+            # apply returns indices of leaves only
+            fast_tree.value[leaf] = new_value
 
     def update_tree_leaf(self, leaf, indices_in_leaf,
                          X, y, y_pred, sample_weight, update_mask, residual):
@@ -226,9 +232,10 @@ class AbstractMatrixLossFunction(AbstractLossFunction):
         """This method should be overloaded in descendant, and should return A, w (matrix and vector)"""
         raise NotImplementedError()
 
-    def update_tree(self, tree, X, y, y_pred, sample_weight, update_mask, residual):
+    def update_tree(self, tree, X, y, y_pred, sample_weight, update_mask, residual, terminal_regions=None):
         self.update_exponents = self.w * numpy.exp(- self.A.dot(self.y_signed * y_pred))
-        AbstractLossFunction.update_tree(self, tree, X, y, y_pred, sample_weight, update_mask, residual)
+        AbstractLossFunction.update_tree(self, tree, X, y, y_pred, sample_weight, update_mask, residual,
+                                         terminal_regions=terminal_regions)
 
     def update_tree_leaf(self, leaf, indices_in_leaf, X, y, y_pred, sample_weight, update_mask, residual):
         terminal_region = numpy.zeros(len(X), dtype=float)
@@ -304,6 +311,8 @@ def exp_margin(margin):
 
 
 class AbstractFlatnessLossFunction(AbstractLossFunction):
+    computes_value = False
+
     def __init__(self, uniform_variables, uniform_label=1, power=2., ada_coefficient=1.,
                  allow_wrong_signs=True, use_median=False,
                  keep_debug_info=False):
@@ -319,6 +328,7 @@ class AbstractFlatnessLossFunction(AbstractLossFunction):
             the less we tend to uniformity.
         :type allow_wrong_signs: defines whether gradient may different sign from the "sign of class"
             (i.e. may have negative gradient on signal)
+        :type keep_debug_info: bool | DebugRecorder, if not False, predictions and gradients are saved to debug_dict
         """
         self.uniform_variables = uniform_variables
         if isinstance(uniform_label, numbers.Number):
@@ -356,7 +366,7 @@ class AbstractFlatnessLossFunction(AbstractLossFunction):
         self.divided_weight = sample_weight / numpy.maximum(occurences, 1)
 
         if self.keep_debug_info:
-            self.debug_dict = defaultdict(list)
+            self.debug_dict = DebugRecorder.create(self.keep_debug_info)
         return self
 
     def compute_groups_indices(self, X, y, label):
@@ -392,9 +402,9 @@ class AbstractFlatnessLossFunction(AbstractLossFunction):
 
         y_signed = self.y_signed
         if self.keep_debug_info:
-            self.debug_dict['pred'].append(numpy.copy(y_pred))
-            self.debug_dict['fl_grad'].append(numpy.copy(neg_gradient))
-            self.debug_dict['ada_grad'].append(y_signed * self.sample_weight * exp_margin(-y_signed * y_pred))
+            self.debug_dict.record('pred', y_pred)
+            self.debug_dict.record('fl_grad', neg_gradient)
+            self.debug_dict.record('ada_grad', y_signed * self.sample_weight * exp_margin(-y_signed * y_pred))
 
         # adding ada
         neg_gradient += self.ada_coefficient * y_signed * self.sample_weight * exp_margin(-y_signed * y_pred)
@@ -9,7 +9,7 @@ import numpy
 import sklearn
 from sklearn.tree.tree import DecisionTreeClassifier
 
-from .commonutils import computeKnnIndicesOfSameClass, check_uniform_label
+from .commonutils import computeKnnIndicesOfSameClass, check_uniform_label, TrainingProfiler
 from .supplementaryclassifiers import AbstractBoostingClassifier
 
 
@@ -28,7 +28,8 @@ class MeanAdaBoostClassifier(AbstractBoostingClassifier):
                  n_neighbours=10,
                  uniform_label=1,
                  train_variables=None,
-                 voting='mean'):
+                 voting='mean',
+                 profile=False):
         """
         Modification of AdaBoostClassifier, has modified reweighting procedure
         (as described in article 'New Approaches for Boosting to Uniformity').
@@ -47,6 +48,8 @@ class MeanAdaBoostClassifier(AbstractBoostingClassifier):
             'mean', 'median', 'random-percentile', 'random-mean', 'matrix'
             (in the 'matrix' case one should also provide a matrix to fit method.
             Matrix is generalization of )
+        :param profile: bool or TrainingProfiler, if True, time spent in phases of each stage
+            is measured and saved to self.profiling_info (pandas.DataFrame)
         """
         self.uniform_variables = uniform_variables
         self.base_estimator = base_estimator
@@ -56,6 +59,7 @@ class MeanAdaBoostClassifier(AbstractBoostingClassifier):
         self.uniform_label = uniform_label
         self.train_variables = train_variables
         self.voting = voting
+        self.profile = profile
 
     def fit(self, X, y, sample_weight=None, A=None):
         if self.voting == 'matrix':
@@ -65,8 +69,10 @@ class MeanAdaBoostClassifier(AbstractBoostingClassifier):
         self.uniform_label = check_uniform_label(self.uniform_label)
         X, y, sample_weight = self.check_input(X, y, sample_weight)
         y_signed = 2 * y - 1
+        profiler = TrainingProfiler.create(self.profile)
 
-        knn_indices = computeKnnIndicesOfSameClass(self.uniform_variables, X, y, self.n_neighbours)
+        with profiler.phase('neighbours'):
+            knn_indices = computeKnnIndicesOfSameClass(self.uniform_variables, X, y, self.n_neighbours)
 
         # for those events with non-uniform label we repeat it's own index several times
         for label in [0, 1]:
@@ -78,31 +84,36 @@ class MeanAdaBoostClassifier(AbstractBoostingClassifier):
         self.estimators = []
 
         for stage in range(self.n_estimators):
-            knn_scores = numpy.take(cumulative_score, knn_indices)
-            if self.voting == 'mean':
-                voted_score = numpy.mean(knn_scores, axis=1)
-            elif self.voting == 'median':
-                voted_score = numpy.median(knn_scores, axis=1)
-            elif self.voting == 'random-percentile':
-                voted_score = numpy.percentile(knn_scores, numpy.random.random(), axis=1)
-            elif self.voting == 'random-mean':
-                n_feats = numpy.random.randint(self.n_neighbours//2, self.n_neighbours)
-                voted_score = numpy.mean(knn_scores[:, :n_feats], axis=1)
-            elif self.voting == 'matrix':
-                voted_score = A.dot(cumulative_score)
-            else:  # self.voting is callable
-                assert not isinstance(self.voting, str), \
-                    'unknown value for voting: {}'.format(self.voting)
-                voted_score = self.voting(cumulative_score, knn_scores)
-
-            weight = sample_weight * numpy.exp(- y_signed * voted_score)
-            weight = self.normalize_weights(y=y, sample_weight=weight)
-
-            classifier = sklearn.clone(self.base_estimator)
-            classifier.fit(X, y, sample_weight=weight)
-            cumulative_score += self.learning_rate * self.compute_score(classifier, X=X)
+            profiler.start_stage(stage)
+            with profiler.phase('voting'):
+                knn_scores = numpy.take(cumulative_score, knn_indices)
+                if self.voting == 'mean':
+                    voted_score = numpy.mean(knn_scores, axis=1)
+                elif self.voting == 'median':
+                    voted_score = numpy.median(knn_scores, axis=1)
+                elif self.voting == 'random-percentile':
+                    voted_score = numpy.percentile(knn_scores, numpy.random.random(), axis=1)
+                elif self.voting == 'random-mean':
+                    n_feats = numpy.random.randint(self.n_neighbours//2, self.n_neighbours)
+                    voted_score = numpy.mean(knn_scores[:, :n_feats], axis=1)
+                elif self.voting == 'matrix':
+                    voted_score = A.dot(cumulative_score)
+                else:  # self.voting is callable
+                    assert not isinstance(self.voting, str), \
+                        'unknown value for voting: {}'.format(self.voting)
+                    voted_score = self.voting(cumulative_score, knn_scores)
+
+                weight = sample_weight * numpy.exp(- y_signed * voted_score)
+                weight = self.normalize_weights(y=y, sample_weight=weight)
+
+            with profiler.phase('fit_tree'):
+                classifier = sklearn.clone(self.base_estimator)
+                classifier.fit(X, y, sample_weight=weight)
+            with profiler.phase('predict'):
+                cumulative_score += self.learning_rate * self.compute_score(classifier, X=X)
             self.estimators.append(classifier)
 
+        self.profiling_info = profiler.finish()
         return self
 
     @staticmethod
@@ -10,7 +10,6 @@ import pandas
 from sklearn.base import BaseEstimator
 from sklearn.neighbors.unsupervised import NearestNeighbors
 from sklearn.utils.validation import column_or_1d, check_arrays
-from sklearn.metrics import roc_curve
 
 from .commonutils import check_sample_weight, computeSignalKnnIndices
 from . import metrics_utils as ut
@@ -43,6 +42,78 @@ background rejection = background efficiency (physicists don't agree with the la
 # region Quality metrics
 
 
+class CutScan(object):
+    def __init__(self, y_true, y_score, sample_weight=None):
+        """
+        Scan over all possible cuts on y_score: the predictions are sorted only once,
+        and all figures of merit (ROC curve, AUC, sensitivity, AMS, efficiencies at given cuts)
+        are computed from the same cumulative sums of weights.
+        Event passes the cut if y_score > cut.
+
+        :param y_true: array-like of shape [n_samples] with labels of samples (0 or 1)
+        :param y_score: array-like of shape [n_samples] with predictions (float)
+        :param sample_weight: None or array-like of shape [n_samples]
+
+        Example of usage:
+        >>> scan = CutScan(y, proba[:, 1], sample_weight=weights)
+        >>> fpr, tpr, thresholds = scan.roc_curve()
+        >>> print(scan.auc(), scan.optimal_sensitivity())
+        """
+        y_true, y_score, sample_weight = \
+            ut.check_metrics_arguments(y_true, y_score, sample_weight=sample_weight, two_class=True, binary_pred=False)
+        y_true = numpy.array(y_true, dtype=float)
+        y_score = numpy.array(y_score, dtype=float)
+        order = numpy.argsort(y_score, kind='mergesort')[::-1]
+        y_score = y_score[order]
+        sig_weight = (y_true * sample_weight)[order]
+        bck_weight = ((1 - y_true) * sample_weight)[order]
+
+        # the last position of each group of equal predictions
+        last_positions = numpy.append(numpy.nonzero(numpy.diff(y_score))[0], len(y_score) - 1)
+        # cuts are descending, the first cut rejects all events
+        self.thresholds = numpy.append(y_score[0] + 1, y_score[last_positions])
+        self.s = numpy.append(0., numpy.cumsum(sig_weight)[last_positions])
+        self.b = numpy.append(0., numpy.cumsum(bck_weight)[last_positions])
+        self.total_s = self.s[-1]
+        self.total_b = self.b[-1]
+        # tpr = signal efficiency, fpr = background efficiency
+        self.tpr = self.s / self.total_s
+        self.fpr = self.b / self.total_b
+
+    def roc_curve(self):
+        """The same as sklearn.metrics.roc_curve
+        :return: fpr, tpr, thresholds - parallel arrays with equal lengths"""
+        return self.fpr, self.tpr, self.thresholds
+
+    def auc(self):
+        """Area under ROC curve, the same as sklearn.metrics.roc_auc_score"""
+        return numpy.sum(numpy.diff(self.fpr) * (self.tpr[1:] + self.tpr[:-1])) / 2.
+
+    def sensitivity(self):
+        """s / sqrt(s + b) for each cut, s and b are normalized to be in [0, 1]"""
+        return self.tpr / numpy.sqrt(self.tpr + self.fpr + 1e-6)
+
+    def optimal_sensitivity(self):
+        return numpy.max(self.sensitivity())
+
+    def ams(self, expected_s, expected_b, br=10.):
+        """Approximate median significance for each cut,
+        weights of signal and background are normalized to expected_s, expected_b"""
+        s = self.tpr * expected_s
+        b = self.fpr * expected_b
+        radicands = 2 * ((s + b + br) * numpy.log(1.0 + s / (b + br)) - s)
+        return numpy.sqrt(numpy.clip(radicands, 0, numpy.inf))
+
+    def efficiencies_at_cuts(self, cuts):
+        """
+        :param cuts: float or array-like with cuts
+        :return: tpr, fpr - parts of signal and background with y_score > cut
+        """
+        # number of thresholds (except the first) greater than cut
+        positions = numpy.searchsorted(- self.thresholds[1:], - numpy.array(cuts), side='left')
+        return self.tpr[positions], self.fpr[positions]
+
+
 def roc_curve_splitted(data1, data2, sample_weight1=None, sample_weight2=None):
     """Does exactly the same as sklearn.metrics.roc_curve,
     but for signal/background predictions kept in different arrays.
@@ -50,20 +121,20 @@ def roc_curve_splitted(data1, data2, sample_weight1=None, sample_weight2=None):
     Returns: tpr, fpr, thresholds, these are parallel arrays with equal lengths.
     """
     sample_weight1 = check_sample_weight(data1, sample_weight=sample_weight1)
-    sample_weight2 = check_sample_weight(data1, sample_weight=sample_weight2)
+    sample_weight2 = check_sample_weight(data2, sample_weight=sample_weight2)
     data = numpy.concatenate([data1, data2])
     sample_weight = numpy.concatenate([sample_weight1, sample_weight2])
     labels = numpy.concatenate([numpy.zeros(len(data1)), numpy.ones(len(data2))])
-    return roc_curve(labels, data, sample_weight=sample_weight)
+    return CutScan(labels, data, sample_weight=sample_weight).roc_curve()
 
 
 def compute_sb(y_true, y_pred, sample_weight):
     """Here the passed arguments should be already checked, y_pred is array of 0 and 1"""
-    total_s = numpy.sum(sample_weight[y_true > 0.5])
-    total_b = numpy.sum(sample_weight[y_true < 0.5])
-    s = sample_weight[y_true * y_pred > 0.5].sum()
-    b = sample_weight[(1 - y_true) * y_pred > 0.5].sum()
-    return s / total_s, b / total_b
+    sig_weight = y_true * sample_weight
+    bck_weight = sample_weight - sig_weight
+    s = numpy.dot(sig_weight, y_pred)
+    b = numpy.dot(bck_weight, y_pred)
+    return s / numpy.sum(sig_weight), b / numpy.sum(bck_weight)
 
 
 def efficiency_score(y_true, y_pred, sample_weight=None):
@@ -102,10 +173,7 @@ def sensitivity(y_true, y_score, sample_weight=None):
 
 def optimal_sensitivity(y_true, y_score, sample_weight=None):
     """s,b are normalized to be in [0,1] """
-    from sklearn.metrics import roc_curve
-
-    b, s, _ = roc_curve(y_true, y_score, sample_weight=sample_weight)
-    return numpy.max(s / numpy.sqrt(s + b + 1e-6))
+    return CutScan(y_true, y_score, sample_weight=sample_weight).optimal_sensitivity()
 
 
 # endregion
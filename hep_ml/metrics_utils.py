@@ -61,6 +61,41 @@ are typically computed only for events of some particular class.
 """
 
 
+def _uniform_grid(bin_limits_axis):
+    """Returns (start, width) if bin limits form a uniform grid, otherwise None"""
+    if len(bin_limits_axis) < 2:
+        return None
+    start = bin_limits_axis[0]
+    width = (bin_limits_axis[-1] - start) / (len(bin_limits_axis) - 1)
+    if not width > 0:
+        return None
+    grid = start + width * numpy.arange(len(bin_limits_axis))
+    if numpy.max(numpy.abs(grid - bin_limits_axis)) > 1e-3 * width:
+        return None
+    return start, width
+
+
+def _compute_axis_bin_indices(bin_limits_axis, values):
+    """The same as numpy.searchsorted(bin_limits_axis, values),
+    but for uniform grid bins are computed arithmetically"""
+    bin_limits_axis = numpy.asarray(bin_limits_axis, dtype=float)
+    grid = _uniform_grid(bin_limits_axis)
+    if grid is None:
+        return numpy.searchsorted(bin_limits_axis, values)
+    start, width = grid
+    n_limits = len(bin_limits_axis)
+    positions = numpy.subtract(values, start, dtype=float)
+    positions /= width
+    positions += 1
+    numpy.clip(positions, 0, n_limits, out=positions)
+    positions[numpy.isnan(positions)] = n_limits
+    result = positions.astype(numpy.int32)
+    # correcting rounding at the edges of bins, so the result coincides with searchsorted
+    result[(result < n_limits) & (values > bin_limits_axis[numpy.minimum(result, n_limits - 1)])] += 1
+    result[(result > 0) & (values <= bin_limits_axis[result - 1])] -= 1
+    return result
+
+
 def compute_bin_indices(X_part, bin_limits=None, n_bins=20):
     """For arbitrary number of variables computes the indices of data,
     the indices are unique numbers of bin from zero to \prod_j (len(bin_limits[j])+1)
@@ -68,17 +103,21 @@ def compute_bin_indices(X_part, bin_limits=None, n_bins=20):
         var_names = ["M2AB", "M2AC"]
         bin_limits = [numpy.linspace(0, 1, 21), numpy.linspace(0, 1, 21)]
 
-    If bin_limits is not provided, they are computed using mask and n_bins
+    If bin_limits is not provided, they are computed using mask and n_bins.
+    Uniform bin limits (such as numpy.linspace) are processed without searching.
     """
+    X_part = numpy.asarray(X_part)
     if bin_limits is None:
         bin_limits = []
-        for variable_data in range(X_part.shape[1]):
+        for axis in range(X_part.shape[1]):
+            variable_data = X_part[:, axis]
             bin_limits.append(numpy.linspace(numpy.min(variable_data), numpy.max(variable_data), n_bins + 1)[1: -1])
 
-    bin_indices = numpy.zeros(len(X_part), dtype=numpy.int)
+    total_bins = numpy.prod([len(bin_limits_axis) + 1 for bin_limits_axis in bin_limits])
+    bin_indices = numpy.zeros(len(X_part), dtype=numpy.int32 if total_bins < 2 ** 31 else numpy.int64)
     for axis, bin_limits_axis in enumerate(bin_limits):
         bin_indices *= (len(bin_limits_axis) + 1)
-        bin_indices += numpy.searchsorted(bin_limits_axis, X_part[:, axis])
+        bin_indices += _compute_axis_bin_indices(bin_limits_axis, X_part[:, axis])
 
     return bin_indices
 
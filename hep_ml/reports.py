@@ -8,23 +8,26 @@ from __future__ import print_function, division, absolute_import
 from itertools import islice
 
 from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+import hashlib
 import time
 import warnings
 import numpy
 import pandas
 import matplotlib.pyplot as pylab
-from sklearn.metrics import auc, roc_auc_score, roc_curve
+from sklearn.metrics import roc_auc_score
 from sklearn.utils.validation import check_arrays, column_or_1d
 from matplotlib import cm
 from scipy.stats import pearsonr
 
-from .commonutils import compute_bdt_cut, \
+from .commonutils import compute_bdt_cut, weighted_percentiles, \
     check_sample_weight, build_normalizer, computeSignalKnnIndices, map_on_cluster
 
 from .metrics_utils import compute_sde_on_bins, compute_sde_on_groups, compute_theil_on_bins, \
     bin_based_cvm, bin_based_ks
 
 from .metrics_utils import compute_bin_efficiencies, compute_bin_weights, compute_bin_indices
+from .metrics import CutScan
 
 
 __author__ = 'Alex Rogozhnikov'
@@ -72,11 +75,16 @@ class ClassifiersDict(OrderedDict):
 
 
 class Predictions(object):
-    def __init__(self, classifiers_dict, X, y, sample_weight=None, low_memory=None):
+    # number of binnings kept in cache
+    bin_indices_cache_size = 10
+
+    def __init__(self, classifiers_dict, X, y, sample_weight=None, low_memory=None, n_threads=1):
         """The main object for different reports and plots,
         computes predictions of different classifiers on the same test data sets
         and makes it possible to compute different metrics,
         plot some quality curves and so on
+        :param int n_threads: number of threads used to evaluate metrics on different classifiers and stages,
+            predictions are shared between threads without copying to other processes
         """
         assert isinstance(classifiers_dict, OrderedDict)
         if low_memory is not None:
@@ -86,13 +94,17 @@ class Predictions(object):
         self.y = column_or_1d(numpy.array(y, dtype=int))
         self.sample_weight = sample_weight
         assert len(X) == len(y), 'Different lengths'
+        assert n_threads >= 1, 'number of threads should be positive'
         self.n_samples = len(y)
+        self.n_threads = n_threads
         self.checked_sample_weight = check_sample_weight(y, sample_weight=sample_weight)
 
         self.predictions = OrderedDict([(name, classifier.predict_proba(X))
                                         for name, classifier in classifiers_dict.items()])
         self.staged_predictions = None
         self.classifiers = classifiers_dict
+        # LRU cache: (var_names, n_bins, mask digest) -> bin indices
+        self._bin_indices_cache = OrderedDict()
 
     # region Checks
     @staticmethod
@@ -137,17 +149,49 @@ class Predictions(object):
                     result[name].loc[stage] = numpy.copy(pred)
         return result
 
+    def _map_on_predictions(self, function, named_predictions):
+        """Applies function to each prediction, keeping the order
+        :param named_predictions: iterable of tuples (name, stage, predict_proba)
+        :return: list of tuples (name, stage, result)
+        """
+        if self.n_threads == 1:
+            return [(name, stage, function(pred)) for name, stage, pred in named_predictions]
+
+        def apply_function(named_prediction):
+            name, stage, pred = named_prediction
+            return name, stage, function(pred)
+
+        # predictions are taken in batches, so not all the stages are kept in memory at the same time
+        named_predictions = iter(named_predictions)
+        batch_size = 2 * self.n_threads
+        result = []
+        pool = ThreadPool(self.n_threads)
+        try:
+            while True:
+                # copying, since staged predictions may be yielded in the same buffer
+                batch = [(name, stage, numpy.copy(pred)) for name, stage, pred
+                         in islice(named_predictions, batch_size)]
+                if len(batch) == 0:
+                    break
+                result.extend(pool.map(apply_function, batch))
+        finally:
+            pool.terminate()
+        return result
+
     def _map_on_staged_proba(self, function, step=1):
         """Applies a function to every step-th stage of each classifier
         returns: {name: Series[stage_name, result]}
         :param function: should take the only argument, predict_proba of shape [n_samples, 2]
         :param int step: the function is applied to every step'th iteration
         """
+        staged_probas = self._get_staged_proba()
+        named_predictions = ((name, stage, pred) for name, staged_proba in staged_probas.items()
+                             for stage, pred in islice(enumerate(staged_proba), step - 1, None, step))
         result = OrderedDict()
-        for name, staged_proba in self._get_staged_proba().items():
+        for name in staged_probas:
             result[name] = pandas.Series()
-            for stage, pred in islice(enumerate(staged_proba), step - 1, None, step):
-                result[name].loc[stage] = function(pred)
+        for name, stage, value in self._map_on_predictions(function, named_predictions):
+            result[name].loc[stage] = value
         return result
 
     def _map_on_stages(self, function, stages=None):
@@ -157,8 +201,18 @@ class Predictions(object):
         :rtype: dict[str, pandas.Series]"""
         selected_stages = self._get_stages(stages)
         result = OrderedDict()
+        if self.n_threads == 1:
+            for name, staged_proba in selected_stages.items():
+                result[name] = staged_proba.apply(function)
+            return result
+
+        named_predictions = [(name, stage, pred) for name, staged_proba in selected_stages.items()
+                             for stage, pred in staged_proba.items()]
+        values = OrderedDict((name, []) for name in selected_stages)
+        for name, _, value in self._map_on_predictions(function, named_predictions):
+            values[name].append(value)
         for name, staged_proba in selected_stages.items():
-            result[name] = staged_proba.apply(function)
+            result[name] = pandas.Series(values[name], index=staged_proba.index)
         return result
 
     def _plot_on_stages(self, plotting_function, stages=None):
@@ -242,17 +296,42 @@ class Predictions(object):
 
     #region Uniformity-related methods
 
-    def _compute_bin_indices(self, var_names, n_bins=20, mask=None):
+    def _compute_binning(self, var_names, n_bins=20, mask=None):
         """Mask is used to show events that will be binned afterwards
-        (for instance if only signal events will be binned, then mask= y == 1)"""
+        (for instance if only signal events will be binned, then mask= y == 1).
+        Returns bin indices and bin centers computed from the same limits.
+        Results are cached under one key, the returned arrays are read-only."""
         for var in var_names:
             assert var in self.X.columns, "the variable %i is not in dataset" % var
         mask = self._check_mask(mask)
+        key = (tuple(var_names), n_bins, hashlib.md5(numpy.packbits(mask).tobytes()).hexdigest())
+        if key in self._bin_indices_cache:
+            binning = self._bin_indices_cache.pop(key)
+            self._bin_indices_cache[key] = binning
+            return binning
+
         bin_limits = []
+        bin_centers = []
         for var_name in var_names:
             var_data = self.X.loc[mask, var_name]
-            bin_limits.append(numpy.linspace(numpy.min(var_data), numpy.max(var_data), n_bins + 1)[1: -1])
-        return compute_bin_indices(self.X.ix[:, var_names].values, bin_limits=bin_limits)
+            var_min, var_max = numpy.min(var_data), numpy.max(var_data)
+            bin_limits.append(numpy.linspace(var_min, var_max, n_bins + 1)[1: -1])
+            centers = numpy.linspace(var_min, var_max, 2 * n_bins + 1)[1::2]
+            assert len(centers) == n_bins
+            centers.setflags(write=False)
+            bin_centers.append(centers)
+        bin_indices = compute_bin_indices(self.X.ix[:, var_names].values, bin_limits=bin_limits)
+        bin_indices.setflags(write=False)
+        binning = bin_indices, tuple(bin_centers)
+        self._bin_indices_cache[key] = binning
+        while len(self._bin_indices_cache) > self.bin_indices_cache_size:
+            self._bin_indices_cache.popitem(last=False)
+        return binning
+
+    def _compute_bin_indices(self, var_names, n_bins=20, mask=None):
+        """Mask is used to show events that will be binned afterwards. Results are cached, read-only"""
+        bin_indices, _ = self._compute_binning(var_names, n_bins=n_bins, mask=mask)
+        return bin_indices
 
     def _compute_nonempty_bins_mask(self, var_names, n_bins=20, mask=None):
         return numpy.bincount(self._compute_bin_indices(var_names, n_bins=n_bins, mask=mask),
@@ -266,14 +345,9 @@ class Predictions(object):
         return numpy.array(result)
 
     def _compute_bin_centers(self, var_names, n_bins=20, mask=None):
-        """Mask is used to show events that will be binned after"""
-        bin_centers = []
-        mask = self._check_mask(mask)
-        for var_name in var_names:
-            var_data = self.X.loc[mask, var_name]
-            bin_centers.append(numpy.linspace(numpy.min(var_data), numpy.max(var_data), 2 * n_bins + 1)[1::2])
-            assert len(bin_centers[-1]) == n_bins
-        return bin_centers
+        """Mask is used to show events that will be binned after. Cached together with bin indices"""
+        _, bin_centers = self._compute_binning(var_names, n_bins=n_bins, mask=mask)
+        return list(bin_centers)
 
     def sde_curves(self, uniform_variables, target_efficiencies=None, n_bins=20, step=3, power=2., label=1,
                    return_data=False):
@@ -433,16 +507,17 @@ class Predictions(object):
         if print_cut:
             legend_label += '(cut={cut:.2f})'
 
+        # cuts for all classifiers and all rcps are computed at once, shape = [n_rcps, n_classifiers]
+        cut_label = label if not compute_cuts_for_other_class else 1 - label
+        cut_mask = mask > 0.5
+        scores = numpy.array([proba[cut_mask, cut_label] for proba in self.predictions.values()]).T
+        cuts = weighted_percentiles(scores, 1. - global_rcp, sample_weight=self.checked_sample_weight[cut_mask])
+        if compute_cuts_for_other_class:
+            cuts = 1 - cuts
+
         for i, (name, proba) in enumerate(self.predictions.items(), start=1):
             ax = pylab.subplot(1, n_classifiers, i)
-            for eff in global_rcp:
-                if not compute_cuts_for_other_class:
-                    cut = compute_bdt_cut(eff, y_true=mask, y_pred=proba[:, label],
-                                          sample_weight=self.checked_sample_weight)
-                else:
-                    cut = 1 - compute_bdt_cut(eff, y_true=mask, y_pred=proba[:, 1 - label],
-                                              sample_weight=self.checked_sample_weight)
-
+            for eff, cut in zip(global_rcp, cuts[:, i - 1]):
                 bin_effs = compute_bin_efficiencies(proba[mask, label], bin_indices=bin_indices[mask], cut=cut,
                                                     sample_weight=self.checked_sample_weight[mask], minlength=n_bins)
                 ax.plot(bin_centers[bin_mask], bin_effs[bin_mask], label=legend_label.format(rcp=eff, cut=cut),
@@ -467,17 +542,17 @@ class Predictions(object):
         bin_indices = self._compute_bin_indices(uniform_variables, n_bins, mask=mask)
         total_bins = n_bins ** len(uniform_variables)
 
-        def compute_bin_effs(prediction_proba, target_eff):
-            cut = compute_bdt_cut(target_eff, y_true=mask, y_pred=prediction_proba[:, label],
-                                  sample_weight=self.checked_sample_weight)
-            return compute_bin_efficiencies(prediction_proba[mask, label], bin_indices=bin_indices[mask],
-                                            cut=cut, sample_weight=self.checked_sample_weight[mask],
-                                            minlength=total_bins)
+        def compute_bin_effs(prediction_proba, target_effs):
+            # cuts for all target efficiencies are computed with one sort
+            cuts = compute_bdt_cut(numpy.asarray(target_effs), y_true=mask, y_pred=prediction_proba[:, label],
+                                   sample_weight=self.checked_sample_weight)
+            return [compute_bin_efficiencies(prediction_proba[mask, label], bin_indices=bin_indices[mask],
+                                             cut=cut, sample_weight=self.checked_sample_weight[mask],
+                                             minlength=total_bins) for cut in cuts]
 
         if len(uniform_variables) == 1:
             effs = self._map_on_stages(stages=stages,
-                                       function=lambda pred: [compute_bin_effs(pred, eff) for eff in
-                                                              target_efficiencies])
+                                       function=lambda pred: compute_bin_effs(pred, target_efficiencies))
             effs = pandas.DataFrame(effs)
             x_limits, = self._compute_bin_centers(uniform_variables, n_bins=n_bins, mask=mask)
             for stage_name, stage in effs.iterrows():
@@ -498,7 +573,8 @@ class Predictions(object):
             bin_weights = compute_bin_weights(bin_indices, sample_weight=self.checked_sample_weight)
             bin_weights.resize(total_bins)
             for target_efficiency in target_efficiencies:
-                staged_results = self._map_on_stages(lambda x: compute_bin_effs(x, target_efficiency), stages=stages)
+                staged_results = self._map_on_stages(lambda x: compute_bin_effs(x, [target_efficiency])[0],
+                                                     stages=stages)
                 staged_results = pandas.DataFrame(staged_results)
                 for stage_name, stage_data in staged_results.iterrows():
                     print("Stage %s, efficiency=%.2f" % (str(stage_name), target_efficiency))
@@ -590,8 +666,9 @@ def plot_roc(y_true, y_pred, sample_weight=None, classifier_name="", is_cut=Fals
         if sample_weight is not None:
             sample_weight = sample_weight[mask]
 
-    fpr, tpr, thresholds = check_arrays(*roc_curve(y_true, y_pred, sample_weight=sample_weight))
-    roc_auc = auc(fpr, tpr)
+    scan = CutScan(y_true, y_pred, sample_weight=sample_weight)
+    fpr, tpr, thresholds = scan.roc_curve()
+    roc_auc = scan.auc()
     # tpr = recall = isSasS / isS = signal efficiency
     # fpr = isBasS / isB = 1 - specificity = 1 - backgroundRejection
     bg_rejection = 1. - fpr
@@ -10,7 +10,6 @@ obtain efficiency uniformity at the specified level
 # Alex Rogozhnikov <axelr@yandex-team.ru>
 # Nikita Kazeev <kazeevn@yandex-team.ru>
 
-from collections import defaultdict
 from six.moves import zip
 
 import numpy as np
@@ -22,7 +21,7 @@ from sklearn.utils.random import check_random_state
 from sklearn.utils.validation import check_arrays, column_or_1d
 
 from .commonutils import sigmoid_function, compute_bdt_cut, map_on_cluster, \
-    computeKnnIndicesOfSameClass, compute_cut_for_efficiency
+    computeKnnIndicesOfSameClass, compute_cut_for_efficiency, DebugRecorder, TrainingProfiler
 from .metrics_utils import compute_group_efficiencies
 
 
@@ -50,7 +49,9 @@ class uBoostBDT:
                  keep_debug_info=False,
                  random_state=None,
                  uniform_label=1,
-                 algorithm="SAMME"):
+                 algorithm="SAMME",
+                 warm_start=False,
+                 profile=False):
         """
         uBoostBDT is AdaBoostClassifier, which is modified to have flat
         efficiency of signal (class=1) along some variables.
@@ -120,6 +121,20 @@ class uBoostBDT:
             If None, the random number generator is the RandomState
             instance used by `np.random`.
 
+        keep_debug_info: bool or DebugRecorder, (default=False)
+            if True, local efficiencies and weights on each iteration are
+            saved to debug_dict, DebugRecorder allows to limit memory used for this
+
+        warm_start: bool, (default=False)
+            if True, the next call of fit (on the same data) adds
+            n_estimators - len(estimators_) stages to the fitted ensemble,
+            boosting weights and scores are kept after each fit,
+            neighbours are kept after fit with warm_start (otherwise computed again)
+
+        profile: bool or TrainingProfiler, (default=False)
+            if True, time spent in different phases of each stage is
+            measured and saved to profiling_info (pandas.DataFrame)
+
         Attributes
         ----------
         `estimators_` : list of classifiers
@@ -152,6 +167,8 @@ class uBoostBDT:
         self.keep_debug_info = keep_debug_info
         self.random_state = random_state
         self.algorithm = algorithm
+        self.warm_start = warm_start
+        self.profile = profile
 
     def fit(self, X, y, sample_weight=None, neighbours_matrix=None):
         """Build a boosted classifier from the training set (X, y).
@@ -202,44 +219,66 @@ class uBoostBDT:
             "only two-class classification is implemented"
         self.signed_uniform_label = 2 * self.uniform_label - 1
 
-        if neighbours_matrix is not None:
-            assert np.shape(neighbours_matrix) == (len(X), self.n_neighbors), \
-                "Wrong shape of neighbours_matrix"
-            self.knn_indices = neighbours_matrix
-        else:
-            assert self.uniform_variables is not None, \
-                "uniform_variables should be set"
-            self.knn_indices = computeKnnIndicesOfSameClass(
-                self.uniform_variables, X, y, self.n_neighbors)
-
-        if sample_weight is None:
-            # Initialize weights to 1 / n_samples
-            sample_weight = np.ones(len(X), dtype=np.float) / len(X)
-        else:
-            # Normalize existing weights
-            assert np.all(sample_weight >= 0.), \
-                'the weights should be non-negative'
-            sample_weight /= np.sum(sample_weight)
-
-        # Clear any previous fit results
-        self.estimators_ = []
-        self.estimator_weights_ = []
-        # score cuts correspond to
-        # global efficiency == target_efficiency on each iteration.
-        self.score_cuts_ = []
-
         X_train_variables = self.get_train_vars(X)
         y = column_or_1d(y)
         X_train_variables, y = check_arrays(
             X_train_variables, y, sparse_format="dense")
-
-        # A dictionary to keep all intermediate weights, efficiencies and so on
-        if self.keep_debug_info:
-            self.debug_dict = defaultdict(list)
-
-        self.random_generator = check_random_state(self.random_state)
-
-        self._boost(X_train_variables, y, sample_weight)
+        self._profiler = TrainingProfiler.create(self.profile)
+        try:
+            continue_training = self.warm_start and len(getattr(self, 'estimators_', [])) > 0
+            if continue_training:
+                # continue training, boosting state is kept (also if previous fit was without warm_start)
+                assert getattr(self, '_boosting_state', None) is not None, 'no saved state to continue training'
+                sample_weight, cumulative_score = self._boosting_state
+                assert len(sample_weight) == len(X), 'warm start requires the same training data'
+                assert len(self.estimators_) <= self.n_estimators, 'n_estimators should not decrease'
+
+            # neighbours are kept only after fit with warm_start (or keep_debug_info)
+            if not continue_training or self.knn_indices is None:
+                if neighbours_matrix is not None:
+                    assert np.shape(neighbours_matrix) == (len(X), self.n_neighbors), \
+                        "Wrong shape of neighbours_matrix"
+                    self.knn_indices = neighbours_matrix
+                else:
+                    assert self.uniform_variables is not None, \
+                        "uniform_variables should be set"
+                    with self._profiler.phase('neighbours'):
+                        self.knn_indices = computeKnnIndicesOfSameClass(
+                            self.uniform_variables, X, y, self.n_neighbors)
+
+            if not continue_training:
+                if sample_weight is None:
+                    # Initialize weights to 1 / n_samples
+                    sample_weight = np.ones(len(X), dtype=np.float) / len(X)
+                else:
+                    # Normalize existing weights
+                    assert np.all(sample_weight >= 0.), \
+                        'the weights should be non-negative'
+                    sample_weight /= np.sum(sample_weight)
+                cumulative_score = np.zeros(len(X))
+
+                # Clear any previous fit results
+                self.estimators_ = []
+                self.estimator_weights_ = []
+                # score cuts correspond to
+                # global efficiency == target_efficiency on each iteration.
+                self.score_cuts_ = []
+
+                # A dictionary to keep all intermediate weights, efficiencies and so on
+                if self.keep_debug_info:
+                    self.debug_dict = DebugRecorder.create(self.keep_debug_info)
+
+                self.random_generator = check_random_state(self.random_state)
+
+            sample_weight, cumulative_score = self._boost(X_train_variables, y, sample_weight, cumulative_score)
+
+            # the state needed to continue training
+            self._boosting_state = sample_weight, cumulative_score
+            if not self.warm_start and not self.keep_debug_info:
+                self.knn_indices = None
+            self.profiling_info = self._profiler.finish()
+        finally:
+            del self._profiler
 
         self.score_cut = self.signed_uniform_label * compute_bdt_cut(
             self.target_efficiency, y == self.uniform_label, self.predict_score(X) * self.signed_uniform_label)
@@ -273,15 +312,21 @@ class uBoostBDT:
         weight[y == 1] /= np.mean(weight[y == 1])
         return weight
 
-    def compute_uboost_multipliers(self, sample_weight, score, y):
+    def compute_uboost_multipliers(self, sample_weight, score, y, profiler=None):
         """Returns uBoost multipliers to sample_weight
-        and computed global cut"""
+        and computed global cut
+        :param profiler: optional TrainingProfiler, which measures 'cuts' and 'voting' phases"""
+        if profiler is None:
+            profiler = TrainingProfiler(enabled=False)
         signed_score = score * self.signed_uniform_label
-        signed_score_cut = compute_cut_for_efficiency(self.target_efficiency, y == self.uniform_label, signed_score)
+        with profiler.phase('cuts'):
+            signed_score_cut = compute_cut_for_efficiency(self.target_efficiency, y == self.uniform_label,
+                                                          signed_score)
         global_score_cut = signed_score_cut * self.signed_uniform_label
 
-        local_efficiencies = compute_group_efficiencies(signed_score, self.knn_indices, cut=signed_score_cut,
-                                                        smoothing=self.smoothing)
+        with profiler.phase('voting'):
+            local_efficiencies = compute_group_efficiencies(signed_score, self.knn_indices, cut=signed_score_cut,
+                                                            smoothing=self.smoothing)
 
         # pay attention - sample_weight should be used only here
         e_prime = np.average(np.abs(local_efficiencies - self.target_efficiency),
@@ -298,55 +343,61 @@ class uBoostBDT:
                                (beta * self.uniforming_rate))
 
         if self.keep_debug_info:
-            self.debug_dict['local_effs'].append(local_efficiencies.copy())
+            self.debug_dict.record('local_effs', local_efficiencies)
 
         return boost_weights, global_score_cut
 
-    def _boost(self, X, y, sample_weight):
+    def _boost(self, X, y, sample_weight, cumulative_score):
         """Implement a single boost using the SAMME or SAMME.R algorithm,
-        which is modified in uBoost way"""
-        cumulative_score = np.zeros(len(X))
+        which is modified in uBoost way. Stages are added until there are n_estimators,
+        returns updated sample_weight and cumulative_score"""
         y_signed = 2 * y - 1
-        for iteration in range(self.n_estimators):
-            estimator = self._make_estimator()
-            mask = generate_mask(len(X), self.bagging, self.random_generator)
-            estimator.fit(X, y, sample_weight=sample_weight * mask)
+        profiler = self._profiler
+        for iteration in range(len(self.estimators_), self.n_estimators):
+            profiler.start_stage(iteration)
+            with profiler.phase('fit_tree'):
+                estimator = self._make_estimator()
+                mask = generate_mask(len(X), self.bagging, self.random_generator)
+                estimator.fit(X, y, sample_weight=sample_weight * mask)
 
             # computing estimator weight
-            if self.algorithm == 'SAMME':
-                y_pred = estimator.predict(X)
+            with profiler.phase('predict'):
+                if self.algorithm == 'SAMME':
+                    y_pred = estimator.predict(X)
 
-                # Error fraction
-                estimator_error = np.average(y_pred != y, weights=sample_weight)
-                estimator_error = np.clip(estimator_error, 1e-6, 1. - 1e-6)
+                    # Error fraction
+                    estimator_error = np.average(y_pred != y, weights=sample_weight)
+                    estimator_error = np.clip(estimator_error, 1e-6, 1. - 1e-6)
 
-                estimator_weight = self.learning_rate * 0.5 * (
-                    np.log((1. - estimator_error) / estimator_error))
+                    estimator_weight = self.learning_rate * 0.5 * (
+                        np.log((1. - estimator_error) / estimator_error))
 
-                score = estimator_weight * (2 * y_pred - 1)
-            else:
-                estimator_weight = self.learning_rate * 0.5
-                score = estimator_weight * self._estimator_score(estimator, X)
+                    score = estimator_weight * (2 * y_pred - 1)
+                else:
+                    estimator_weight = self.learning_rate * 0.5
+                    score = estimator_weight * self._estimator_score(estimator, X)
 
             # correcting the weights and score according to predictions
-            sample_weight *= np.exp(- y_signed * score)
-            sample_weight = self._normalize_weight(y, sample_weight)
-            cumulative_score += score
+            with profiler.phase('reweighting'):
+                sample_weight *= np.exp(- y_signed * score)
+                sample_weight = self._normalize_weight(y, sample_weight)
+                cumulative_score += score
 
+            # knn voting and cuts are measured separately
             uboost_multipliers, global_score_cut = \
-                self.compute_uboost_multipliers(sample_weight, cumulative_score, y)
-            sample_weight *= uboost_multipliers
-            sample_weight = self._normalize_weight(y, sample_weight)
+                self.compute_uboost_multipliers(sample_weight, cumulative_score, y, profiler=profiler)
+            with profiler.phase('reweighting'):
+                sample_weight *= uboost_multipliers
+                sample_weight = self._normalize_weight(y, sample_weight)
 
             self.score_cuts_.append(global_score_cut)
             self.estimators_.append(estimator)
             self.estimator_weights_.append(estimator_weight)
 
             if self.keep_debug_info:
-                self.debug_dict['weights'].append(sample_weight.copy())
+                self.debug_dict.record('weights', sample_weight)
 
-        if not self.keep_debug_info:
-            self.knn_indices = None
+        return sample_weight, cumulative_score
 
     def get_train_vars(self, X):
         """Gets the DataFrame and returns only columns
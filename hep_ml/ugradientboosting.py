@@ -1,6 +1,7 @@
 from __future__ import print_function, division, absolute_import
 
 import copy
+from multiprocessing.pool import ThreadPool
 import numpy
 import pandas
 
@@ -9,7 +10,9 @@ from sklearn.tree.tree import DecisionTreeRegressor, DTYPE
 from sklearn.utils.random import check_random_state
 from sklearn.utils.validation import check_arrays, column_or_1d
 
-from .commonutils import check_sample_weight, sigmoid_function
+from .commonutils import check_sample_weight, sigmoid_function, TrainingProfiler
+from .histogramtree import BinQuantizer, HistogramTreeRegressor
+from .metrics import AbstractMetric
 from .losses import AbstractLossFunction, AdaLossFunction, AbstractFlatnessLossFunction, \
     KnnFlatnessLossFunction, BinFlatnessLossFunction, AbstractMatrixLossFunction, \
     SimpleKnnLossFunction, BinomialDevianceLossFunction
@@ -25,7 +28,90 @@ def score_to_proba(score):
     return result
 
 
+class PackedTrees(object):
+    # arrays which completely define packed trees
+    fields = ['roots', 'feature', 'threshold', 'children_left', 'children_right', 'value']
+
+    def __init__(self, trees, leaf_values=None):
+        """All the trees of ensemble are packed into contiguous arrays, so the ensemble is evaluated
+        with one vectorized traversal instead of calling predict of each tree.
+        :param trees: list of sklearn trees (tree_ attribute of DecisionTreeRegressor)
+            or any objects with the same arrays: children_left, children_right, feature, threshold, value
+        :param leaf_values: optional list of arrays with values in nodes of each tree, used instead of tree.value
+        """
+        if leaf_values is None:
+            leaf_values = [tree.value[:, 0, 0] for tree in trees]
+        node_counts = [len(tree.children_left) for tree in trees]
+        self.roots = numpy.cumsum([0] + node_counts)[:-1]
+        n_nodes = sum(node_counts)
+        self.feature = numpy.zeros(n_nodes, dtype=int)
+        self.threshold = numpy.zeros(n_nodes, dtype=float)
+        self.children_left = numpy.zeros(n_nodes, dtype=int)
+        self.children_right = numpy.zeros(n_nodes, dtype=int)
+        self.value = numpy.zeros(n_nodes, dtype=float)
+        for tree, values, root, node_count in zip(trees, leaf_values, self.roots, node_counts):
+            nodes = slice(root, root + node_count)
+            is_leaf = tree.children_left < 0
+            own_indices = numpy.arange(root, root + node_count)
+            # leaves point to themselves, so traversal needs no checks
+            self.children_left[nodes] = numpy.where(is_leaf, own_indices, tree.children_left + root)
+            self.children_right[nodes] = numpy.where(is_leaf, own_indices, tree.children_right + root)
+            self.feature[nodes] = numpy.where(is_leaf, 0, tree.feature)
+            self.threshold[nodes] = tree.threshold
+            self.value[nodes] = values
+        self._compute_depth()
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """Restores packed trees from dict with arrays (see fields)"""
+        result = cls.__new__(cls)
+        for field in cls.fields:
+            setattr(result, field, numpy.asarray(arrays[field]))
+        result._compute_depth()
+        return result
+
+    def to_arrays(self):
+        """Returns minimal representation in the form of dict with arrays"""
+        n_features = numpy.max(self.feature) + 1 if len(self.feature) > 0 else 1
+        index_type = numpy.int32 if len(self.value) < 2 ** 31 else numpy.int64
+        return {'roots': self.roots.astype(index_type),
+                'feature': self.feature.astype(numpy.uint16 if n_features < 2 ** 16 else numpy.int64),
+                'threshold': self.threshold,
+                'children_left': self.children_left.astype(index_type),
+                'children_right': self.children_right.astype(index_type),
+                'value': self.value}
+
+    def _compute_depth(self):
+        self.n_trees = len(self.roots)
+        # breadth-first traversal of all trees simultaneously
+        self.depth = 0
+        layer = self.roots
+        while True:
+            layer = layer[self.children_left[layer] != layer]
+            if len(layer) == 0:
+                break
+            layer = numpy.concatenate([self.children_left[layer], self.children_right[layer]])
+            self.depth += 1
+
+    def apply(self, X, trees=slice(None)):
+        """Returns global indices of leaves, shape = [n_samples, n_selected_trees]
+        :param trees: slice, selects trees to evaluate """
+        nodes = numpy.repeat(self.roots[numpy.newaxis, trees], len(X), axis=0)
+        rows = numpy.arange(len(X))[:, numpy.newaxis]
+        for _ in range(self.depth):
+            to_right = X[rows, self.feature[nodes]] > self.threshold[nodes]
+            nodes = numpy.where(to_right, self.children_right[nodes], self.children_left[nodes])
+        return nodes
+
+    def predict_trees(self, X, trees=slice(None)):
+        """Returns the predictions of each tree, shape = [n_samples, n_selected_trees]"""
+        return self.value[self.apply(X, trees=trees)]
+
+
 class uGradientBoostingClassifier(BaseEstimator, ClassifierMixin):
+    # maximal number of (event, tree) pairs evaluated at once during prediction
+    max_batch_elements = 10 ** 7
+
     def __init__(self, loss=None,
                  n_estimators=10,
                  learning_rate=0.1,
@@ -40,10 +126,37 @@ class uGradientBoostingClassifier(BaseEstimator, ClassifierMixin):
                  criterion='mse',
                  splitter='best',
                  train_variables=None,
-                 random_state=None):
+                 random_state=None,
+                 max_bins=256,
+                 early_stopping_rounds=None,
+                 eval_metric=None,
+                 warm_start=False,
+                 subsample_method='choice',
+                 n_threads=1,
+                 profile=False):
         """This version of gradient boosting supports only two-class classification and only special losses
         derived from AbstractLossFunction.
         :type loss: AbstractLossFunction
+        :param splitter: 'best' or 'random' are passed to sklearn trees,
+            'histogram' quantizes features once before training and finds splits from histograms of gradients
+            (criterion should be 'mse' or 'friedman_mse', max_leaf_nodes is not supported)
+        :param int max_bins: maximal number of bins used by 'histogram' splitter, not greater than 256
+        :param int early_stopping_rounds: if not None, training stops when validation score
+            (eval_set should be passed to fit) didn't improve during this number of stages,
+            trees after the best stage are dropped.
+        :param eval_metric: AbstractMetric from hep_ml.metrics (for instance, uniformity metric) to be minimized
+            on eval_set, if None, the loss (fitted on eval_set) is used, flatness losses don't compute
+            their value, so eval_metric is required with them.
+        :param bool warm_start: if True, next call of fit adds trees to the existing ensemble,
+            keeping the fitted loss and current predictions on training data.
+        :param str subsample_method: how in-bag events are selected when subsample < 1.
+            'choice' - random subset for each tree (in-bag data is copied for each tree),
+            'blocks' - training data is shuffled once, each tree takes random circular block of shuffled data,
+            so data is copied only for blocks wrapping around the end.
+        :param int n_threads: number of threads. With 'histogram' splitter histograms of features are computed
+            in parallel, for all splitters predictions of each new tree on training data are computed in parallel.
+        :param profile: bool or TrainingProfiler, if True, time spent in phases of each stage (gradient,
+            fitting tree, ...) is measured and saved to self.profiling_info (pandas.DataFrame)
         """
         self.loss = loss
         self.n_estimators = n_estimators
@@ -60,68 +173,215 @@ class uGradientBoostingClassifier(BaseEstimator, ClassifierMixin):
         self.random_state = random_state
         self.criterion = criterion
         self.splitter = splitter
+        self.max_bins = max_bins
+        self.early_stopping_rounds = early_stopping_rounds
+        self.eval_metric = eval_metric
+        self.warm_start = warm_start
+        self.subsample_method = subsample_method
+        self.n_threads = n_threads
+        self.profile = profile
 
     def check_params(self):
         assert isinstance(self.loss, AbstractLossFunction), \
             'LossFunction should be derived from AbstractLossFunction'
         assert self.n_estimators > 0, 'n_estimators should be positive'
         assert 0 < self.subsample <= 1., 'subsample should be in (0, 1]'
+        if self.splitter == 'histogram':
+            assert self.max_leaf_nodes is None, 'max_leaf_nodes is not supported by histogram splitter'
+        assert self.subsample_method in ['choice', 'blocks'], 'unknown subsample_method'
+        assert self.n_threads >= 1, 'n_threads should be positive'
+        if self.eval_metric is not None:
+            assert isinstance(self.eval_metric, AbstractMetric), 'eval_metric should be derived from AbstractMetric'
         self.random_state = check_random_state(self.random_state)
 
-    def fit(self, X, y, sample_weight=None):
+    def fit(self, X, y, sample_weight=None, eval_set=None):
+        """
+        :param eval_set: None or tuple (X, y) or (X, y, sample_weight) with validation data,
+            score on it is computed after each stage and saved to self.validation_scores
+        If warm_start is True and the classifier was already fitted (on the same data),
+        only n_estimators - len(self.estimators) new trees are built.
+        """
         sample_weight = check_sample_weight(y, sample_weight=sample_weight)
         assert len(X) == len(y), 'Different lengths of X and y'
         X = pandas.DataFrame(X)
         y = numpy.array(column_or_1d(y), dtype=int)
         assert numpy.all(numpy.in1d(y, [0, 1])), 'Only two-class classification supported'
         self.check_params()
-
-        self.estimators = []
-        self.scores = []
+        profiler = TrainingProfiler.create(self.profile)
+        continue_training = self.warm_start and len(getattr(self, 'estimators', [])) > 0
+        # trees are packed again on next prediction, even with warm start the number of trees may coincide
+        self._packed_trees = None
 
         n_samples = len(X)
         n_inbag = int(self.subsample * len(X))
-        self.loss = copy.copy(self.loss)
-        self.loss.fit(X, y, sample_weight=sample_weight)
+        assert self.early_stopping_rounds is None or eval_set is not None, 'early stopping requires eval_set'
+        # copy of loss should be done before fitting on training data
+        validation_score = None if eval_set is None else self._make_validation_score(*eval_set)
+        if not continue_training:
+            self.estimators = []
+            self.scores = []
+            self.loss = copy.copy(self.loss)
+            with profiler.phase('fit_loss'):
+                self.loss.fit(X, y, sample_weight=sample_weight)
 
         # preparing for fitting in trees
         X = self.get_train_vars(X)
         self.n_features = X.shape[1]
         X, y = check_arrays(X, y, dtype=DTYPE, sparse_format="dense", check_ccontiguous=True)
-        y_pred = numpy.zeros(len(X), dtype=float)
 
-        if self.init_estimator is not None:
-            y_signed = 2 * y - 1
-            self.init_estimator.fit(X, y_signed, sample_weight=sample_weight)
-            y_pred += numpy.ravel(self.init_estimator.predict(X))
+        if continue_training:
+            assert getattr(self, '_train_pred', None) is not None, 'no saved state to continue training'
+            assert len(self._train_pred) == n_samples, 'warm start requires the same training data'
+            y_pred = self._train_pred
+        else:
+            y_pred = numpy.zeros(len(X), dtype=float)
+            if self.init_estimator is not None:
+                y_signed = 2 * y - 1
+                self.init_estimator.fit(X, y_signed, sample_weight=sample_weight)
+                y_pred += numpy.ravel(self.init_estimator.predict(X))
+            if self.splitter == 'histogram':
+                # features are quantized only once
+                with profiler.phase('quantize'):
+                    self._quantizer = BinQuantizer(max_bins=self.max_bins, random_state=self.random_state).fit(X)
+
+        if self.splitter == 'histogram':
+            with profiler.phase('quantize'):
+                X_binned = self._quantizer.transform(X)
+        train_X = X_binned if self.splitter == 'histogram' else X
+        if self.subsample_method == 'blocks':
+            # shuffled once, blocks of shuffled data are views without copying
+            permutation = self.random_state.permutation(n_samples)
+            train_X = train_X[permutation]
+            train_weight = sample_weight[permutation]
+
+        if eval_set is not None:
+            # validation predictions are updated incrementally, existing stages are evaluated once
+            self.validation_scores = []
+            X_valid, valid_pred = self._prepare_for_prediction(eval_set[0])
+            for stage_pred in self.staged_predict_score(eval_set[0]):
+                self.validation_scores.append(validation_score(stage_pred))
+                valid_pred = numpy.copy(stage_pred)
+            best_stage = int(numpy.argmin(self.validation_scores)) if continue_training else 0
+
+        pool = ThreadPool(self.n_threads) if self.n_threads > 1 else None
+        try:
+            for stage in range(len(self.estimators), self.n_estimators):
+                profiler.start_stage(stage)
+                # tree creation
+                tree = self._make_tree()
 
-        for stage in range(self.n_estimators):
-            # tree creation
-            tree = DecisionTreeRegressor(
+                # tree learning
+                with profiler.phase('gradient'):
+                    residual = self.loss.negative_gradient(y_pred)
+                with profiler.phase('subsample'):
+                    if self.subsample_method == 'blocks':
+                        block = self._sample_block(n_samples, n_inbag)
+                        tree_X, tree_weight = train_X[block], train_weight[block]
+                        tree_residual = residual[permutation[block]]
+                    else:
+                        train_indices = self.random_state.choice(n_samples, size=n_inbag, replace=False)
+                        tree_X, tree_weight = train_X[train_indices], sample_weight[train_indices]
+                        tree_residual = residual[train_indices]
+
+                with profiler.phase('fit_tree'):
+                    if self.splitter == 'histogram':
+                        tree.fit(tree_X, tree_residual, sample_weight=tree_weight,
+                                 bin_edges=self._quantizer.bin_edges, pool=pool)
+                    else:
+                        tree.fit(tree_X, tree_residual, sample_weight=tree_weight, check_input=False)
+                # leaves of training events are computed once, used both to update leaves and predictions
+                with profiler.phase('predict'):
+                    if self.splitter == 'histogram':
+                        leaves = self._predict_in_chunks(tree.apply_binned, X_binned, pool)
+                    else:
+                        leaves = self._predict_in_chunks(tree.tree_.apply, X, pool)
+                # update tree leaves
+                if self.update_tree:
+                    with profiler.phase('update_tree'):
+                        self.loss.update_tree(tree.tree_, X=X, y=y, y_pred=y_pred, sample_weight=sample_weight,
+                                              update_mask=numpy.ones(len(X), dtype=bool), residual=residual,
+                                              terminal_regions=leaves)
+                with profiler.phase('predict'):
+                    y_pred += self.learning_rate * numpy.take(tree.tree_.value[:, 0, 0], leaves)
+                self.estimators.append(tree)
+                with profiler.phase('loss'):
+                    self.scores.append(self.loss(y_pred))
+
+                if eval_set is not None:
+                    with profiler.phase('validation'):
+                        valid_pred += self.learning_rate * tree.predict(X_valid)
+                        self.validation_scores.append(validation_score(valid_pred))
+                    if self.validation_scores[stage] < self.validation_scores[best_stage]:
+                        best_stage = stage
+                    if self.early_stopping_rounds is not None and stage - best_stage >= self.early_stopping_rounds:
+                        break
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+        if self.early_stopping_rounds is not None:
+            for tree in self.estimators[best_stage + 1:]:
+                y_pred -= self.learning_rate * tree.predict(X)
+            self.estimators = self.estimators[:best_stage + 1]
+            self.scores = self.scores[:best_stage + 1]
+
+        # the state needed to continue training (also if this fit was without warm_start)
+        self._train_pred = y_pred
+        self.profiling_info = profiler.finish()
+        return self
+
+    def _sample_block(self, n_samples, n_inbag):
+        """Random circular block of shuffled data, so all events are in-bag equally often.
+        Returns slice (data isn't copied) or indices if the block wraps around the end"""
+        if n_inbag >= n_samples:
+            return slice(None)
+        block_start = self.random_state.randint(0, n_samples)
+        if block_start + n_inbag <= n_samples:
+            return slice(block_start, block_start + n_inbag)
+        return numpy.r_[block_start:n_samples, 0:block_start + n_inbag - n_samples]
+
+    def _predict_in_chunks(self, predict_function, X, pool):
+        """Applies prediction function to chunks of X in parallel"""
+        if pool is None:
+            return predict_function(X)
+        limits = numpy.linspace(0, len(X), self.n_threads + 1).astype(int)
+        chunks = [X[start:stop] for start, stop in zip(limits[:-1], limits[1:])]
+        return numpy.concatenate(pool.map(predict_function, chunks))
+
+    def _make_validation_score(self, X, y, sample_weight=None):
+        """Returns function, which computes the score on validation dataset from predicted scores"""
+        sample_weight = check_sample_weight(y, sample_weight=sample_weight)
+        X = pandas.DataFrame(X)
+        y = numpy.array(column_or_1d(y), dtype=int)
+        if self.eval_metric is None:
+            assert self.loss.computes_value, \
+                '{} does not compute its value, eval_metric is needed for eval_set'.format(type(self.loss).__name__)
+            loss = copy.copy(self.loss)
+            loss.fit(X, y, sample_weight=sample_weight)
+            return loss
+        metric = copy.copy(self.eval_metric)
+        metric.fit(X, y, sample_weight=sample_weight)
+        return lambda score: metric(y, score_to_proba(score), sample_weight=sample_weight)
+
+    def _make_tree(self):
+        if self.splitter == 'histogram':
+            return HistogramTreeRegressor(
                 criterion=self.criterion,
-                splitter=self.splitter,
                 max_depth=self.max_depth,
                 min_samples_split=self.min_samples_split,
                 min_samples_leaf=self.min_samples_leaf,
                 max_features=self.max_features,
                 random_state=self.random_state,
-                max_leaf_nodes=self.max_leaf_nodes)
-
-            # tree learning
-            residual = self.loss.negative_gradient(y_pred)
-            train_indices = self.random_state.choice(n_samples, size=n_inbag, replace=False)
-
-            tree.fit(X[train_indices], residual[train_indices],
-                     sample_weight=sample_weight[train_indices], check_input=False)
-            # update tree leaves
-            if self.update_tree:
-                self.loss.update_tree(tree.tree_, X=X, y=y, y_pred=y_pred, sample_weight=sample_weight,
-                                      update_mask=numpy.ones(len(X), dtype=bool), residual=residual)
-
-            y_pred += self.learning_rate * tree.predict(X)
-            self.estimators.append(tree)
-            self.scores.append(self.loss(y_pred))
-        return self
+                n_threads=self.n_threads)
+        return DecisionTreeRegressor(
+            criterion=self.criterion,
+            splitter=self.splitter,
+            max_depth=self.max_depth,
+            min_samples_split=self.min_samples_split,
+            min_samples_leaf=self.min_samples_leaf,
+            max_features=self.max_features,
+            random_state=self.random_state,
+            max_leaf_nodes=self.max_leaf_nodes)
 
     def get_train_vars(self, X):
         if self.train_variables is None:
@@ -129,21 +389,45 @@ class uGradientBoostingClassifier(BaseEstimator, ClassifierMixin):
         else:
             return X.loc[:, self.train_variables]
 
-    def staged_predict_score(self, X):
+    def _get_packed_trees(self):
+        if getattr(self, '_packed_trees', None) is None or self._packed_trees.n_trees != len(self.estimators):
+            self._packed_trees = PackedTrees([tree.tree_ for tree in self.estimators])
+        return self._packed_trees
+
+    def _prepare_for_prediction(self, X):
         X = self.get_train_vars(X)
+        X, = check_arrays(X, dtype=DTYPE, sparse_format="dense")
         y_pred = numpy.zeros(len(X))
         if self.init_estimator is not None:
             y_pred += numpy.ravel(self.init_estimator.predict(X))
+        return X, y_pred
 
-        for estimator in self.estimators:
-            y_pred += self.learning_rate * estimator.predict(X)
-            yield y_pred
+    def staged_predict_score(self, X):
+        X, y_pred = self._prepare_for_prediction(X)
+        packed_trees = self._get_packed_trees()
+        # trees are evaluated in blocks, memory is bounded by max_batch_elements
+        block_size = max(1, self.max_batch_elements // max(len(X), 1))
+        for block_start in range(0, packed_trees.n_trees, block_size):
+            trees = slice(block_start, block_start + block_size)
+            for tree_predictions in packed_trees.predict_trees(X, trees=trees).T:
+                y_pred += self.learning_rate * tree_predictions
+                yield y_pred
 
-    def predict_score(self, X):
-        result = None
-        for score in self.staged_predict_score(X):
-            result = score
-        return result
+    def predict_score(self, X, chunk_size=None):
+        """
+        :param chunk_size: number of events evaluated at once, by default is chosen to keep memory bounded,
+            scoring of large datasets happens chunk by chunk.
+        """
+        X, y_pred = self._prepare_for_prediction(X)
+        packed_trees = self._get_packed_trees()
+        if chunk_size is None:
+            chunk_size = max(1, self.max_batch_elements // max(packed_trees.n_trees, 1))
+        for start in range(0, len(X), chunk_size):
+            rows = slice(start, start + chunk_size)
+            # summing in the same order as in staged predictions
+            for tree_predictions in packed_trees.predict_trees(X[rows]).T:
+                y_pred[rows] += self.learning_rate * tree_predictions
+        return y_pred
 
     def staged_predict_proba(self, X):
         for score in self.staged_predict_score(X):
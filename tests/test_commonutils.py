@@ -1,12 +1,16 @@
 from __future__ import division, print_function, absolute_import
 
+import os
+import shutil
+import tempfile
 import numpy
 import pandas
 from numpy.random.mtrand import RandomState
 from sklearn.metrics.pairwise import pairwise_distances
 from hep_ml import commonutils
-from hep_ml.commonutils import weighted_percentile, build_normalizer, \
-    compute_cut_for_efficiency, generate_sample, computeSignalKnnIndices, computeKnnIndicesOfSameClass
+from hep_ml.commonutils import weighted_percentile, weighted_percentiles, SortedColumns, DebugRecorder, \
+    TrainingProfiler, build_normalizer, compute_cut_for_efficiency, generate_sample, computeSignalKnnIndices, \
+    computeKnnIndicesOfSameClass
 
 
 def test_splitting():
@@ -52,6 +56,22 @@ def test_weighted_percentile():
     check_weighted_percentile(20, 100)
 
 
+def test_weighted_percentiles(n_samples=200, n_columns=7):
+    random = RandomState()
+    arrays = random.normal(size=[n_samples, n_columns])
+    # some equal values
+    arrays[:n_samples // 2, 0] = 1.
+    weights = random.exponential(size=n_samples)
+    quantiles = numpy.concatenate([[0., 1.], random.uniform(size=20)])
+    for old_style in [False, True]:
+        sorted_columns = SortedColumns(arrays, sample_weight=weights, old_style=old_style)
+        result = weighted_percentiles(sorted_columns, quantiles)
+        assert result.shape == (len(quantiles), n_columns)
+        for column in range(n_columns):
+            expected = weighted_percentile(arrays[:, column], quantiles, sample_weight=weights, old_style=old_style)
+            assert numpy.allclose(result[:, column], expected), 'different from weighted_percentile'
+
+
 def test_build_normalizer(checks=10):
     predictions = numpy.array(RandomState().normal(size=2000))
     result = build_normalizer(predictions)(predictions)
@@ -109,3 +129,57 @@ def test_compute_knn_indices(n_events=100):
         assert numpy.all(is_signal[neighbours] == is_signal[i]), "returned indices are not signal/bg"
 
 test_compute_knn_indices()
+
+
+def test_debug_recorder(n_events=100, n_records=10):
+    arrays = [numpy.random.normal(size=n_events) for _ in range(n_records)]
+    recorder = DebugRecorder.create(True)
+    for array in arrays:
+        recorder.record('x', array)
+    arrays[0][:] = 0
+    assert len(recorder['x']) == n_records and numpy.all(recorder['x'][0] != 0), 'the copy should be saved'
+    # unknown names behave as in defaultdict(list)
+    assert recorder['y'] == [] and 'y' not in recorder
+    assert list(recorder) == ['x'] and [name for name, _ in recorder.items()] == ['x']
+
+    settings = DebugRecorder(max_records=3, dtype=numpy.float16, n_events=20)
+    recorder = DebugRecorder.create(settings)
+    assert recorder is not settings
+    for array in arrays:
+        recorder.record('x', array)
+    assert len(recorder['x']) == 3
+    assert recorder['x'][0].dtype == numpy.float16 and recorder['x'][0].shape == (20, )
+
+    directory = tempfile.mkdtemp()
+    try:
+        recorder = DebugRecorder(directory=directory, dtype=numpy.float32).fresh()
+        for array in arrays:
+            recorder.record('x', array)
+        assert recorder['x'].shape == (n_records, n_events)
+        assert numpy.allclose(recorder['x'][-1], arrays[-1])
+        # files of records are removed by close
+        assert len(os.listdir(directory)) == 1
+        recorder.close()
+        assert len(os.listdir(directory)) == 0 and 'x' not in recorder
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_training_profiler(n_stages=3):
+    profiler = TrainingProfiler.create(TrainingProfiler(trace_memory=True))
+    for stage in range(n_stages):
+        profiler.start_stage(stage)
+        with profiler.phase('allocation'):
+            array = numpy.ones(100000)
+        with profiler.phase('sum'):
+            array.sum()
+    info = profiler.finish()
+    assert list(info.index) == list(range(n_stages))
+    assert list(info.columns) == ['allocation', 'allocation_memory', 'sum', 'sum_memory']
+    # on later stages the previous array is released
+    assert info.loc[0, 'allocation_memory'] >= array.nbytes
+
+    disabled = TrainingProfiler.create(False)
+    with disabled.phase('sum'):
+        array.sum()
+    assert disabled.finish() is None
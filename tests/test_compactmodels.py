@@ -0,0 +1,45 @@
+from __future__ import division, print_function, absolute_import
+import os
+import shutil
+import tempfile
+import numpy
+import pandas
+from sklearn.tree import DecisionTreeClassifier
+from hep_ml.commonutils import generate_sample
+from hep_ml.losses import BinFlatnessLossFunction
+from hep_ml.ugradientboosting import uGradientBoostingClassifier
+from hep_ml.uboost import uBoostClassifier
+from hep_ml.compactmodels import export_model, load_model
+
+
+def check_export(classifier, X):
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, 'model.npz')
+        export_model(classifier, filename)
+        model = load_model(filename)
+        assert model.train_variables == classifier.train_variables
+        assert numpy.allclose(model.predict_proba(X), classifier.predict_proba(X))
+        assert numpy.all(model.predict(X) == classifier.predict(X))
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_export(n_samples=1000):
+    trainX, trainY = generate_sample(n_samples, 10, 0.6)
+    testX, testY = generate_sample(n_samples, 10, 0.6)
+    for splitter in ['best', 'histogram']:
+        ugb = uGradientBoostingClassifier(loss=BinFlatnessLossFunction(['column0']), n_estimators=10,
+                                          splitter=splitter, train_variables=['column1', 'column2', 'column3'])
+        check_export(ugb.fit(trainX, trainY), testX)
+
+    for algorithm in ['SAMME', 'SAMME.R']:
+        uboost = uBoostClassifier(uniform_variables=['column0'], n_neighbors=20, efficiency_steps=3,
+                                  n_estimators=10, algorithm=algorithm,
+                                  base_estimator=DecisionTreeClassifier(max_depth=3))
+        check_export(uboost.fit(trainX, trainY), testX)
+
+    # integer names of columns
+    trainX, testX = pandas.DataFrame(trainX.values), pandas.DataFrame(testX.values)
+    ugb = uGradientBoostingClassifier(loss=BinFlatnessLossFunction([0]), n_estimators=10, train_variables=[1, 2, 3])
+    check_export(ugb.fit(trainX, trainY), testX)
@@ -5,12 +5,15 @@ from sklearn.ensemble.gradient_boosting import GradientBoostingClassifier
 from sklearn.metrics.metrics import roc_auc_score
 from sklearn.tree.tree import DecisionTreeRegressor
 from hep_ml.commonutils import generate_sample
+from hep_ml.losses import BinFlatnessLossFunction
+from hep_ml.metrics import BinBasedSDE
 from hep_ml.ugradientboosting import AdaLossFunction, BinomialDevianceLossFunction as BinomialDeviance, \
     uGradientBoostingClassifier
 from hep_ml.experiments.categorical import CategoricalTreeRegressor, SimpleCategoricalRegressor, ObliviousCategoricalRegressor, \
     CategoricalLinearClassifier
 from hep_ml.experiments.fasttree import FastTreeRegressor, FastNeuroTreeRegressor
-from hep_ml.experiments.fastgb import TreeGradientBoostingClassifier, CommonGradientBoosting, FoldingGBClassifier
+from hep_ml.experiments.fastgb import TreeGradientBoostingClassifier, CommonGradientBoosting, FoldingGBClassifier, \
+    StageTimer, ValidationMonitor
 import time
 
 __author__ = 'Alex Rogozhnikov'
@@ -58,6 +61,75 @@ def test_refitting(n_samples=10000, n_features=10, distance=0.5):
 # test_refitting()
 
 
+def test_callbacks(n_samples=2000, n_features=10, distance=0.5):
+    trainX, trainY = generate_sample(n_samples=n_samples, n_features=n_features, distance=distance)
+    testX, testY = generate_sample(n_samples=n_samples, n_features=n_features, distance=distance)
+    timer = StageTimer()
+    monitor = ValidationMonitor(testX, testY)
+    booster = TreeGradientBoostingClassifier(n_estimators=20, loss=BinomialDeviance(),
+                                             base_estimator=FastTreeRegressor(max_depth=3))
+    booster.fit(trainX, trainY, callbacks=[timer, monitor])
+    assert len(booster.estimators) == len(timer.times) == len(monitor.scores) == 20
+    # orders of features and binned data are used only during fit
+    assert booster._feature_orders is None and booster._X_binned is None
+    binned = TreeGradientBoostingClassifier(n_estimators=20, loss=BinomialDeviance(), max_bins=64,
+                                            base_estimator=FastTreeRegressor(max_depth=3)).fit(trainX, trainY)
+    assert binned._X_binned is None and binned._bin_edges is None
+    assert roc_auc_score(testY, binned.predict_proba(testX)[:, 1]) > 0.8
+
+    # validation scores are the same as computed from staged predictions
+    loss = BinomialDeviance()
+    loss.fit(testX, testY, sample_weight=numpy.ones(n_samples))
+    for score, stage_score in zip(monitor.scores, booster.staged_predict_score(testX)):
+        assert numpy.allclose(score, loss(stage_score))
+
+    # early stopping, trees after the best stage are dropped
+    monitor = ValidationMonitor(testX, testY, early_stopping_rounds=3)
+    booster = TreeGradientBoostingClassifier(n_estimators=200, learning_rate=1., loss=BinomialDeviance(),
+                                             base_estimator=FastTreeRegressor(max_depth=6))
+    booster.fit(trainX, trainY, callbacks=[monitor])
+    assert len(monitor.scores) < 200
+    assert len(monitor.scores) == monitor.best_stage + 4
+    assert len(booster.estimators) == len(booster.scores) == monitor.best_stage + 1
+
+    # flatness losses don't compute their value, so metric is required
+    booster = TreeGradientBoostingClassifier(n_estimators=20, loss=BinFlatnessLossFunction(['column0']),
+                                             update_tree=False, base_estimator=FastTreeRegressor(max_depth=3))
+    try:
+        booster.fit(trainX, trainY, callbacks=[ValidationMonitor(testX, testY, early_stopping_rounds=3)])
+    except AssertionError:
+        pass
+    else:
+        raise AssertionError('flatness loss should not be used as validation score')
+    monitor = ValidationMonitor(testX, testY, metric=BinBasedSDE(['column0'], uniform_label=1),
+                                early_stopping_rounds=3)
+    booster.fit(trainX, trainY, callbacks=[monitor])
+    assert len(booster.estimators) == monitor.best_stage + 1
+    assert numpy.std(monitor.scores) > 0
+
+
+def test_threads(n_samples=2000, n_features=10, distance=0.5):
+    trainX, trainY = generate_sample(n_samples=n_samples, n_features=n_features, distance=distance)
+    testX, testY = generate_sample(n_samples=n_samples, n_features=n_features, distance=distance)
+    # folds are trained in parallel, results are collected in the same order
+    for subsample in [1., 0.7, 0.3]:
+        predictions = []
+        for n_threads in [1, 4]:
+            booster = FoldingGBClassifier(loss=BinomialDeviance(), n_estimators=10, n_folds=4, n_threads=n_threads,
+                                          subsample=subsample, random_state=42,
+                                          base_estimator=FastTreeRegressor(max_depth=3, random_state=42))
+            predictions.append(booster.fit(trainX, trainY).predict_score(testX))
+        assert numpy.allclose(predictions[0], predictions[1]), subsample
+
+    # n_threads of boosting is passed to trees
+    predictions = []
+    for n_threads in [1, 3]:
+        booster = TreeGradientBoostingClassifier(loss=BinomialDeviance(), n_estimators=10, n_threads=n_threads,
+                                                 base_estimator=FastTreeRegressor(max_depth=3, random_state=42))
+        predictions.append(booster.fit(trainX, trainY).predict_score(testX))
+        assert all(tree.n_threads == n_threads for tree in booster.estimators)
+    assert numpy.allclose(predictions[0], predictions[1])
+
 
 def test_gb_quality(n_samples=10000, n_features=10, distance=0.5):
     trainX, trainY = generate_sample(n_samples=n_samples, n_features=n_features, distance=distance)
@@ -131,5 +203,4 @@ def test_categorical_gb(n_samples=100000, n_features=10, p=0.7):
         print(name, "spent:{:3.2f} auc:{}".format(time.time() - start, auc))
 
 
-
-test_categorical_gb()
\ No newline at end of file
+# test_categorical_gb()
\ No newline at end of file
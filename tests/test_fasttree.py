@@ -5,8 +5,12 @@ import numpy
 import time
 from sklearn.metrics import roc_auc_score
 from hep_ml.commonutils import generate_sample
-from hep_ml.experiments.fasttree import FastTreeRegressor
+from hep_ml.histogramtree import BinQuantizer
+from hep_ml.experiments.categorical import CategoricalTreeRegressor
+from hep_ml.experiments.fasttree import FastTreeRegressor, FastObliviousTreeRegressor, FastNeuroTreeRegressor, \
+    compute_feature_orders, predict_oblivious_ensemble, _fit_linear_regressions
 from sklearn.tree import DecisionTreeRegressor
+from sklearn.linear_model import LinearRegression
 
 __author__ = 'Alex Rogozhnikov'
 
@@ -27,9 +31,174 @@ def test_tree(n_samples=1000):
 
     # Testing apply method
     indices1, values1 = tree.apply(X)
-    indices2, values2 = tree.fast_apply(X)
+    indices2, values2 = tree._recursive_apply(X)
 
+    assert numpy.all(indices1 == indices2), 'two apply methods give different results'
     assert numpy.all(values1 == values2), 'two apply methods give different results'
+    assert numpy.all(tree.children_left[indices1] == indices1), 'events should be in leaves'
+
+
+def test_feature_orders(n_samples=1000):
+    """
+    Tree trained with presorted features should coincide with usual one when all events are used in nodes
+    """
+    X, y = generate_sample(n_samples=n_samples, n_features=5)
+    X = numpy.array(X)
+    w = numpy.random.random(n_samples)
+    for criterion in ['mse', 'fmse', 'entropy']:
+        tree1 = FastTreeRegressor(criterion=criterion, max_events_used=n_samples, random_state=42).fit(X, y, w)
+        tree2 = FastTreeRegressor(criterion=criterion, max_events_used=n_samples, random_state=42)
+        tree2.fit(X, y, w, feature_orders=compute_feature_orders(X))
+        assert numpy.allclose(tree1.predict(X), tree2.predict(X))
+
+    # subsampling in nodes
+    tree = FastTreeRegressor(max_events_used=100).fit(X, y, w, feature_orders=compute_feature_orders(X))
+    assert roc_auc_score(y, tree.predict(X)) > 0.7
+
+
+def test_level_wise(n_samples=1000):
+    """
+    Level-wise building should give the same tree as recursive when all events are used in nodes
+    """
+    X, y = generate_sample(n_samples=n_samples, n_features=5)
+    X = numpy.array(X)
+    w = numpy.random.random(n_samples)
+    # continuous target, otherwise all splits of pure nodes have the same cost
+    target = y + numpy.random.random(n_samples)
+    for criterion in ['mse', 'fmse']:
+        tree1 = FastTreeRegressor(criterion=criterion, max_events_used=n_samples, random_state=42)
+        tree1.fit(X, target, w)
+        tree2 = FastTreeRegressor(criterion=criterion, max_events_used=n_samples, random_state=42, level_wise=True)
+        tree2.fit(X, target, w)
+        assert tree1.node_count == tree2.node_count
+        assert numpy.allclose(tree1.predict(X), tree2.predict(X))
+
+    tree = FastTreeRegressor(max_events_used=100, max_features=3, level_wise=True).fit(X, y, w)
+    assert roc_auc_score(y, tree.predict(X)) > 0.7
+
+
+def test_node_sampling(n_samples=1000):
+    X, y = generate_sample(n_samples=n_samples, n_features=5)
+    X = numpy.array(X)
+    w = numpy.random.random(n_samples)
+    for sampling in ['choice', 'permutation', 'stratified']:
+        for max_features in [None, 3]:
+            tree = FastTreeRegressor(max_events_used=100, max_features=max_features, sampling=sampling)
+            tree.fit(X, 2. * y - 1., w)
+            assert roc_auc_score(y, tree.predict(X)) > 0.8
+            # with feature_orders the same events are taken from nodes
+            presorted = FastTreeRegressor(max_events_used=100, max_features=max_features, sampling=sampling,
+                                          random_state=42)
+            presorted.fit(X, 2. * y - 1., w, feature_orders=compute_feature_orders(X))
+            if sampling != 'choice':
+                tree = FastTreeRegressor(max_events_used=100, max_features=max_features, sampling=sampling,
+                                         random_state=42).fit(X, 2. * y - 1., w)
+                assert numpy.allclose(presorted.predict(X), tree.predict(X))
+            assert roc_auc_score(y, presorted.predict(X)) > 0.8
+
+    for sampling, params in [('unknown', {}), ('permutation', {'level_wise': True})]:
+        try:
+            FastTreeRegressor(sampling=sampling, **params).fit(X, y, w)
+        except AssertionError:
+            pass
+        else:
+            raise AssertionError('sampling {} should not be accepted with {}'.format(sampling, params))
+
+    # in each prefix of stratified order the fraction of positive targets is kept
+    target = numpy.repeat([1., -1.], [n_samples // 4, n_samples - n_samples // 4])
+    tree = FastTreeRegressor(sampling='stratified', random_state=numpy.random.RandomState(42))
+    order = tree._compute_sampling_order(target)
+    assert numpy.all(numpy.sort(order) == numpy.arange(n_samples))
+    for length in [40, 100, 500]:
+        assert numpy.sum(target[order[:length]] > 0) == length // 4
+
+
+def test_threads(n_samples=1000):
+    """
+    Split search in parallel groups of features gives the same tree
+    """
+    X, y = generate_sample(n_samples=n_samples, n_features=5)
+    X = numpy.array(X)
+    w = numpy.random.random(n_samples)
+    for feature_orders in [None, compute_feature_orders(X)]:
+        tree1 = FastTreeRegressor(random_state=42).fit(X, y, w, feature_orders=feature_orders)
+        tree2 = FastTreeRegressor(random_state=42, n_threads=3).fit(X, y, w, feature_orders=feature_orders)
+        assert numpy.all(tree1.predict(X) == tree2.predict(X))
+    tree1 = FastNeuroTreeRegressor(random_state=42).fit(X, y, w)
+    tree2 = FastNeuroTreeRegressor(random_state=42, n_threads=2).fit(X, y, w)
+    assert numpy.all(tree1.predict(X) == tree2.predict(X))
+
+
+def test_binned_tree(n_samples=200):
+    """
+    When number of bins is greater than number of events, splits from histograms coincide with usual ones
+    """
+    X, y = generate_sample(n_samples=n_samples, n_features=5)
+    X = numpy.array(X)
+    w = numpy.random.random(n_samples)
+    quantizer = BinQuantizer(max_bins=256).fit(X)
+    X_binned = quantizer.transform(X)
+    target = y + numpy.random.random(n_samples)
+    for criterion in ['mse', 'fmse']:
+        tree1 = FastTreeRegressor(criterion=criterion, max_events_used=n_samples, min_samples_split=10)
+        tree1.fit(X, target, w)
+        tree2 = FastTreeRegressor(criterion=criterion, min_samples_split=10)
+        tree2.fit(X_binned, target, w, bin_edges=quantizer.bin_edges)
+        assert numpy.allclose(tree1.predict(X), tree2.predict(X))
+
+    quantizer = BinQuantizer(max_bins=16).fit(X)
+    for criterion in ['mse', 'pvalue', 'entropy']:
+        tree = FastTreeRegressor(criterion=criterion, max_features=3)
+        tree.fit(quantizer.transform(X), 2. * y - 1., w, bin_edges=quantizer.bin_edges)
+        assert roc_auc_score(y, tree.predict(X)) > 0.8
+
+
+def test_neuro_tree(n_samples=1000):
+    # linear regressions fitted together coincide with sklearn ones
+    data = numpy.random.normal(size=[5, 50, 3])
+    target = numpy.random.normal(size=50)
+    coefficients = _fit_linear_regressions(data, target)
+    for regression_data, regression_coefficients in zip(data, coefficients):
+        assert numpy.allclose(regression_coefficients, LinearRegression().fit(regression_data, target).coef_)
+
+    X, y = generate_sample(n_samples=n_samples, n_features=5)
+    X = numpy.array(X)
+    w = numpy.random.random(n_samples)
+    tree = FastNeuroTreeRegressor(max_depth=4).fit(X, y, w)
+    assert roc_auc_score(y, tree.predict(X)) > 0.8
+
+
+def test_apply_other_splits(n_samples=1000):
+    """
+    Level-by-level apply of trees with other types of splits gives the same leaves as recursive one
+    """
+    X, y = generate_sample(n_samples=n_samples, n_features=5)
+    X = numpy.array(X)
+    w = numpy.random.random(n_samples)
+    X_categorical = (numpy.abs(X) * 10).astype(int)
+    for tree, data in [(FastNeuroTreeRegressor(max_depth=6, min_samples_split=10), X),
+                       (CategoricalTreeRegressor(max_depth=6, min_samples_split=10), X_categorical)]:
+        tree.fit(data, y, w)
+        indices1, values1 = tree.apply(data)
+        indices2, values2 = tree._recursive_apply(data)
+        assert numpy.all(indices1 == indices2) and numpy.all(values1 == values2)
+
+
+def test_oblivious_tree(n_samples=1000):
+    X, y = generate_sample(n_samples=n_samples, n_features=5)
+    X = numpy.array(X)
+    w = numpy.random.random(n_samples)
+    for criterion in ['mse', 'fmse', 'entropy']:
+        tree = FastObliviousTreeRegressor(max_depth=4, criterion=criterion).fit(X, y, w)
+        assert tree.depth == 4 and tree.node_count == 16
+        assert roc_auc_score(y, tree.predict(X)) > 0.8
+
+    # all trees of ensemble are evaluated together, trees of different depth are possible
+    trees = [FastObliviousTreeRegressor(max_depth=depth, max_features=3).fit(X, y + numpy.random.random(n_samples), w)
+             for depth in [0, 2, 5]]
+    predictions = sum(0.1 * tree.predict(X) for tree in trees)
+    assert numpy.allclose(predictions, predict_oblivious_ensemble(trees, X, tree_weights=[0.1] * len(trees)))
+    assert numpy.all(predict_oblivious_ensemble([], X) == 0) and len(predict_oblivious_ensemble([], X)) == n_samples
 
 
 def test_tree_speed(n_samples=100000, n_features=10):
@@ -51,7 +220,7 @@ def test_tree_speed(n_samples=100000, n_features=10):
     methods = OrderedDict()
     methods['old'] = lambda: regressors['old'].predict(X)
     methods['new'] = lambda: regressors['new'].apply(X)
-    methods['new-fast'] = lambda: regressors['new'].fast_apply(X)
+    methods['new-recursive'] = lambda: regressors['new']._recursive_apply(X)
     for name, method in methods.items():
         start = time.time()
         for _ in range(5):
@@ -0,0 +1,81 @@
+from __future__ import division, print_function, absolute_import
+from multiprocessing.pool import ThreadPool
+import numpy
+from sklearn.tree import DecisionTreeRegressor
+from hep_ml.histogramtree import BinQuantizer, HistogramTreeRegressor
+
+
+def test_histogram_tree(n_samples=2000, n_features=5, max_depth=4):
+    random = numpy.random.RandomState(42)
+    # few unique values, so binning is lossless
+    X = numpy.round(random.normal(size=[n_samples, n_features]), 1)
+    y = X[:, 0] * X[:, 1] + numpy.sin(X[:, 2]) + random.normal(size=n_samples) * 0.1
+    w = random.exponential(size=n_samples)
+
+    quantizer = BinQuantizer(max_bins=256).fit(X)
+    X_binned = quantizer.transform(X)
+    assert X_binned.dtype == numpy.uint8
+    tree = HistogramTreeRegressor(max_depth=max_depth).fit(X_binned, y, w, bin_edges=quantizer.bin_edges)
+    predictions = tree.predict(X)
+    assert numpy.allclose(predictions, tree.value[tree.apply_binned(X_binned), 0, 0])
+
+    sk_tree = DecisionTreeRegressor(max_depth=max_depth).fit(X, y, sample_weight=w)
+    mse = numpy.average((predictions - y) ** 2, weights=w)
+    sk_mse = numpy.average((sk_tree.predict(X) - y) ** 2, weights=w)
+    assert numpy.allclose(mse, sk_mse), 'split finding differs from exact'
+    assert len(numpy.unique(tree.apply(X))) <= 2 ** max_depth
+    assert numpy.allclose(numpy.sum(tree.feature_importances_), 1)
+
+    # coarse binning still works
+    quantizer = BinQuantizer(max_bins=8).fit(X)
+    tree = HistogramTreeRegressor(max_depth=max_depth, min_samples_leaf=50) \
+        .fit(quantizer.transform(X), y, w, bin_edges=quantizer.bin_edges)
+    assert numpy.min(numpy.bincount(tree.apply(X))[numpy.unique(tree.apply(X))]) >= 50
+
+
+def test_histogram_tree_max_features(n_samples=1000, n_features=16):
+    random = numpy.random.RandomState(42)
+    X = random.normal(size=[n_samples, n_features])
+    y = X[:, 0] + random.normal(size=n_samples) * 0.1
+    w = numpy.ones(n_samples)
+    quantizer = BinQuantizer(max_bins=32).fit(X)
+    X_binned = quantizer.transform(X)
+    for max_features, n_used in [(None, 16), ('auto', 4), ('sqrt', 4), ('log2', 4), (3, 3), (100, 16), (0.5, 8),
+                                 (0.01, 1)]:
+        tree = HistogramTreeRegressor(max_depth=3, max_features=max_features, random_state=42)
+        tree.fit(X_binned, y, w, bin_edges=quantizer.bin_edges)
+        assert tree._n_used_features == n_used, max_features
+        assert tree.predict(X).shape == (n_samples,)
+
+
+def test_histogram_tree_nan(n_samples=1000, n_features=4):
+    random = numpy.random.RandomState(42)
+    X = random.normal(size=[n_samples, n_features])
+    y = X[:, 0] + X[:, 1] + random.normal(size=n_samples) * 0.1
+    X[random.random_sample(size=X.shape) < 0.2] = numpy.nan
+    w = numpy.ones(n_samples)
+    quantizer = BinQuantizer(max_bins=32).fit(X)
+    assert all(numpy.all(numpy.isfinite(edges)) for edges in quantizer.bin_edges)
+    X_binned = quantizer.transform(X)
+    tree = HistogramTreeRegressor(max_depth=4).fit(X_binned, y, w, bin_edges=quantizer.bin_edges)
+    # NaN goes right both in binned and in original data
+    assert numpy.all(tree.apply(X) == tree.apply_binned(X_binned))
+
+
+def test_histogram_tree_pool(n_samples=1000, n_features=6):
+    random = numpy.random.RandomState(42)
+    X = random.normal(size=[n_samples, n_features])
+    y = X[:, 0] * X[:, 1] + random.normal(size=n_samples) * 0.1
+    w = numpy.ones(n_samples)
+    quantizer = BinQuantizer(max_bins=32).fit(X)
+    X_binned = quantizer.transform(X)
+    reference = HistogramTreeRegressor(max_depth=4).fit(X_binned, y, w, bin_edges=quantizer.bin_edges)
+    pool = ThreadPool(3)
+    try:
+        # the same pool is reused by several trees
+        for _ in range(2):
+            tree = HistogramTreeRegressor(max_depth=4, n_threads=3)
+            tree.fit(X_binned, y, w, bin_edges=quantizer.bin_edges, pool=pool)
+            assert numpy.allclose(tree.predict(X), reference.predict(X))
+    finally:
+        pool.terminate()
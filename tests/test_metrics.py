@@ -12,7 +12,8 @@ from hep_ml.metrics_utils import compute_sde_on_bins, \
     groups_based_ks, cvm_2samp, _cvm_2samp_fast, bin_based_cvm, group_based_cvm
 
 from hep_ml.metrics import sde, theil_flatness, cvm_flatness, \
-    KnnBasedSDE, KnnBasedTheil, KnnBasedCvM, BinBasedSDE, BinBasedTheil, BinBasedCvM
+    KnnBasedSDE, KnnBasedTheil, KnnBasedCvM, BinBasedSDE, BinBasedTheil, BinBasedCvM, \
+    CutScan, compute_sb
 
 from hep_ml.metrics_utils import bin_to_group_indices, compute_bin_indices
 
@@ -51,6 +52,35 @@ def test_bins(size=500, n_bins=10):
     bins = compute_bin_indices(df[columns].values, bin_limits=[x_limits, x_limits])
     assert numpy.all(0 <= bins) and numpy.all(bins < n_bins * n_bins), "the bins with wrong indices appeared"
 
+    # uniform grid should give the same result as searching, also for values on the edges of bins
+    data = numpy.concatenate([random.normal(size=size), x_limits, [numpy.nan]])[:, numpy.newaxis]
+    for limits in [x_limits, numpy.linspace(-2, 1, n_bins + 1)[1:-1], numpy.sort(random.normal(size=n_bins))]:
+        assert numpy.all(compute_bin_indices(data, bin_limits=[limits]) == numpy.searchsorted(limits, data[:, 0]))
+
+    bins = compute_bin_indices(df[columns].values, n_bins=n_bins)
+    assert numpy.all(numpy.bincount(bins // n_bins, minlength=n_bins) > 0), 'limits are computed wrongly'
+
+
+def test_cut_scan(size=1000):
+    from sklearn.metrics import roc_auc_score
+    y = random.uniform(size=size) > 0.5
+    # rounding to have many equal predictions
+    y_score = numpy.round(random.normal(size=size) + y, 1)
+    sample_weight = random.exponential(size=size)
+    scan = CutScan(y, y_score, sample_weight=sample_weight)
+    assert numpy.allclose(scan.auc(), roc_auc_score(y, y_score, sample_weight=sample_weight))
+
+    cuts = random.normal(size=20)
+    tpr, fpr = scan.efficiencies_at_cuts(cuts)
+    for cut, cut_tpr, cut_fpr in zip(cuts, tpr, fpr):
+        s, b = compute_sb(y, y_score > cut, sample_weight=sample_weight)
+        assert numpy.allclose([s, b], [cut_tpr, cut_fpr]), 'wrong efficiencies at cut'
+
+    fpr, tpr, thresholds = scan.roc_curve()
+    for threshold, threshold_tpr, threshold_fpr in zip(thresholds, tpr, fpr):
+        s, b = compute_sb(y, y_score >= threshold, sample_weight=sample_weight)
+        assert numpy.allclose([s, b], [threshold_tpr, threshold_fpr]), 'wrong roc curve'
+
 
 def test_compare_sde_computations(n_samples=1000, n_bins=10):
     y, pred, weights, bins, groups = generate_binned_dataset(n_samples=n_samples, n_bins=n_bins)
@@ -1,4 +1,5 @@
 from __future__ import division, print_function, absolute_import
+import numpy
 import pandas
 
 from sklearn.ensemble import AdaBoostClassifier, RandomForestClassifier
@@ -67,3 +68,31 @@ def test_reports_efficiency(null_pylab=True):
     predictions.efficiency(trainX.columns[:2], n_bins=12, target_efficiencies=[0.5]).show()
 
 
+def test_reports_threads(null_pylab=True):
+    if null_pylab:
+        reports.pylab = MyNull()
+    threaded = reports.Predictions(classifiers, testX, testY, n_threads=3)
+
+    for name, sde in threaded.sde_curves(['column0'], step=2, return_data=True).items():
+        assert numpy.allclose(sde, predictions.sde_curves(['column0'], step=2, return_data=True)[name])
+
+    rocs = threaded.compute_metrics(stages=[5, 10], metrics=roc_auc_score)
+    assert numpy.allclose(rocs, predictions.compute_metrics(stages=[5, 10], metrics=roc_auc_score))
+    assert numpy.allclose(threaded.compute_metrics(), predictions.compute_metrics())
+
+
+def test_bin_indices_cache():
+    mask = testY == 1
+    bin_indices = predictions._compute_bin_indices(['column0', 'column1'], n_bins=5, mask=mask)
+    assert predictions._compute_bin_indices(['column0', 'column1'], n_bins=5, mask=mask) is bin_indices
+    other = predictions._compute_bin_indices(['column0', 'column1'], n_bins=5, mask=~mask)
+    assert other is not bin_indices
+    for n_bins in range(2, 20):
+        predictions._compute_bin_indices(['column0'], n_bins=n_bins)
+    assert len(predictions._bin_indices_cache) == predictions.bin_indices_cache_size
+    assert numpy.all(predictions._compute_bin_indices(['column0', 'column1'], n_bins=5, mask=mask) == bin_indices)
+    centers = predictions._compute_bin_centers(['column0', 'column1'], n_bins=5, mask=mask)
+    assert len(predictions._bin_indices_cache) == predictions.bin_indices_cache_size
+    assert all(c is other_c for c, other_c in
+               zip(centers, predictions._compute_bin_centers(['column0', 'column1'], n_bins=5, mask=mask)))
+    assert [len(c) for c in centers] == [5, 5]
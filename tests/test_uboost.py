@@ -8,7 +8,7 @@ from sklearn.naive_bayes import GaussianNB
 from sklearn.tree import DecisionTreeClassifier
 from sklearn.ensemble.weight_boosting import AdaBoostClassifier
 
-from hep_ml.commonutils import generate_sample
+from hep_ml.commonutils import generate_sample, DebugRecorder
 from hep_ml.supplementaryclassifiers import HidingClassifier
 from hep_ml.uboost import uBoostBDT, uBoostClassifier
 from hep_ml.reports import Predictions, ClassifiersDict
@@ -149,3 +149,48 @@ def check_classifiers(n_samples=10000, output_name_pattern=None):
     if output_name_pattern is not None:
         pl.savefig(output_name_pattern % "efficiency_curves", bbox="tight")
 
+
+def test_warm_start(n_samples=1000):
+    trainX, trainY = generate_sample(n_samples, 10, 0.6)
+    testX, testY = generate_sample(n_samples, 10, 0.6)
+    params = dict(uniform_variables=['column0'], n_neighbors=20, random_state=42,
+                  base_estimator=DecisionTreeClassifier(max_depth=4))
+    reference = uBoostBDT(n_estimators=20, **params).fit(trainX, trainY)
+    warm = uBoostBDT(n_estimators=8, warm_start=True, **params).fit(trainX, trainY)
+    assert len(warm.estimators_) == 8
+    warm.n_estimators = 20
+    warm.fit(trainX, trainY)
+    assert len(warm.estimators_) == len(warm.score_cuts_) == 20
+    assert np.allclose(warm.score_cuts_, reference.score_cuts_)
+    assert np.allclose(warm.predict_score(testX), reference.predict_score(testX))
+
+    # the first fit without warm_start, then warm_start is switched on
+    warm = uBoostBDT(n_estimators=8, **params).fit(trainX, trainY)
+    warm.warm_start, warm.n_estimators = True, 20
+    warm.fit(trainX, trainY)
+    assert len(warm.estimators_) == 20
+    assert np.allclose(warm.predict_score(testX), reference.predict_score(testX))
+
+
+def test_debug_info(n_samples=1000):
+    trainX, trainY = generate_sample(n_samples, 10, 0.6)
+    recorder = DebugRecorder(max_records=5, dtype=np.float16, n_events=100)
+    uBDT = uBoostBDT(uniform_variables=['column0'], n_neighbors=20, n_estimators=20, keep_debug_info=recorder)
+    uBDT.fit(trainX, trainY)
+    assert len(uBDT.debug_dict['weights']) == len(uBDT.debug_dict['local_effs']) == 5
+    assert uBDT.debug_dict['weights'][0].shape == (100, )
+
+
+def test_profiling(n_samples=1000):
+    trainX, trainY = generate_sample(n_samples, 10, 0.6)
+    uBDT = uBoostBDT(uniform_variables=['column0'], n_neighbors=20, n_estimators=10, profile=True)
+    uBDT.fit(trainX, trainY)
+    assert list(uBDT.profiling_info.index) == [-1] + list(range(10))
+    assert set(uBDT.profiling_info.columns) == {'neighbours', 'fit_tree', 'predict', 'reweighting', 'cuts', 'voting'}
+
+    # profiler isn't kept after failed fit
+    try:
+        uBDT.fit(trainX, trainY, neighbours_matrix=np.zeros([n_samples, 1], dtype=int))
+    except AssertionError:
+        pass
+    assert not hasattr(uBDT, '_profiler')
@@ -4,6 +4,7 @@ from hep_ml.commonutils import generate_sample
 from hep_ml.losses import compute_positions, BinomialDevianceLossFunction, SimpleKnnLossFunction, \
     BinFlatnessLossFunction, KnnFlatnessLossFunction
 from hep_ml.ugradientboosting import uGradientBoostingClassifier
+from hep_ml.metrics import BinBasedSDE
 
 
 def check_orders(size=40):
@@ -56,3 +57,162 @@ def test_gradient_boosting(n_samples=1000):
             .fit(trainX[:n_samples], trainY[:n_samples]).score(testX, testY)
         assert result >= 0.7, "The quality is too poor: %.3f" % result
 
+
+def test_gb_histogram(n_samples=1000, distance=0.6):
+    testX, testY = generate_sample(n_samples, 10, distance)
+    trainX, trainY = generate_sample(n_samples, 10, distance)
+    uniform_variables = ['column0']
+    for loss in [BinomialDevianceLossFunction(), BinFlatnessLossFunction(uniform_variables, ada_coefficient=0.5),
+                 KnnFlatnessLossFunction(uniform_variables, ada_coefficient=0.5),
+                 BinFlatnessLossFunction(uniform_variables, ada_coefficient=0.5, use_median=True),
+                 KnnFlatnessLossFunction(uniform_variables, ada_coefficient=0.5, use_median=True)]:
+        for update_tree in [False, True]:
+            clf = uGradientBoostingClassifier(loss=loss, min_samples_split=20, max_depth=5, learning_rate=.2,
+                                              subsample=0.7, n_estimators=20, splitter='histogram', max_bins=64,
+                                              update_tree=update_tree)
+            clf.fit(trainX, trainY)
+            assert clf.predict_proba(testX).shape == (n_samples, 2)
+            assert len(clf.feature_importances_) == 10
+            # without use_median flatness losses put clipped y_pred of one event in each leaf,
+            # so after update_tree the trees do not fit residuals at all and no quality is expected
+            if not update_tree or getattr(loss, 'use_median', True):
+                result = clf.score(testX, testY)
+                assert result >= 0.7, "The quality is too poor: %.3f" % result
+
+
+def test_packed_trees(n_samples=1000, n_features=10):
+    trainX, trainY = generate_sample(n_samples, n_features)
+    testX, testY = generate_sample(n_samples, n_features)
+    for splitter in ['best', 'histogram']:
+        clf = uGradientBoostingClassifier(loss=BinomialDevianceLossFunction(), n_estimators=15, max_depth=4,
+                                          subsample=0.7, splitter=splitter).fit(trainX, trainY)
+        score = numpy.zeros(n_samples)
+        for tree in clf.estimators:
+            score += clf.learning_rate * tree.predict(testX.values.astype('float32'))
+        assert numpy.allclose(score, clf.predict_score(testX))
+        assert numpy.allclose(score, clf.predict_score(testX, chunk_size=77))
+        # blocks of trees in staged predictions
+        clf.max_batch_elements = 3 * n_samples
+        for stage, staged_score in enumerate(clf.staged_predict_score(testX)):
+            pass
+        assert stage + 1 == len(clf.estimators)
+        assert numpy.allclose(staged_score, score)
+        # refitting on other data with the same number of trees shouldn't use old packed trees
+        clf.fit(testX, testY)
+        score = numpy.zeros(n_samples)
+        for tree in clf.estimators:
+            score += clf.learning_rate * tree.predict(testX.values.astype('float32'))
+        assert numpy.allclose(score, clf.predict_score(testX))
+
+
+def test_early_stopping(n_samples=1000):
+    trainX, trainY = generate_sample(n_samples, 10, distance=0.6)
+    validX, validY = generate_sample(n_samples, 10, distance=0.6)
+    clf = uGradientBoostingClassifier(loss=BinomialDevianceLossFunction(), n_estimators=100, learning_rate=0.5,
+                                      max_depth=6, early_stopping_rounds=5)
+    clf.fit(trainX, trainY, eval_set=(validX, validY))
+    best_stage = numpy.argmin(clf.validation_scores)
+    assert len(clf.validation_scores) == best_stage + 6 < 100
+    assert len(clf.estimators) == best_stage + 1
+    deviance = BinomialDevianceLossFunction()
+    deviance.fit(validX, validY, sample_weight=numpy.ones(n_samples))
+    assert numpy.allclose(deviance(clf.predict_score(validX)), clf.validation_scores[best_stage])
+
+    # uniformity metric
+    clf = uGradientBoostingClassifier(loss=BinomialDevianceLossFunction(), n_estimators=20,
+                                      eval_metric=BinBasedSDE(['column0'], uniform_label=1))
+    clf.fit(trainX, trainY, eval_set=(validX, validY, numpy.ones(n_samples)))
+    assert len(clf.validation_scores) == len(clf.estimators) == 20
+
+    # flatness losses don't compute their value, so eval_metric is required
+    loss = BinFlatnessLossFunction(['column0'], ada_coefficient=0.5)
+    clf = uGradientBoostingClassifier(loss=loss, n_estimators=20, early_stopping_rounds=5)
+    try:
+        clf.fit(trainX, trainY, eval_set=(validX, validY))
+    except AssertionError:
+        pass
+    else:
+        raise AssertionError('flatness loss should not be used as validation score')
+    clf = uGradientBoostingClassifier(loss=loss, n_estimators=20, learning_rate=0.5, early_stopping_rounds=5,
+                                      eval_metric=BinBasedSDE(['column0'], uniform_label=1))
+    clf.fit(trainX, trainY, eval_set=(validX, validY))
+    assert len(clf.estimators) == numpy.argmin(clf.validation_scores) + 1
+    assert numpy.std(clf.validation_scores) > 0
+
+
+def test_warm_start(n_samples=1000):
+    trainX, trainY = generate_sample(n_samples, 10, distance=0.6)
+    testX, testY = generate_sample(n_samples, 10, distance=0.6)
+    for splitter in ['best', 'histogram']:
+        params = dict(loss=BinFlatnessLossFunction(['column0'], ada_coefficient=0.5), max_depth=4, subsample=0.7,
+                      splitter=splitter)
+        reference = uGradientBoostingClassifier(n_estimators=20, random_state=42, **params).fit(trainX, trainY)
+        warm = uGradientBoostingClassifier(n_estimators=8, random_state=42, warm_start=True, **params)
+        warm.fit(trainX, trainY)
+        warm.n_estimators = 20
+        warm.eval_metric = BinBasedSDE(['column0'], uniform_label=1)
+        warm.fit(trainX, trainY, eval_set=(testX, testY))
+        assert len(warm.estimators) == len(warm.scores) == len(warm.validation_scores) == 20
+        assert numpy.allclose(warm.scores, reference.scores)
+        assert numpy.allclose(warm.predict_score(testX), reference.predict_score(testX))
+
+        # the first fit without warm_start, then warm_start is switched on
+        warm = uGradientBoostingClassifier(n_estimators=8, random_state=42, **params).fit(trainX, trainY)
+        warm.set_params(warm_start=True, n_estimators=20)
+        warm.fit(trainX, trainY)
+        assert len(warm.estimators) == 20
+        assert numpy.allclose(warm.predict_score(testX), reference.predict_score(testX))
+
+
+def test_subsample_blocks(n_samples=1000):
+    trainX, trainY = generate_sample(n_samples, 10, distance=0.6)
+    testX, testY = generate_sample(n_samples, 10, distance=0.6)
+    for splitter in ['best', 'histogram']:
+        clf = uGradientBoostingClassifier(loss=BinFlatnessLossFunction(['column0'], ada_coefficient=0.5),
+                                          n_estimators=20, max_depth=5, subsample=0.6, splitter=splitter,
+                                          subsample_method='blocks', update_tree=False)
+        result = clf.fit(trainX, trainY).score(testX, testY)
+        assert result >= 0.7, "The quality is too poor: %.3f" % result
+
+    # all events should be in-bag equally often
+    n_trees, subsample = 2000, 0.6
+    clf.random_state = numpy.random.RandomState(42)
+    in_bag_counts = numpy.zeros(n_samples)
+    for _ in range(n_trees):
+        in_bag_counts[numpy.arange(n_samples)[clf._sample_block(n_samples, int(subsample * n_samples))]] += 1
+    assert numpy.all(numpy.abs(in_bag_counts / n_trees - subsample) < 0.1), 'in-bag frequencies are not uniform'
+    # without subsampling all data is used without copying
+    assert clf._sample_block(n_samples, n_samples) == slice(None)
+
+
+def test_threads(n_samples=1000):
+    trainX, trainY = generate_sample(n_samples, 10, distance=0.6)
+    testX, testY = generate_sample(n_samples, 10, distance=0.6)
+    for splitter in ['best', 'histogram']:
+        predictions = []
+        for n_threads in [1, 3]:
+            clf = uGradientBoostingClassifier(loss=BinomialDevianceLossFunction(), n_estimators=10, max_depth=4,
+                                              subsample=0.7, splitter=splitter, random_state=42, n_threads=n_threads)
+            predictions.append(clf.fit(trainX, trainY).predict_score(testX))
+        assert numpy.allclose(predictions[0], predictions[1])
+
+
+def test_profiling(n_samples=1000):
+    trainX, trainY = generate_sample(n_samples, 10, distance=0.6)
+    clf = uGradientBoostingClassifier(loss=BinomialDevianceLossFunction(), n_estimators=10, profile=True)
+    clf.fit(trainX, trainY)
+    assert list(clf.profiling_info.index) == [-1] + list(range(10))
+    assert numpy.all(clf.profiling_info.loc[0:, 'fit_tree'] > 0)
+    clf.profile = False
+    assert clf.fit(trainX, trainY).profiling_info is None
+
+
+def test_train_predictions(n_samples=1000):
+    # predictions on training data are computed from leaves of events, should coincide with predict_score
+    trainX, trainY = generate_sample(n_samples, 10, distance=0.6)
+    for splitter in ['best', 'histogram']:
+        for update_tree in [False, True]:
+            clf = uGradientBoostingClassifier(loss=BinomialDevianceLossFunction(), n_estimators=10, splitter=splitter,
+                                              update_tree=update_tree, warm_start=True, random_state=42)
+            clf.fit(trainX, trainY)
+            assert numpy.allclose(clf._train_pred, clf.predict_score(trainX))